@@ -19,6 +19,17 @@
 # required imports
 import arcpy
 import os
+import sys
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+import numpy
+from SegmentationUtils import (METADATA_CACHE, METADATA_STATS, SCRATCH, describe,
+                               list_fields, invalidate_metadata, clear_metadata_cache,
+                               scratch_path, track_scratch, release_scratch, clear_scratch,
+                               check_geometry, check_features, delete_identical,
+                               chain_polylines)
 
 arcpy.env.overwriteOutput = True
 
@@ -38,6 +49,8 @@ USRAP_AVG_AADT = 'USRAP_AVG_AADT'
 USRAP_SEGID = 'USRAP_SEGID'
 USRAP_ROADWAYTYPE = 'USRAP_ROADWAY_TYPE'
 USRAP_CLASS_ERROR = "USRAP_CLASSIFICATION_ERROR"
+USRAP_MISSING = "USRAP_MISSING"
+USRAP_SHORT_SEGMENT = "USRAP_SHORT_SEGMENT"
 
 # conditions constants
 EQUAL_TO = 'EQUAL_TO'
@@ -53,12 +66,57 @@ OUTPUT_GDB_NAME = "BasicSegmentationOutput.gdb"
 # USRAP_SEGID_START_FROM must be number
 USRAP_SEGID_START_FROM = 1000
 
-# keep the progressor at position
-DELETE_OIDS = []
+# every county numbers its USRAP segments in a block of its own starting at
+# USRAP_SEGID_START_FROM + (county object id - 1) * SEGID_COUNTY_BLOCK so
+# the SEGIDs of a county do not depend on the other counties
+SEGID_COUNTY_BLOCK = 100000
+
+# rows read, transformed and inserted together when the segments of a
+# county are copied to the final output
+PROJECT_BATCH_ROWS = 10000
 
 # Name of the final output feature class
 OUTPUT_SEGMENT_NAME = 'Segments'
 
+# number of worker processes used to segment the counties, each worker
+# writes its county to a scratch geodatabase in SCRATCH_FOLDER_NAME
+# 1 processes the counties one after another in this process
+COUNTY_WORKERS = 1
+
+# python interpreter the worker processes are started with, when empty it
+# is looked for in the python environment ArcGIS Pro is running
+WORKER_PYTHON = ""
+SCRATCH_FOLDER_NAME = "BasicSegmentationScratch"
+
+# in_memory budget, in megabytes, for the intermediate datasets of a run,
+# it is shared evenly by the COUNTY_WORKERS processes, once the share of a
+# process is exceeded its largest intermediates are moved to a scratch
+# geodatabase in SCRATCH_FOLDER_NAME and new ones are written there
+SCRATCH_MEMORY_BUDGET_MB = 8192
+
+# when True only the counties whose routes, attribute features or tool
+# parameters changed since the last run are segmented again, their rows in
+# Segments are replaced and the other counties keep their rows and SEGIDs
+# the fingerprint of every county is kept in MANIFEST_TABLE_NAME
+INCREMENTAL_SEGMENTATION = False
+MANIFEST_TABLE_NAME = "SegmentationManifest"
+
+# every county appended to Segments is recorded in CHECKPOINT_TABLE_NAME
+# until the run completes, a run with the same parameters that finds the
+# checkpoint resumes at the first county that was not appended
+CHECKPOINT_TABLE_NAME = "SegmentationCheckpoint"
+
+# fields of the manifest and checkpoint tables, (name, type, length)
+# both tables hold one row per county with the object id range of its
+# rows in Segments
+RECORD_COUNTY = "COUNTY"
+RECORD_FIRST_OID = "FIRST_OID"
+RECORD_LAST_OID = "LAST_OID"
+MANIFEST_FIELDS = [(RECORD_COUNTY, 'TEXT', 255), ("FINGERPRINT", 'TEXT', 40),
+                   (RECORD_FIRST_OID, 'LONG', None), (RECORD_LAST_OID, 'LONG', None)]
+CHECKPOINT_FIELDS = [(RECORD_COUNTY, 'TEXT', 255), ("PARAMETERS", 'TEXT', 40),
+                     (RECORD_FIRST_OID, 'LONG', None), (RECORD_LAST_OID, 'LONG', None)]
+
 # Access Control domain description
 value_access_control_full = "Full Access Control"
 value_access_control_partial = "Partial Access Control"
@@ -81,6 +139,59 @@ urban_multi_divided = "Urban Multilane divided"
 urban_multi_undivided = "Urban Multilane Undivided"
 urban_two_undivided = "Urban two-lane Undivided"
 
+# values treated as missing while classifying baseline segments
+MISSING_TEXT_VALUES = ["", " ", None, "0"]
+MISSING_NUMBER_VALUES = ["", " ", None, "0", 0]
+CLASSIFICATION_ERROR_MESSAGE = "Roadway not valid for roadway type classifications"
+
+# USRAP_MISSING holds a bit for each check of get_classification_checks, in
+# that order, that is missing a value and one more bit for segments whose
+# values match no roadway type, the text of USRAP_CLASSIFICATION_ERROR is
+# derived from it, set WRITE_CLASSIFICATION_ERROR to False to leave the text
+# field out of Segments
+WRITE_CLASSIFICATION_ERROR = True
+ROADWAY_TYPE_CHECK = "Roadway Type"
+
+# mileage weighted coverage of every check by county and route type
+COVERAGE_TABLE_NAME = "AttributeCoverage"
+COVERAGE_FIELDS = [("COUNTY", 'TEXT', 255), ("ROUTE_TYPE", 'TEXT', 255),
+                   ("FIELD", 'TEXT', 50), ("TOTAL_MILES", 'DOUBLE', None),
+                   ("MISSING_MILES", 'DOUBLE', None), ("COVERAGE", 'DOUBLE', None)]
+METERS_PER_MILE = 1609.344
+EARTH_RADIUS_MILES = 3958.7613
+
+# USRAP segments longer than MAX_SEGMENT_MILES are cut into equal pieces
+# after merging and the ones shorter than MIN_SEGMENT_MILES are flagged in
+# USRAP_SHORT_SEGMENT, 0 turns either off. Fields starting with one of
+# PROPORTIONAL_FIELD_PREFIXES hold counts that are shared between the
+# pieces by length, every other field is copied.
+MAX_SEGMENT_MILES = 10.0
+MIN_SEGMENT_MILES = 0.1
+PROPORTIONAL_FIELD_PREFIXES = ["CRASH_", "TOTAL_CRASH"]
+
+# what-if evaluation of the merge condition, when MERGE_WHAT_IF is True
+# every scenario is evaluated on the adjacency graph of each county next to
+# the current condition and the segment counts and length histogram of each
+# are written to the MergeScenarios table along with the percent of the
+# classified miles with a valid USRAP classification, COVERAGE, and the
+# miles in segments shorter than MIN_SEGMENT_MILES. A scenario
+# replaces the condition tuples of the fields it names. Only the scenario
+# named by MERGE_SCENARIO, or the current condition when it is None, is
+# written to the segments.
+MERGE_WHAT_IF = False
+MERGE_SCENARIO = None
+MERGE_SCENARIOS = [("AADT 15%", [(USRAP_AVG_AADT, LESS_THAN_EQUAL_TO, 15)]),
+                   ("AADT 25%", [(USRAP_AVG_AADT, LESS_THAN_EQUAL_TO, 25)]),
+                   ("Speed 45/50", [(USRAP_SPEED_LIMIT,
+                                     LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO, 45, 50)])]
+CURRENT_SCENARIO = "Current"
+SCENARIO_TABLE_NAME = "MergeScenarios"
+SCENARIO_LENGTH_BINS = [0, 0.1, 0.25, 0.5, 1, 2, 5, 10]
+SCENARIO_FIELDS = [("SCENARIO", 'TEXT', 100), ("MIN_MILES", 'DOUBLE', None),
+                   ("MAX_MILES", 'DOUBLE', None), ("SEGMENTS", 'LONG', None),
+                   ("MILES", 'DOUBLE', None), ("COVERAGE", 'DOUBLE', None),
+                   ("SHORT_MILES", 'DOUBLE', None)]
+
 VERSION_USED = str(arcpy.GetInstallInfo()['Version'])
 
 # list of road types on which baseline segments will be
@@ -136,23 +247,41 @@ roadway_type = [{USRAP_AREA_TYPE: value_area_type_rural,
                     USRAP_ACCESS_CONTROL: [value_access_control_full],
                     USRAP_ROADWAYTYPE: urban_freeway}]
 
-def check_name_length(feature_name):
-    """ check the maximum name length for file geodatabase feature classes,
-        if exceed, 160 characters would be returned """
-    if len(feature_name) > 160:
-        feature_name = feature_name[:160]
-    return feature_name
+def add_field(dataset, field_name, field_type, **kwargs):
+    """ add a field to a dataset and invalidate its cached metadata """
+    arcpy.AddField_management(dataset, field_name, field_type, **kwargs)
+    invalidate_metadata(dataset)
 
 def get_workspace(feature_class):
     """ returns the workspace location of feature class """
-    if arcpy.Describe(os.path.dirname(feature_class)).dataType != 'Workspace':
+    if describe(os.path.dirname(feature_class)).dataType != 'Workspace':
         return get_workspace(os.path.dirname(feature_class))
     return os.path.dirname(feature_class)
 
+def get_workspace_domains(workspace):
+    """ cached coded values of every domain of a workspace """
+    key = str(workspace)
+    if key in METADATA_CACHE['domains']:
+        METADATA_STATS['hits'] += 1
+    else:
+        METADATA_STATS['misses'] += 1
+        METADATA_CACHE['domains'][key] = dict((domain.name, domain.codedValues)
+                                              for domain in arcpy.da.ListDomains(workspace))
+    return METADATA_CACHE['domains'][key]
+
 def get_domain_values(workspace, domain_name):
     """ takes gdb and domain name as input and return domain value dictinary """
-    return next((domain.codedValues for domain in arcpy.da.ListDomains(workspace)
-            if domain.name == domain_name))
+    return get_workspace_domains(workspace)[domain_name]
+
+def get_domain_codes(workspace, domain_name):
+    """ reversed domain dictionary to find the domain code of a description """
+    key = (str(workspace), domain_name)
+    if key in METADATA_CACHE['domain_codes']:
+        METADATA_STATS['hits'] += 1
+    else:
+        values = get_domain_values(workspace, domain_name)
+        METADATA_CACHE['domain_codes'][key] = dict(zip(values.values(), values.keys()))
+    return METADATA_CACHE['domain_codes'][key]
 
 def get_field_values(feature_class, field_name):
     """ takes feature class and field object as input
@@ -163,27 +292,16 @@ def get_field_values(feature_class, field_name):
 def get_field_object(feature_class, field_name):
     """ takes feature class and field name as input and
         return field object for the given field name"""
-    return next((field for field in arcpy.Describe(feature_class).fields
+    return next((field for field in describe(feature_class).fields
             if field.name == field_name))
 
-def disable_m_value(feature_class):
-    """ Disable M value of feature class """
-    arcpy.env.outputMFlag = 'Disabled'
-    arcpy.env.outputZFlag = 'Disabled'
-    fc_name = os.path.basename(str(feature_class)) + "_noM"
-    return arcpy.FeatureClassToFeatureClass_conversion(feature_class, IN_MEMORY,
-                                                       fc_name)
-
 def create_where_clause(field, route_types, lookup=None):
-    """ create where clause """
+    """ create where clause
+        lookup - domain description to domain code dictionary """
     where_clause = ''
     quotes = ''
     if field.type == "String":
         quotes = "'"
-    if lookup:
-        # reverse the dictinary key, value pair to find domain code
-        # for selected values
-        lookup = dict(list(zip(list(lookup.values()), list(lookup.keys()))))
     for route_type in route_types:
         if len(where_clause) > 0:
             where_clause += ' OR '
@@ -197,36 +315,6 @@ def create_where_clause(field, route_types, lookup=None):
                                                      route_type)
     return where_clause
 
-def identity(target_ftrs, identity_ftrs, output_name=None, output_folder=None, cluster_tolerance="",
-             problem_fields={}, full_out_path=""):
-    """ perform identity analysis on target feature class with identity
-        feature class """
-    try:
-        output_location = IN_MEMORY
-        out_ftrs = os.path.basename(str(identity_ftrs))
-        if output_folder:
-            output_location = output_folder
-            out_ftrs = arcpy.CreateUniqueName(out_ftrs, output_location)
-        else:
-            out_ftrs = os.path.join(output_location, out_ftrs)
-        # add 'identity' in output feature class name if not present
-        if out_ftrs.find('_identity') == -1:
-            out_ftrs += '_identity'
-        out_ftrs = check_name_length(out_ftrs)
-        # identity operation to combine attributes
-        cnt = int(arcpy.GetCount_management(identity_ftrs)[0])
-        if cnt > 0:
-            arcpy.Identity_analysis(target_ftrs, identity_ftrs, out_ftrs,
-                                    "NO_FID", cluster_tolerance)
-            feature_name = check_name_length("sp" + os.path.basename(str(out_ftrs)))
-            if output_name:
-                feature_name = output_name
-            # convert multiparts to single part, if any
-            return out_ftrs
-        return target_ftrs
-    except Exception as e:
-        arcpy.AddError(str(e))
-
 def year(s):
     return s.split("_")[2]
 
@@ -237,573 +325,758 @@ def median(y, x):
         mid -= 1
     return str(sortedList[int(mid)+x])
 
-def calculate_average(feature_class, existing_fields, new_field):
-    """ calculate the average of AADT fields for fields that have
-        valid value """
-
-    add_message("   Calculating average AADT for each segment")
-
-    arcpy.AddField_management(feature_class, new_field, 'DOUBLE', field_alias=new_field)
-    fields = list(existing_fields)
-    #create dict with 0 based index for the years location in the fields collection
+def get_year_order(fields):
+    """ column indexes of the AADT fields in the order they are tested, from
+        the middle year outward, when not every year has a value """
     years = [year(field) for field in fields]
-    indexes = [n for n in range(len(years))]
-    field_order = dict(list(zip(indexes, years)))
-    fields.append(new_field)
-    with arcpy.da.UpdateCursor(feature_class, fields) as cursor:
-        for row in cursor:
-            try:
-                #Add all AADT values
-                dividend = sum([float(value) for value in row[:-1] if value != None and float(value) > 0])
-                #count number of years of AADT data for the row
-                divisor = sum([1 for value in row[:-1] if value != None and float(value) > 0])
-                #If data is not avalible for all years use the middle year
-                # if at least one year is avalible
-                if divisor < len(row[:-1]) and divisor > 0:
-                    testIndex = 0
-                    forwardTest = True
-                    i = 0
-                    while i < len(row[:-1]):
-                        mid = median(list(field_order.values()), testIndex)
-                        value = row[list(field_order.keys())[list(field_order.values()).index(mid)]]
-
-                        if value != None and value != 0:
-                            row[-1] = value
-                            break
-                        if forwardTest:
-                            testIndex = abs(testIndex) + 1
-                        else:
-                            testIndex = -testIndex
-                        i += 1
-                        forwardTest = not forwardTest
-                elif divisor == 0:
-                    row[-1] = None
-                else:
-                    #actual average of the value is only calculated when we have
-                    # continous values across all years in the study
-                    row[-1] = round((dividend / divisor), 1)
-            except (ValueError, ZeroDivisionError):
-                row[-1] = None
-            cursor.updateRow(row)
-    #del cursor
-    arcpy.SetProgressorPosition()
-    return feature_class
+    order = []
+    test_index = 0
+    forward_test = True
+    for i in range(len(years)):
+        order.append(years.index(median(years, test_index)))
+        if forward_test:
+            test_index = abs(test_index) + 1
+        else:
+            test_index = -test_index
+        forward_test = not forward_test
+    return order
 
-def copy_fields(feature_class, fields_name_info, fc_source):
-    """ create new fields and copy records to it """
+def load_aadt_columns(rows):
+    """ load AADT rows into a 2-D array, nulls become NaN
+        returns the array and a mask of rows holding non numeric values """
     try:
-        domain_lu = None
-        field_type = None
-        update_rows = True
-        for existing_field, new_field in list(fields_name_info.items()):
-            # get the field object of existing field in baseline feature class
-            field = get_field_object(fc_source, existing_field)
-            if field.domain:
-                # get the database of selected feature class
-                database = get_workspace(fc_source)
-                # get domains from geo-database for selected feature class
-                # and field
-                domain_lu = get_domain_values(database, field.domain)
-                # field_length=50 from AddField_management
-                arcpy.AddField_management(feature_class, new_field, 'TEXT',
-                                          field_alias=new_field)
-            else:
-                # field_length=field.length,
-                arcpy.AddField_management(feature_class, new_field, field.type,
-                                          field_alias=new_field)
-
-            if not [field.name for field in arcpy.Describe(feature_class).fields].count(existing_field) > 0:
-                update_rows = False
-
-            if update_rows:
-                with arcpy.da.UpdateCursor(feature_class, [existing_field,
-                                                           new_field]) as cursor:
-                    for row in cursor:
-                        # row[1] is newly created field and row[0] is added after
-                        # identity operation
-                        row[1] = row[0]
-                        if domain_lu:
-                            try:
-                                row[1] = str(domain_lu[row[0]])
-                            except KeyError:
-                                row[1] = None
-                        cursor.updateRow(row)
-                #del cursor
-        return feature_class
-    except Exception as error:
-        arcpy.AddError(str(error))
-
-def combine_attributes(fc_target, fc_identity, fc_identity_field_name,
-                       new_field_name, output_name=None, output_folder=None, cluster_tolerance="", problem_fields={}, full_out_path="", fc_source=""):
-    """ combines the required fields from other feature classes with
-        baseline feature class """
+        values = numpy.array(rows, dtype=float).reshape(len(rows), -1)
+        return values, numpy.zeros(len(values), dtype=bool)
+    except (TypeError, ValueError):
+        width = len(rows[0]) if len(rows) > 0 else 0
+        values = numpy.full((len(rows), width), numpy.nan)
+        invalid = numpy.zeros(len(rows), dtype=bool)
+        for index, row in enumerate(rows):
+            try:
+                values[index] = numpy.array(row, dtype=float)
+            except (TypeError, ValueError):
+                invalid[index] = True
+        return values, invalid
+
+def average_aadt_columns(values, year_order):
+    """ average AADT of each row of a 2-D array (rows x years, NaN for null)
+        the actual average is only used when every year has a value, for rows
+        with gaps the first value found from the middle year outward is used
+        returns a float array with NaN where no average could be found """
+    aadt = numpy.ma.masked_invalid(values)
+    valid = ~numpy.ma.getmaskarray(aadt) & (aadt.filled(0) > 0)
+    divisor = valid.sum(axis=1)
+
+    # add the years in field order so the sum matches a per row python sum
+    dividend = numpy.zeros(len(values))
+    for index in range(values.shape[1]):
+        dividend = dividend + numpy.where(valid[:, index], aadt.filled(0)[:, index], 0.0)
+
+    average = numpy.full(len(values), numpy.nan)
+    full = divisor == values.shape[1]
+    average[full] = dividend[full] / divisor[full]
+
+    partial = (divisor > 0) & ~full
+    available = ~numpy.ma.getmaskarray(aadt) & (aadt.filled(0) != 0)
+    for index in year_order:
+        found = partial & numpy.isnan(average) & available[:, index]
+        average[found] = values[found, index]
+    return average, full
+
+def get_average_aadt(rows, fields):
+    """ average AADT of each row of AADT values, the values of a row are in
+        the order of fields, returns a list with None where no average
+        could be found """
+    if len(rows) == 0:
+        return []
+    values, invalid = load_aadt_columns(rows)
+    average, full = average_aadt_columns(values, get_year_order(fields))
+    averages = []
+    for value, is_full, is_invalid in zip(average, full, invalid):
+        if is_invalid or numpy.isnan(value):
+            averages.append(None)
+        elif is_full:
+            #actual average of the value is only calculated when we have
+            # continous values across all years in the study
+            averages.append(round(float(value), 1))
+        else:
+            averages.append(float(value))
+    return averages
+
+def get_classification_checks(field_route_name):
+    """ list of (field, missing values, description) tested on every
+        baseline segment, in the order missing values are reported """
+    return [(USRAP_AVG_AADT, MISSING_NUMBER_VALUES, "AADT"),
+            (USRAP_SPEED_LIMIT, MISSING_NUMBER_VALUES, "Speed Limit"),
+            (USRAP_COUNTY, MISSING_TEXT_VALUES, "County"),
+            (USRAP_ACCESS_CONTROL, MISSING_TEXT_VALUES, "Access Control"),
+            (USRAP_MEDIAN, MISSING_NUMBER_VALUES, "Median"),
+            (USRAP_LANES, MISSING_NUMBER_VALUES, "Lanes"),
+            (USRAP_AREA_TYPE, MISSING_TEXT_VALUES, "Area Type"),
+            (field_route_name, MISSING_NUMBER_VALUES, "Route Name")]
+
+def get_lane_class(value):
+    """ return the lane condition of roadway_type satisfied by value """
     try:
-        #add_formatted_message("   Combining {0} into routes", fc_identity_field_name)
-
-        if arcpy.Describe(fc_target).hasM:
-            fc_target = disable_m_value(fc_target)
-
-        # keep the feature class to find domain in copy_fields function
-        if arcpy.Describe(fc_identity).hasM:
-            fc_identity = disable_m_value(fc_identity)
-        # keep required fields in list to find newly added fields after identity
-        # operation
-        fc_target_fields = [field.name.lower() for field in
-                            arcpy.Describe(fc_target).fields]
-
-        # identity analysis to combine attributes of identity feature class
-        baseline_routes = identity(fc_target, fc_identity,
-                                   output_name, output_folder,
-                                   cluster_tolerance, problem_fields, full_out_path)
-
-        fc_identity_fields = []
-        for field in arcpy.Describe(fc_identity).fields:
-            if field.name != fc_identity_field_name and \
-                    not field.required and \
-                    not field.name.lower().startswith('shape') and \
-                    not field.name.lower().startswith('objectid'):
-                fc_identity_fields.append(field.name.lower())
-
-        # delete unncessary fields coming from identity feature class
-        if len(fc_identity_fields) > 0:
-            arcpy.DeleteField_management(baseline_routes, fc_identity_fields)
-
-        # find the fields newly added in baseline feature class after identity
-        # operation
-        baseline_route_fields = [field.name for field in
-                                 arcpy.Describe(baseline_routes).fields
-                                 if field.name.lower() not in
-                                 fc_target_fields and not field.required]
-
-        # copy existing feild rows into a new field added in
-        # baseline feature class
-        # this could be invalid still if fc_target and fc_identity share a
-        # common field name...fc_identity_field_name...prior to identity operation
-        field_dict = {fc_identity_field_name: new_field_name}
-
-        baseline_routes = copy_fields(baseline_routes, field_dict, fc_source)
-
-        #NOT WITH IN_MEM data
-        #arcpy.AddIndex_management(baseline_routes, new_field_name, new_field_name, "NON_UNIQUE", "NON_ASCENDING")
-
-        # delete the previous field from which rows has beed copied to new field
-        if len(baseline_route_fields) > 0:
-            arcpy.DeleteField_management(baseline_routes, baseline_route_fields)
-
-        if not arcpy.Exists(full_out_path):
-            if isinstance(baseline_routes, str) or isinstance(baseline_routes, str):
-                name = str(baseline_routes)
-            else:
-                name = baseline_routes[0]
-
-            n_d = arcpy.Describe(name)
-            arcpy.CreateFeatureclass_management(os.path.dirname(full_out_path),
-                                                os.path.basename(full_out_path),
-                                                n_d.shapeType,
-                                                name,
-                                                spatial_reference=n_d.spatialReference)
-            #del n_d
-        #verify it has the necessary USRAP fields
-        domain_lu = None
-        field_type = None
-
-        for existing_field, new_field in list(field_dict.items()):
-            if not len([field.name for field in arcpy.ListFields(full_out_path) if field.name == new_field]) == 1:
-                # get the field object of existing field in baseline feature class
-                name = ""
-                if isinstance(baseline_routes, str) or isinstance(baseline_routes, str):
-                    name = str(baseline_routes)
-                else:
-                    name = baseline_routes[0]
-                field = get_field_object(name, new_field)
-                if field.domain:
-                    # get the database of selected feature class
-                    database = get_workspace(fc_source)
-                    # get domains from geo-database for selected feature class
-                    # and field
-                    domain_lu = get_domain_values(database, field.domain)
-                    # field_length=50 from AddField_management
-                    arcpy.AddField_management(full_out_path, new_field, 'TEXT',
-                                                field_alias=new_field)
-                    #del database, domain_lu
-                else:
-                    # field_length=field.length,
-                    arcpy.AddField_management(full_out_path, new_field, field.type,
-                                            field_alias=new_field)
-       
-        arcpy.SetProgressorPosition()
-        return baseline_routes
-    except Exception as e:
-        arcpy.SetProgressorPosition()
-        arcpy.AddError(str(e))
-
-def identify_usrap_segment(feature_class, roadway_types, output_folder, field_route_name):
-    """ create new field 'USRAP_SEGMENT' and assign 'YES' or 'NO' valuecording to roadway type """
-
-    add_message("   Identifying USRAP segments...")
-    # field name for USRAP segments
-    fields = list(set([k for d in roadway_types for k in list(d.keys())]))
-    fields.append(USRAP_SEGMENT)
-    fields.append(USRAP_AVG_AADT)
-    fields.append(USRAP_SPEED_LIMIT)
-    fields.append(USRAP_CLASS_ERROR)
-    fields.append(USRAP_COUNTY)
-    fields.append(USRAP_MEDIAN)
-    fields.append(field_route_name)
-    fields.append("OID@")
+        lanes = float(value)
+    except (TypeError, ValueError):
+        return None
+    if lanes == 2:
+        return EQUAL_TO_2_LANES
+    elif lanes > 2:
+        return MORE_THAN_2_LANES
+    return None
+
+def compile_roadway_types(roadway_types):
+    """ compile the roadway type list into a lookup keyed by
+        (area type, lane class, median, access control) """
+    lookup = {}
+    for road_type in roadway_types:
+        for access_control in road_type[USRAP_ACCESS_CONTROL]:
+            key = (road_type[USRAP_AREA_TYPE], road_type[USRAP_LANES],
+                   road_type[USRAP_MEDIAN], access_control)
+            if key not in lookup:
+                lookup[key] = road_type[USRAP_ROADWAYTYPE]
+    return lookup
+
+def get_classification_error(missing):
+    """ build the classification error message from the descriptions of
+        the missing values """
+    if len(missing) > 1:
+        return "Missing " + (' AND '.join(missing)) + " values"
+    elif len(missing) == 1:
+        return "Missing {0} value".format(missing[0])
+    return CLASSIFICATION_ERROR_MESSAGE
+
+def get_missing_mask(column, missing_values):
+    """ vectorized test of a column against the missing values """
+    column = numpy.asarray(column)
+    if column.dtype.kind == 'f':
+        mask = numpy.isnan(column)
+        numbers = [v for v in missing_values if not isinstance(v, str) and v is not None]
+        if len(numbers) > 0:
+            mask |= numpy.isin(column, numbers)
+        return mask
+    elif column.dtype.kind in 'iub':
+        numbers = [v for v in missing_values if not isinstance(v, str) and v is not None]
+        return numpy.isin(column, numbers)
+    elif column.dtype.kind == 'U':
+        return numpy.isin(column, [v for v in missing_values if isinstance(v, str)])
+    test = numpy.frompyfunc(lambda value: value in missing_values, 1, 1)
+    return test(column).astype(bool)
+
+def get_value_codes(column, values):
+    """ return the position of each column value in values, -1 when the
+        column value is not present """
+    column = numpy.asarray(column)
+    codes = numpy.full(len(column), -1, dtype=numpy.int64)
+    for index, value in enumerate(values):
+        codes[column == value] = index
+    return codes
+
+def classify_usrap_arrays(columns, lookup, field_route_name):
+    """ classify baseline segments held as column arrays in one vectorized
+        call, for example the result of arcpy.da.FeatureClassToNumPyArray
+        columns - structured array or dictionary of field name and array
+        returns (USRAP_SEGMENT, USRAP_ROADWAY_TYPE) object arrays and the
+        USRAP_MISSING bitmask array """
+    checks = get_classification_checks(field_route_name)
+    row_count = len(columns[USRAP_AREA_TYPE])
+
+    # encode the missing values of each row as a bitmask so the error
+    # message is only built once per distinct combination
+    missing_bits = numpy.zeros(row_count, dtype=numpy.int64)
+    for bit, (field, missing_values, description) in enumerate(checks):
+        missing_bits[get_missing_mask(columns[field], missing_values)] |= 1 << bit
+
+    # encode each lookup key element and combine them to a single code
+    keys = list(lookup.keys())
+    key_values = [sorted(set(key[i] for key in keys), key=str) for i in range(4)]
+    lanes = numpy.frompyfunc(get_lane_class, 1, 1)(
+        numpy.asarray(columns[USRAP_LANES], dtype=object))
+    codes = [get_value_codes(columns[USRAP_AREA_TYPE], key_values[0]),
+             get_value_codes(lanes, key_values[1]),
+             get_value_codes(columns[USRAP_MEDIAN], key_values[2]),
+             get_value_codes(columns[USRAP_ACCESS_CONTROL], key_values[3])]
+    combined = numpy.zeros(row_count, dtype=numpy.int64)
+    valid = numpy.ones(row_count, dtype=bool)
+    for code, values in zip(codes, key_values):
+        valid &= code >= 0
+        combined = combined * len(values) + numpy.maximum(code, 0)
+
+    table_size = 1
+    for values in key_values:
+        table_size *= len(values)
+    road_types = numpy.full(table_size, None, dtype=object)
+    for key, road_type in lookup.items():
+        index = 0
+        for element, values in zip(key, key_values):
+            index = index * len(values) + values.index(element)
+        road_types[index] = str(road_type)
+
+    roadway = numpy.where(valid, road_types[combined], None)
+    unmatched = numpy.equal(roadway, None) & (missing_bits == 0)
+    missing_bits[unmatched] |= 1 << len(checks)
+    roadway[missing_bits != 0] = None
+    segment = numpy.where(numpy.equal(roadway, None), 'NO', 'YES').astype(object)
+    return segment, roadway, missing_bits
+
+def get_classification_errors(missing_bits, checks):
+    """ USRAP_CLASSIFICATION_ERROR text of each segment derived from its
+        USRAP_MISSING bitmask, the message is only built once per distinct
+        combination of bits """
+    missing_bits = numpy.asarray(missing_bits)
+    error = numpy.full(len(missing_bits), None, dtype=object)
+    error[missing_bits == 1 << len(checks)] = CLASSIFICATION_ERROR_MESSAGE
+    for bits in numpy.unique(missing_bits[(missing_bits != 0) &
+                                          (missing_bits != 1 << len(checks))]):
+        missing = [checks[bit][2] for bit in range(len(checks)) if bits & (1 << bit)]
+        error[missing_bits == bits] = get_classification_error(missing)
+    return error
+
+def get_check_names(checks):
+    """ name of each bit of USRAP_MISSING """
+    return [check[2] for check in checks] + [ROADWAY_TYPE_CHECK]
+
+def summarize_coverage(checks, missing_bits, route_types, miles):
+    """ mileage with and without a value for every check by route type
+        returns {(route type, check name): (total miles, missing miles)} """
+    keys = numpy.array(["" if value is None else str(value) for value in route_types],
+                       dtype=str)
+    names, inverse = numpy.unique(keys, return_inverse=True)
+    total = numpy.bincount(inverse, weights=miles, minlength=len(names))
+    coverage = {}
+    for bit, check_name in enumerate(get_check_names(checks)):
+        flagged = ((missing_bits >> bit) & 1).astype(float)
+        missing = numpy.bincount(inverse, weights=miles * flagged, minlength=len(names))
+        for index, name in enumerate(names):
+            coverage[(str(name), check_name)] = (float(total[index]), float(missing[index]))
+    return coverage
+
+def add_classification_fields(feature_class):
+    """ create the fields that hold the USRAP classification """
     # create new field to identify USRAP Segments
-    arcpy.AddField_management(feature_class, USRAP_SEGMENT, 'TEXT',
+    add_field(feature_class, USRAP_SEGMENT, 'TEXT',
                               field_length=3, field_alias=USRAP_SEGMENT)
 
     # create new field to store USRAP roadway type
-    arcpy.AddField_management(feature_class, USRAP_ROADWAYTYPE, 'TEXT',
+    add_field(feature_class, USRAP_ROADWAYTYPE, 'TEXT',
                               field_length=100, field_alias=USRAP_ROADWAYTYPE)
 
-    # create new field to store USRAP classification error
-    arcpy.AddField_management(feature_class, USRAP_CLASS_ERROR, 'TEXT',
-                              field_length=200, field_alias=USRAP_CLASS_ERROR)
-
-    workspace = os.path.dirname(str(feature_class))
+    # create new field to store the bitmask of missing values
+    add_field(feature_class, USRAP_MISSING, 'LONG', field_alias=USRAP_MISSING)
 
-    # take a segment to from baseline route feature class
-    with arcpy.da.UpdateCursor(feature_class, fields) as cursor:
+    # create new field to store USRAP classification error
+    if WRITE_CLASSIFICATION_ERROR:
+        add_field(feature_class, USRAP_CLASS_ERROR, 'TEXT',
+                                  field_length=200, field_alias=USRAP_CLASS_ERROR)
+
+def write_usrap_classification(feature_class, oids, columns):
+    """ write the classification columns back to the feature class in one
+        cursor pass, columns - dictionary of field name and array """
+    fields = list(columns.keys())
+    results = dict(zip(oids, zip(*[columns[field] for field in fields])))
+    with arcpy.da.UpdateCursor(feature_class, ['OID@'] + fields) as cursor:
         for row in cursor:
-            errors = {}
-            for roadway_type in roadway_types:
-                truth_table = []
-                if '' in row:
-                    truth_table.append(False)
-                    break
-
-                # test a segment on roadway type to identify it as usrap segment
-                for field in list(roadway_type.keys()):
-                    if field != USRAP_ROADWAYTYPE:
-                        try:
-                            # check for access control
-                            if field == USRAP_ACCESS_CONTROL:
-                                truth_table.append(row[fields.index(field)] in
-                                                   roadway_type[field])
-                            # check for lanes
-                            elif field == USRAP_LANES:
-                                try:
-                                    if roadway_type[field] == EQUAL_TO_2_LANES:
-                                        val = float(row[fields.index(field)]) == 2
-                                        truth_table.append(val)
-                                    elif roadway_type[field] == MORE_THAN_2_LANES:
-                                        val = float(row[fields.index(field)]) > 2
-                                        truth_table.append(val)
-                                except ValueError:
-                                    truth_table.append(False)
-                            else:
-                                index = fields.index(field)
-                                val = row[index] == roadway_type[field]
-                                truth_table.append(val)
-                        except IndexError:
-                            continue
-                        if False in truth_table:
-                            break
-                #No need to do the previous loop if this stuff is missing...TODO move before the previous loop
-                # verify we have a value for USRAP_AREA_TYPE
-                if row[fields.index(USRAP_AREA_TYPE)] in ["", " ", None, "0"]:
-                    errors[USRAP_AREA_TYPE] = False
-                    truth_table.append(False)
-
-                # verify we have a value for USRAP_LANES
-                if row[fields.index(USRAP_LANES)] in ["", " ", None, "0", 0]:
-                    errors[USRAP_LANES] = False
-                    truth_table.append(False)
-
-                # verify we have a value for USRAP_MEDIAN
-                if row[fields.index(USRAP_MEDIAN)] in ["", " ", None, "0", 0]:
-                    errors[USRAP_MEDIAN] = False
-                    truth_table.append(False)
-
-                # verify we have a value for USRAP_COUNTY
-                if row[fields.index(USRAP_COUNTY)] in ["", " ", None, "0"]:
-                    errors[USRAP_COUNTY] = False
-                    truth_table.append(False)
-
-                # verify we have a value for USRAP_ACCESS_CONTROL
-                if row[fields.index(USRAP_ACCESS_CONTROL)] in ["", " ", None, "0"]:
-                    errors[USRAP_ACCESS_CONTROL] = False
-                    truth_table.append(False)
-
-                # verify we have a value for USRAP_SPEED_LIMIT
-                if row[fields.index(USRAP_SPEED_LIMIT)] in ["", " ", None, "0", 0]:
-                    errors[USRAP_SPEED_LIMIT] = False
-                    truth_table.append(False)
-
-                #verify we have a value for USRAP_AVG_AADT
-                if row[fields.index(USRAP_AVG_AADT)] in ["", " ", None, "0", 0]:
-                    errors[USRAP_AVG_AADT] = False
-                    truth_table.append(False)
-
-                #verify we have a value for ROUTE_NAME
-                if row[fields.index(field_route_name)] in ["", " ", None, "0", 0]:
-                    errors[field_route_name] = False
-                    truth_table.append(False)
-
-                if False not in truth_table:
-                    # mark segment as usrap segment 'YES' if it fulfill the
-                    # roadway type condition
-                    row[fields.index(USRAP_SEGMENT)] = 'YES'
-                    # write the short name for the roadway type to the table
-                    row[fields.index(USRAP_ROADWAYTYPE)] = str(roadway_type[USRAP_ROADWAYTYPE])
-                    cursor.updateRow(row)
-                    break
-            if truth_table and False in truth_table:
-                #verify that the row has all necessary attributes
-                # log error message is values are missing
-                allTrue = True
-                has_speed = True
-                has_aadt = True
-                has_county = True
-                has_access_control = True
-                has_median = True
-                has_lanes = True
-                has_area_type = True
-                has_name = True
-                for field in list(errors.keys()):
-                    if str(errors[field]) != 'True':
-                        allTrue = False
-                        if str(field) == USRAP_AVG_AADT:
-                            has_aadt = False
-                        if str(field) == USRAP_COUNTY:
-                            has_county = False
-                        if str(field) == USRAP_ACCESS_CONTROL:
-                            has_access_control = False
-                        if str(field) == USRAP_MEDIAN:
-                            has_median = False
-                        if str(field) == USRAP_LANES:
-                            has_lanes = False
-                        if str(field) == USRAP_AREA_TYPE:
-                            has_area_type = False
-                        if str(field) == USRAP_SPEED_LIMIT:
-                            has_speed = False
-                        if str(field) == field_route_name:
-                            has_name = False
-
-                error_message = ""
-                error_messages = []
-                classification_error_message = "Roadway not valid for roadway type classifications"
-                if allTrue:
-                    error_messages.append(classification_error_message)
-                else:
-                    if not has_aadt:
-                        error_messages.append("AADT")
-                    if not has_speed:
-                        error_messages.append("Speed Limit")
-                    if not has_county:
-                        error_messages.append("County")
-                    if not has_access_control:
-                        error_messages.append("Access Control")
-                    if not has_median:
-                        error_messages.append("Median")
-                    if not has_lanes:
-                        error_messages.append("Lanes")
-                    if not has_area_type:
-                        error_messages.append("Area Type")
-                    if not has_name:
-                        error_messages.append("Route Name")
-
-                if len(error_messages) > 1:
-                    error_message = "Missing " + (' AND '.join(error_messages)) + " values"
-                else:
-                    if error_messages[0] == classification_error_message:
-                        error_message = error_messages[0]
-                    else:
-                        error_message = "Missing {0} value".format(error_messages[0])
-
-                row[fields.index(USRAP_CLASS_ERROR)] = error_message
-
-                # mark segment as usrap segment 'NO' if it does not fulfill the
-                # roadway type condition
-                row[fields.index(USRAP_SEGMENT)] = 'NO'
-                cursor.updateRow(row)
-    #del cursor
+            if row[0] in results:
+                cursor.updateRow([row[0]] + list(results[row[0]]))
     return feature_class
 
-def merge_segments(update_row, update_cursor, fields, feature_class, condition):
-    """ merge the adjacent segments according to condition provided and
-        update its field value  """
-    if update_row[0] not in DELETE_OIDS:
-        try:
-            # find the adjacent segments
-            where = "{0} = 'YES'".format(USRAP_SEGMENT)
-
-            #for tup in condition:
-            #    val = str(update_row[fields.index(tup[0])])
-            #    if tup[1] == 'EQUAL_TO':
-            #        if tup[0] == 'USRAP_LANES':
-            #            where += " AND " + tup[0] + " = " + val
-            #        else:
-            #            where += " AND " + tup[0] + " = '" + val + "'"
-            #    if tup[1] == 'LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO':
-            #        if val <= tup[2]:
-            #            where += " AND " + tup[0] + " <= " + str(tup[2])
-            #        else:
-            #            where += " AND " + tup[0] + " >= " + str(tup[3])
-                #if tup[1] == 'LESS_THAN_EQUAL_TO':
-                #    #determine the bounds for the percentage based on the current value...
-                #    #take double the value or half of the value to allow room for value growth...this one may be sketchy but would most likely help eliminate the most
-                #    current_aadt = float(val)
-                #    if current_aadt > 100:
-                #        max_aadt = float(current_aadt) * 2
-                #        min_aadt = float(current_aadt) / 2
-                #    else:
-                #        d = float(current_aadt) * 2
-                #        if d > 100:
-                #            max_aadt = d
-                #        else:
-                #            max_aadt = 100
-                #        min_aadt = 0
-                #    where += " AND " + tup[0] + " > " + str(min_aadt)
-                #    where += " AND " + tup[0] + " < " + str(max_aadt)
-
-            arcpy.SelectLayerByAttribute_management(feature_class, "NEW_SELECTION",where)
-
-            #for each usRAP segment query for additional segments that intersect
-            arcpy.SelectLayerByLocation_management(feature_class, "INTERSECT", update_row[-1], selection_type="SUBSET_SELECTION")
-
-            OID_merged = []
-            # merge segments that meet the criteria and intersect the source feature
-            with arcpy.da.SearchCursor(feature_class, fields) as cursor:
-                for current in cursor:
-                    #no need to check if this is ths same OID
-                    if update_row[0] == current[0]:
-                        continue
-                    if '' in current or None in current:
-                        continue
+def identify_usrap_segment(feature_class, roadway_types, field_route_name, field_route_type):
+    """ create new field 'USRAP_SEGMENT' and assign 'YES' or 'NO' according
+        to roadway type, the missing values of each segment are recorded in
+        USRAP_MISSING and summarized by route type
+        returns the coverage found by summarize_coverage """
 
-                    # truth_table contains boolean value for each condition
-                    truth_table = []
-                    avg_aadt = []
-                    for tup in condition:
-                        pre_val = update_row[fields.index(tup[0])]
-                        cur_val = current[fields.index(tup[0])]
-                        # check for 'EQUAL_TO' condition
-                        if tup[1] == EQUAL_TO:
-                            if tup[0] == USRAP_ACCESS_CONTROL:
-                                #no and partial access should be evaluated as the same
-                                truth_table.append(pre_val == cur_val or
-                                                   (str(pre_val) != value_access_control_full and
-                                                    str(cur_val) != value_access_control_full))
-                            else:
-                                truth_table.append(pre_val == cur_val)
-                            continue
-                        # check for 'LESS_THAN_EQUAL_TO' condition
-                        elif tup[1] == LESS_THAN_EQUAL_TO:
-                            if tup[0] == USRAP_AVG_AADT:
-                                sort = sorted([pre_val, cur_val])
-                                avg_aadt.append(fields.index(tup[0]))
-                                # get length of segments
-                                if update_row != None:
-                                    update_row_length = update_row[-1].getLength()
-                                else:
-                                    update_row_length = 0
-
-                                if current[-1] != None:
-                                    current_row_length = current[-1].getLength()
-                                else:
-                                    current_row_length = 0
-
-                                if sort[0] == 0 or None in sort:
-                                    truth_table.append(sort[1] <= tup[2])
-                                else:
-                                    percent_val = ((sort[1]-sort[0])/sort[0]) * 100
-                                    truth_table.append(percent_val <= tup[2])
-
-                                if pre_val == None and cur_val != None:
-                                    pre_val = 0
-                                elif cur_val == None and pre_val != None:
-                                    cur_val = 0
-                                if pre_val == cur_val == None:
-                                    weighted_avrg = None
-                                else:
-                                    # calculate weighted average
-                                    if (update_row_length + current_row_length) > 0:
-                                        weighted_avrg = (((pre_val*update_row_length) +
-			                                        (cur_val*current_row_length))/
-			                                        (update_row_length +
-			                                        current_row_length))
-                                        weighted_avrg = round(weighted_avrg, 1)
-                                    else:
-                                        weighted_avrg = 0
-                                    avg_aadt.append(weighted_avrg)
-                                continue
-                            else:
-                                truth_table.append(float(pre_val) <= tup[2] and
-                                                   float(cur_val) <= tup[2])
-                        # check for 'LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO'
-                        # condition
-                        elif tup[1] == LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO:
-                            truth_table.append((float(pre_val) <= tup[2] and
-                                                float(cur_val) <= tup[2]) or
-                                               (float(pre_val) >= tup[3] and
-                                                float(cur_val) >= tup[3]))
-                        # check for 'MORE_THAN_EQUAL_TO' condition
-                        elif tup[1] == MORE_THAN_EQUAL_TO:
-                            truth_table.append(float(pre_val >= tup[2] and
-                                                     float(cur_val) >= tup[2]))
-
-                    # proceed to merge geometry when all conditions are satisfied
-                    if not False in truth_table:
-                        if update_row[0] not in DELETE_OIDS:
-                            try:
-                                update_row[avg_aadt[0]] = avg_aadt[1]        
-                                update_row[-1] = update_row[-1].union(current[-1])
-
-                                update_cursor.updateRow(update_row)
-
-                                OID_merged.append(current[0])
-                                DELETE_OIDS.append(current[0])
-
-                            except Exception as re:
-                                msg = "Merge failed for ObjectId {0} and {1}".format(\
-                                        update_row[0], current[0])
-                                arcpy.AddWarning(msg)
-                # delete the redundant records which are merged with others
-                where = ''
-                if len(OID_merged) > 0:
-                    merged_oids = list(map(str, OID_merged))
-                    field_oid = str(arcpy.Describe(feature_class).OIDFieldName)
-                    where = field_oid +' = ' + ' OR {0} = '.format(field_oid).join(merged_oids)
-                    arcpy.SelectLayerByAttribute_management(feature_class,
-                                                            'NEW_SELECTION',
-                                                            where)
-                    arcpy.DeleteRows_management(feature_class)
-
-                    # Recursive call with updated row
-                    #del cursor
-                    return merge_segments(update_row, update_cursor, fields,
-                                          feature_class, condition)
-            #del cursor
-            return feature_class
-        except RuntimeError as error:
-            arcpy.AddError(str(error))
-            raise arcpy.ExecuteError(error[0])
-
-def add_segids(feature_class, field_name):
-    """ add unique id to USRAP_SEGID in usrap feature class  """
-    try:
-        where = "{0} = 'YES'".format(USRAP_SEGMENT)
-        arcpy.SelectLayerByAttribute_management(feature_class,
-                                                'CLEAR_SELECTION')
-        arcpy.SelectLayerByAttribute_management(feature_class, "NEW_SELECTION", where)
-        arcpy.AddField_management(feature_class, field_name, 'LONG',
-                                  field_alias=field_name)
-        segment_id = USRAP_SEGID_START_FROM
-        with arcpy.da.UpdateCursor(feature_class, [field_name], where) as update_cur:
-            for row in update_cur:
-                row[0] = segment_id
-                segment_id += 1
-                update_cur.updateRow(row)
-        #del update_cur
-        arcpy.SelectLayerByAttribute_management(feature_class,
-                                        'CLEAR_SELECTION')
-        return feature_class
-    except Exception as e:
-        arcpy.AddError(str(e))
+    add_message("   Identifying USRAP segments...")
+    lookup = compile_roadway_types(roadway_types)
+    checks = get_classification_checks(field_route_name)
+    fields = []
+    for check in checks:
+        if check[0] not in fields:
+            fields.append(check[0])
+    add_classification_fields(feature_class)
+
+    mile_factor = get_mile_factor(describe(feature_class).spatialReference)
+    shape_field = "SHAPE@" if mile_factor is None else "SHAPE@LENGTH"
+    with arcpy.da.SearchCursor(feature_class, ['OID@', field_route_type, shape_field] +
+                               fields) as cursor:
+        rows = [row for row in cursor]
+    oids = [row[0] for row in rows]
+    route_types = [row[1] for row in rows]
+    miles = numpy.array([get_miles(row[2], mile_factor) for row in rows], dtype=float)
+    columns = dict((field, numpy.array([row[3 + index] for row in rows], dtype=object))
+                   for index, field in enumerate(fields))
+    del rows
+
+    segment, roadway, missing_bits = classify_usrap_arrays(columns, lookup, field_route_name)
+    results = {USRAP_SEGMENT: segment, USRAP_ROADWAYTYPE: roadway,
+               USRAP_MISSING: [int(bits) for bits in missing_bits]}
+    if WRITE_CLASSIFICATION_ERROR:
+        results[USRAP_CLASS_ERROR] = get_classification_errors(missing_bits, checks)
+    write_usrap_classification(feature_class, oids, results)
+    return summarize_coverage(checks, missing_bits, route_types, miles)
+
+def find_root(parents, key):
+    """ return the surviving member of the merge group that contains key """
+    root = key
+    while parents[root] != root:
+        root = parents[root]
+    # compress the path so later lookups are a single step
+    while parents[key] != root:
+        parents[key], key = root, parents[key]
+    return root
+
+def union_roots(parents, survivor, merged):
+    """ attach the group of merged to the group of survivor """
+    survivor = find_root(parents, survivor)
+    merged = find_root(parents, merged)
+    if survivor != merged:
+        parents[merged] = survivor
+    return survivor
+
+def endpoint_cells(geometry, tolerance):
+    """ return the grid cells of the first and last vertex of every part """
+    cells = []
+    for part in geometry:
+        points = [point for point in part if point]
+        if len(points) == 0:
+            continue
+        for point in (points[0], points[-1]):
+            cells.append((point.X, point.Y,
+                          int(point.X // tolerance), int(point.Y // tolerance)))
+    return cells
+
+def build_endpoint_graph(geometries, tolerance):
+    """ build adjacency lists for segments whose end points touch
+        within tolerance """
+    grid = {}
+    for oid, geometry in geometries.items():
+        for x, y, cell_x, cell_y in endpoint_cells(geometry, tolerance):
+            grid.setdefault((cell_x, cell_y), []).append((x, y, oid))
+
+    graph = dict((oid, set()) for oid in geometries)
+    for (cell_x, cell_y), points in grid.items():
+        neighbours = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbours += grid.get((cell_x + dx, cell_y + dy), [])
+        for x, y, oid in points:
+            for other_x, other_y, other_oid in neighbours:
+                if other_oid != oid and \
+                        abs(x - other_x) <= tolerance and \
+                        abs(y - other_y) <= tolerance:
+                    graph[oid].add(other_oid)
+    return graph
+
+def check_merge_condition(condition, survivor, candidate):
+    """ test the merge condition tuples between the values of the
+        surviving segment and a candidate segment """
+    for tup in condition:
+        pre_val = survivor[tup[0]]
+        cur_val = candidate[tup[0]]
+        # check for 'EQUAL_TO' condition
+        if tup[1] == EQUAL_TO:
+            if tup[0] == USRAP_ACCESS_CONTROL:
+                #no and partial access should be evaluated as the same
+                if not (pre_val == cur_val or
+                        (str(pre_val) != value_access_control_full and
+                         str(cur_val) != value_access_control_full)):
+                    return False
+            elif pre_val != cur_val:
+                return False
+        # check for 'LESS_THAN_EQUAL_TO' condition
+        elif tup[1] == LESS_THAN_EQUAL_TO:
+            if tup[0] == USRAP_AVG_AADT:
+                sort = sorted([float(pre_val), float(cur_val)])
+                if sort[0] == 0:
+                    if not sort[1] <= tup[2]:
+                        return False
+                elif not ((sort[1]-sort[0])/sort[0]) * 100 <= tup[2]:
+                    return False
+            elif not (float(pre_val) <= tup[2] and float(cur_val) <= tup[2]):
+                return False
+        # check for 'LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO' condition
+        elif tup[1] == LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO:
+            if not ((float(pre_val) <= tup[2] and float(cur_val) <= tup[2]) or
+                    (float(pre_val) >= tup[3] and float(cur_val) >= tup[3])):
+                return False
+        # check for 'MORE_THAN_EQUAL_TO' condition
+        elif tup[1] == MORE_THAN_EQUAL_TO:
+            if not (float(pre_val) >= tup[2] and float(cur_val) >= tup[2]):
+                return False
+    return True
+
+def weighted_aadt(aadt_1, length_1, aadt_2, length_2):
+    """ length weighted average AADT of two merged segments """
+    if aadt_1 is None and aadt_2 is None:
+        return None
+    if (length_1 + length_2) <= 0:
+        return 0
+    return round((((aadt_1 or 0) * length_1) + ((aadt_2 or 0) * length_2)) /
+                 (length_1 + length_2), 1)
+
+def find_merge_groups(segments, graph, condition):
+    """ grow merge groups over the adjacency graph and return the
+        union-find parents along with the merged AADT of each group
+        segments - {oid: (values dictionary, length)} in cursor order
+        a segment only joins one group, once a group has been grown its
+        members are not offered to later seeds """
+    parents = dict((oid, oid) for oid in segments)
+    group_aadt = {}
+    grouped = set()
+    has_aadt = len([tup for tup in condition if tup[0] == USRAP_AVG_AADT]) > 0
+    for seed in segments:
+        if seed in grouped:
+            continue
+        grouped.add(seed)
+        values = dict(segments[seed][0])
+        length = segments[seed][1]
+        members = [seed]
+        merged = True
+        # keep testing the neighbours of the growing segment until no
+        # further segment can be merged
+        while merged:
+            merged = False
+            candidates = sorted(set(oid for member in members
+                                    for oid in graph[member]
+                                    if oid not in grouped))
+            for oid in candidates:
+                if oid in grouped:
+                    continue
+                candidate_values, candidate_length = segments[oid]
+                try:
+                    if not check_merge_condition(condition, values,
+                                                 candidate_values):
+                        continue
+                except (TypeError, ValueError):
+                    continue
+                if has_aadt:
+                    values[USRAP_AVG_AADT] = weighted_aadt(
+                        values[USRAP_AVG_AADT], length,
+                        candidate_values[USRAP_AVG_AADT], candidate_length)
+                length += candidate_length
+                union_roots(parents, seed, oid)
+                grouped.add(oid)
+                members.append(oid)
+                merged = True
+        if len(members) > 1 and has_aadt:
+            group_aadt[seed] = values[USRAP_AVG_AADT]
+    return parents, group_aadt
+
+def apply_scenario(condition, changes):
+    """ merge condition with the tuples of the fields named in changes
+        replaced by the tuples of changes """
+    changes = dict((tup[0], tuple(tup)) for tup in changes)
+    return [changes.get(tup[0], tup) for tup in condition]
+
+def get_merge_scenarios(condition):
+    """ the current condition followed by the what-if scenarios as a list
+        of (name, condition) """
+    return [(CURRENT_SCENARIO, condition)] + [(name, apply_scenario(condition, changes))
+                                              for name, changes in MERGE_SCENARIOS]
+
+def get_classified_miles(feature_class, mile_factor):
+    """ miles of the segments that went through the USRAP classification
+        and of the ones with a valid classification, no missing value and
+        so no USRAP_CLASSIFICATION_ERROR """
+    shape_field = "SHAPE@" if mile_factor is None else "SHAPE@LENGTH"
+    checked = 0.0
+    classified = 0.0
+    with arcpy.da.SearchCursor(feature_class, [USRAP_MISSING, shape_field]) as cursor:
+        for missing, shape in cursor:
+            if missing is None:
+                continue
+            miles = get_miles(shape, mile_factor)
+            checked += miles
+            if missing == 0:
+                classified += miles
+    return checked, classified
+
+def summarize_scenario(segment_miles, parents, fixed_miles, classified_miles):
+    """ segment count, length histogram and mileage of the segments after
+        merging with parents, the USRAP coverage and the mileage of the
+        segments shorter than MIN_SEGMENT_MILES
+        segment_miles - {oid: miles} of the segments that can be merged
+        fixed_miles - miles of the USRAP segments that cannot be merged
+        classified_miles - the miles checked and validly classified by
+        get_classified_miles """
+    oids = list(segment_miles.keys())
+    roots = numpy.array([find_root(parents, oid) for oid in oids])
+    miles = numpy.array([segment_miles[oid] for oid in oids], dtype=float)
+    if len(oids) > 0:
+        _, inverse = numpy.unique(roots, return_inverse=True)
+        miles = numpy.bincount(inverse, weights=miles)
+    miles = numpy.concatenate((miles, numpy.asarray(fixed_miles, dtype=float)))
+    bins = SCENARIO_LENGTH_BINS + [numpy.inf]
+    return {'histogram': numpy.histogram(miles, bins)[0],
+            'binned_miles': numpy.histogram(miles, bins, weights=miles)[0],
+            'miles': float(miles.sum()),
+            'checked_miles': classified_miles[0],
+            'classified_miles': classified_miles[1],
+            'short_miles': float(miles[miles < MIN_SEGMENT_MILES].sum())}
+
+def add_scenario_summaries(totals, summaries):
+    """ add the scenario summaries of a county to the running totals """
+    for name, summary in summaries:
+        if name not in totals:
+            totals[name] = dict((key, 0) for key in summary)
+        for key in summary:
+            totals[name][key] = totals[name][key] + summary[key]
+    return totals
+
+def write_scenario_report(table_path, scenarios, totals):
+    """ report the segments of every scenario and write their length
+        histogram to the scenario table """
+    create_county_records(table_path, SCENARIO_FIELDS)
+    bins = SCENARIO_LENGTH_BINS + [None]
+    with arcpy.da.InsertCursor(table_path, [field[0] for field in SCENARIO_FIELDS]) as cursor:
+        for name, _ in scenarios:
+            if name not in totals:
+                continue
+            total = totals[name]
+            coverage = 100.0 * total['classified_miles'] / total['checked_miles'] \
+                       if total['checked_miles'] > 0 else 0
+            add_message("Scenario {0}: {1} USRAP segments, {2:.1f}% USRAP coverage of {3:.1f} "
+                        "classified miles, {4:.1f} miles in segments shorter than {5} "
+                        "miles".format(name, int(total['histogram'].sum()), coverage,
+                                       total['checked_miles'], total['short_miles'],
+                                       MIN_SEGMENT_MILES))
+            for index in range(len(bins) - 1):
+                cursor.insertRow((name, bins[index], bins[index + 1],
+                                  int(total['histogram'][index]),
+                                  float(total['binned_miles'][index]),
+                                  coverage, total['short_miles']))
+
+def merge_segments(feature_class, condition, scenarios=None):
+    """ merge the adjacent USRAP segments according to condition provided
+        using an end point adjacency graph built once for the feature class,
+        the (name, condition) scenarios are evaluated on the same graph
+        without changing the feature class
+        returns the number of merged segments and the summary of each
+        scenario """
+    scenarios = scenarios or []
+    where = "{0} = 'YES'".format(USRAP_SEGMENT)
+    fields = []
+    for tup in [tup for _, scenario in scenarios for tup in scenario] + list(condition):
+        if tup[0] not in fields:
+            fields.append(tup[0])
+    desc = describe(feature_class)
+    mile_factor = get_mile_factor(desc.spatialReference)
+    segments = {}
+    geometries = {}
+    segment_miles = {}
+    fixed_miles = []
+    with arcpy.da.SearchCursor(feature_class, ['OID@'] + fields + ['SHAPE@'],
+                               where) as cursor:
+        for row in cursor:
+            if '' in row or None in row:
+                if scenarios:
+                    fixed_miles.append(get_miles(row[-1], mile_factor))
+                continue
+            segments[row[0]] = (dict(zip(fields, row[1:-1])), row[-1].getLength())
+            geometries[row[0]] = row[-1]
+            if scenarios:
+                segment_miles[row[0]] = get_miles(row[-1], mile_factor)
+
+    # merging only joins segments with the same attributes, so the USRAP
+    # coverage is the same for every scenario and measured once
+    classified_miles = get_classified_miles(feature_class, mile_factor) if scenarios else None
+
+    tolerance = desc.spatialReference.XYTolerance or 0.001
+    graph = build_endpoint_graph(geometries, tolerance)
+    # every scenario is grouped on the same graph and attribute values, the
+    # groups of the scenario matching condition are the ones written
+    merge_groups = None
+    summaries = []
+    for name, scenario in scenarios:
+        scenario_groups = find_merge_groups(segments, graph, scenario)
+        if list(scenario) == list(condition):
+            merge_groups = scenario_groups
+        summaries.append((name, summarize_scenario(segment_miles, scenario_groups[0],
+                                                   fixed_miles, classified_miles)))
+    if merge_groups is None:
+        merge_groups = find_merge_groups(segments, graph, condition)
+    parents, group_aadt = merge_groups
+
+    groups = {}
+    for oid in segments:
+        groups.setdefault(find_root(parents, oid), []).append(oid)
+
+    merged_count = 0
+    union_count = 0
+    update_fields = ['OID@', 'SHAPE@']
+    if len(group_aadt) > 0:
+        update_fields.append(USRAP_AVG_AADT)
+    with arcpy.da.UpdateCursor(feature_class, update_fields, where) as cursor:
+        for row in cursor:
+            if row[0] not in parents:
+                continue
+            root = find_root(parents, row[0])
+            if len(groups[root]) < 2:
+                continue
+            if root != row[0]:
+                cursor.deleteRow()
+                merged_count += 1
+                continue
+            members = [oid for oid in groups[root] if oid != root]
+            geometry = chain_polylines([geometries[root]] + [geometries[oid] for oid in members],
+                                       tolerance, desc.hasZ, desc.hasM)
+            if geometry is None:
+                # not an end to end chain, fall back to a topological union
+                union_count += 1
+                geometry = geometries[root]
+                for oid in members:
+                    try:
+                        geometry = geometry.union(geometries[oid])
+                    except Exception:
+                        msg = "Merge failed for ObjectId {0} and {1}".format(root, oid)
+                        arcpy.AddWarning(msg)
+            row[1] = geometry
+            if root in group_aadt:
+                row[2] = group_aadt[root]
+            cursor.updateRow(row)
+    if union_count > 0:
+        add_message("   {0} merged segments were not end to end chains and "
+                    "were joined with a union".format(union_count))
+    return merged_count, summaries
+
+def get_mile_factor(spatial_reference):
+    """ miles in one unit of a projected spatial reference, None for a
+        geographic one where lengths are great circle distances between
+        the vertices """
+    if spatial_reference.type != 'Projected':
+        return None
+    return spatial_reference.metersPerUnit / METERS_PER_MILE
+
+def get_miles(value, mile_factor):
+    """ length in miles of a geometry, or of a planar length when the
+        spatial reference is projected, geographic lengths are measured
+        like get_cumulative_miles so they agree with the split points """
+    if not value:
+        return 0.0
+    if mile_factor is None:
+        return sum(float(get_cumulative_miles(numpy.array(
+            [(point.X, point.Y) for point in part if point], dtype=float).reshape(-1, 2),
+            None)[-1]) for part in value)
+    if not isinstance(value, (int, float)):
+        value = value.length
+    return value * mile_factor
+
+def get_coordinates(geometry):
+    """ x, y, z and m of the vertices of a single part polyline as an array,
+        absent z and m values are NaN """
+    return numpy.array([(point.X, point.Y,
+                         numpy.nan if point.Z is None else point.Z,
+                         numpy.nan if point.M is None else point.M)
+                        for point in geometry.getPart(0) if point], dtype=float)
+
+def get_cumulative_miles(coordinates, mile_factor):
+    """ distance in miles from the first vertex to every vertex, great
+        circle distances are used for geographic coordinates """
+    if mile_factor is None:
+        lon = numpy.radians(coordinates[:, 0])
+        lat = numpy.radians(coordinates[:, 1])
+        half_chord = numpy.sin(numpy.diff(lat) / 2) ** 2 + \
+                     numpy.cos(lat[:-1]) * numpy.cos(lat[1:]) * numpy.sin(numpy.diff(lon) / 2) ** 2
+        steps = 2 * EARTH_RADIUS_MILES * numpy.arcsin(numpy.sqrt(numpy.minimum(half_chord, 1)))
+    else:
+        steps = numpy.hypot(numpy.diff(coordinates[:, 0]),
+                            numpy.diff(coordinates[:, 1])) * mile_factor
+    return numpy.concatenate(([0.0], numpy.cumsum(steps)))
+
+def split_coordinates(coordinates, cumulative, pieces):
+    """ cut a vertex array into pieces of equal length, the break points are
+        interpolated between the vertices on either side of them
+        returns a list of vertex arrays """
+    edges = cumulative[-1] * numpy.arange(pieces + 1) / float(pieces)
+    points = numpy.column_stack([numpy.interp(edges, cumulative, coordinates[:, column])
+                                 for column in range(coordinates.shape[1])])
+    points[0] = coordinates[0]
+    points[-1] = coordinates[-1]
+    # the vertices strictly between two break points belong to the piece
+    first = numpy.searchsorted(cumulative, edges[:-1], side='right')
+    last = numpy.searchsorted(cumulative, edges[1:], side='left')
+    return [numpy.vstack((points[index], coordinates[first[index]:last[index]],
+                          points[index + 1])) for index in range(pieces)]
+
+def make_polyline(coordinates, spatial_reference, has_z=False, has_m=False):
+    """ polyline from a vertex array made by get_coordinates """
+    return arcpy.Polyline(arcpy.Array([arcpy.Point(x, y,
+                                                   None if numpy.isnan(z) else z,
+                                                   None if numpy.isnan(m) else m)
+                                       for x, y, z, m in coordinates]),
+                          spatial_reference, has_z, has_m)
+
+def apportion(value, weights):
+    """ share a count between pieces by weight, whole counts are kept whole
+        by giving the remainders to the largest fractions """
+    if value is None:
+        return [None] * len(weights)
+    shares = numpy.asarray(weights, dtype=float) * value
+    if not isinstance(value, int):
+        return [float(share) for share in shares]
+    counts = numpy.floor(shares).astype(int)
+    remainder = value - int(counts.sum())
+    if remainder > 0:
+        counts[numpy.argsort(counts - shares)[:remainder]] += 1
+    return [int(count) for count in counts]
+
+def normalize_segment_lengths(feature_class, max_miles, min_miles):
+    """ split the USRAP segments longer than max_miles into equal pieces and
+        flag the ones shorter than min_miles in USRAP_SHORT_SEGMENT
+        returns the number of segments split, the pieces they were split
+        into and the number of short segments """
+    add_field(feature_class, USRAP_SHORT_SEGMENT, 'TEXT', field_length=3,
+              field_alias=USRAP_SHORT_SEGMENT)
+    desc = describe(feature_class)
+    spatial_reference = desc.spatialReference
+    mile_factor = get_mile_factor(spatial_reference)
+    fields = [field.name for field in list_fields(feature_class)
+              if not field.required and field.type != 'Geometry']
+    short_index = fields.index(USRAP_SHORT_SEGMENT) + 2
+    proportional = [index + 2 for index, field in enumerate(fields)
+                    if field.upper().startswith(tuple(PROPORTIONAL_FIELD_PREFIXES))]
+    where = "{0} = 'YES'".format(USRAP_SEGMENT)
+
+    split_count = 0
+    short_count = 0
+    pieces = []
+    with arcpy.da.UpdateCursor(feature_class, ['OID@', 'SHAPE@'] + fields, where) as cursor:
+        for row in cursor:
+            row = list(row)
+            miles = get_miles(row[1], mile_factor)
+            row[short_index] = 'YES' if min_miles and miles < min_miles else 'NO'
+            short_count += row[short_index] == 'YES'
+            if not max_miles or miles <= max_miles or row[1].isMultipart or \
+                    getattr(row[1], 'hasCurves', False):
+                cursor.updateRow(row)
+                continue
+            coordinates = get_coordinates(row[1])
+            cumulative = get_cumulative_miles(coordinates, mile_factor)
+            count = int(numpy.ceil(cumulative[-1] / max_miles))
+            if len(coordinates) < 2 or count < 2:
+                cursor.updateRow(row)
+                continue
+            weights = [1.0 / count] * count
+            shares = dict((index, apportion(row[index], weights)) for index in proportional)
+            for piece, piece_coordinates in enumerate(split_coordinates(coordinates,
+                                                                        cumulative, count)):
+                new_row = list(row)
+                new_row[1] = make_polyline(piece_coordinates, spatial_reference,
+                                           desc.hasZ, desc.hasM)
+                for index in proportional:
+                    new_row[index] = shares[index][piece]
+                if piece == 0:
+                    cursor.updateRow(new_row)
+                else:
+                    pieces.append(new_row[1:])
+            split_count += 1
+    if len(pieces) > 0:
+        with arcpy.da.InsertCursor(feature_class, ['SHAPE@'] + fields) as cursor:
+            for row in pieces:
+                cursor.insertRow(row)
+    return split_count, split_count + len(pieces), short_count
 
 def check_domain(fc, fc_info, class_message, main_message):
     workspace = get_workspace(fc)
@@ -830,90 +1103,292 @@ def add_formatted_message(msg, fc):
     arcpy.SetProgressorLabel(msg)
     arcpy.AddMessage(msg)
 
-def check_key_fields(key_fields, aadt_layers, aadt_field):
-    #verify that none of the other value layers contain a field with the same name
-    # as another layers key field
-    #if this condition exists it will cause the actual value field to have a new name
-    # when identity is performed and prevent appropriate values from being transferred to
-    # the target class
-    for aadt_layer in aadt_layers:
-        key_fields[aadt_layer] = [aadt_field]
-
-    problem_fields = {}
-    x = 0
-    for kl in list(key_fields.keys()):
-        key_layer_fields = []
-        for key_layer in list(key_fields.keys()):
-            if kl != key_layer:
-                for f in key_fields[key_layer]:
-                    key_layer_fields.append(str(f))
-        fields = [f.name for f in arcpy.ListFields(kl)]
-        for field in key_layer_fields:
-            if fields.count(field) > 0 and key_fields[kl][0] != field:
-                if list(problem_fields.keys()).count(kl) > 0:
-                    if not problem_fields[kl].count(field) > 0:
-                        problem_fields[kl].append(field)
-                else:
-                    problem_fields[kl] = [field]
-    return problem_fields
-
-def combine_values(baseline_selected, value_set, cluster_tolerance, problem_fields, county_geom, full_out_path):
-    add_message("   Combining attributes")
-
-    shape_field_name = arcpy.Describe(baseline_selected).shapeFieldName
-    check_list = [shape_field_name]
-    for values in value_set:
-        if isinstance(baseline_selected, str) or isinstance(baseline_selected, str):
-            sp = baseline_selected
+def get_linear_tolerance(cluster_tolerance, spatial_reference):
+    """ tolerance, in the units of the spatial reference, used to snap break
+        points and match attribute features to the routes """
+    try:
+        tolerance = float(str(cluster_tolerance).split()[0])
+    except (IndexError, ValueError):
+        tolerance = 0
+    return max(tolerance, spatial_reference.XYTolerance or 0)
+
+def get_extent(geometry):
+    """ extent of a geometry as a tuple """
+    extent = geometry.extent
+    return (extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+
+def build_extent_grid(extents, cells=64):
+    """ bucket extents into a uniform grid so candidate features can be
+        found without testing every feature
+        returns the grid dictionary and the cell size """
+    if len(extents) == 0:
+        return {}, 1
+    width = max(e[2] for e in extents) - min(e[0] for e in extents)
+    height = max(e[3] for e in extents) - min(e[1] for e in extents)
+    cell_size = max(width, height) / float(cells) or 1
+    grid = {}
+    for index, extent in enumerate(extents):
+        for cell in get_extent_cells(extent, cell_size):
+            grid.setdefault(cell, []).append(index)
+    return grid, cell_size
+
+def get_extent_cells(extent, cell_size):
+    """ grid cells covered by an extent """
+    return [(x, y) for x in range(int(extent[0] // cell_size), int(extent[2] // cell_size) + 1)
+            for y in range(int(extent[1] // cell_size), int(extent[3] // cell_size) + 1)]
+
+def query_extent_grid(grid, cell_size, extent):
+    """ indexes of the extents sharing a grid cell with extent """
+    found = set()
+    for cell in get_extent_cells(extent, cell_size):
+        found.update(grid.get(cell, []))
+    return sorted(found)
+
+def get_overlay_field_type(feature_class, field_name):
+    """ field type the value of field_name is stored as on the routes,
+        coded values are stored as their description """
+    field = get_field_object(feature_class, field_name)
+    if field.domain:
+        return 'TEXT', get_domain_values(get_workspace(feature_class), field.domain)
+    return field.type, None
+
+def read_counties(ftrclass_county, field_county_name, spatial_reference):
+    """ read the county polygons in the spatial reference of the routes
+        returns a list of (object id, county name, geometry) """
+    counties = []
+    with arcpy.da.SearchCursor(ftrclass_county, ["OID@", field_county_name, "SHAPE@"],
+                               spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            counties.append((row[0], str(row[1]), row[2]))
+    return counties
+
+def partition_layer(feature_class, field_name, domain, counties, county_grid,
+                    spatial_reference):
+    """ read an attribute layer once, check its geometries and assign its
+        features to the counties they fall in, features crossing a county
+        line are split
+        returns {county object id: [(value, geometry)]} """
+    grid, cell_size = county_grid
+    buckets = dict((county[0], []) for county in counties)
+    with arcpy.da.SearchCursor(feature_class, [field_name, "SHAPE@"],
+                               spatial_reference=spatial_reference) as cursor:
+        features = [(value, geometry) for value, geometry in cursor]
+    # the geometries are checked once here rather than in every county
+    features = check_features(features, spatial_reference,
+                              os.path.basename(str(feature_class)))
+    for value, geometry in features:
+        if domain:
+            try:
+                value = str(domain[value])
+            except KeyError:
+                value = None
+        dimension = 4 if geometry.type == 'polygon' else 2
+        for index in query_extent_grid(grid, cell_size, get_extent(geometry)):
+            county_oid, county_name, county_geom = counties[index]
+            if county_geom.disjoint(geometry):
+                continue
+            if geometry.within(county_geom):
+                buckets[county_oid].append((value, geometry))
+                continue
+            part = county_geom.intersect(geometry, dimension)
+            if part is None:
+                continue
+            size = part.area if dimension == 4 else part.length
+            if size > 0:
+                buckets[county_oid].append((value, part))
+    return buckets
+
+def partition_layers(layers, counties, spatial_reference):
+    """ partition every attribute layer by county before the county loop
+        layers - list of (feature class, value field, new field name)
+        returns the (new field name, field type) of each layer and
+        {county object id: [features of each layer]} """
+    add_message("Partitioning attribute layers by county")
+    county_grid = build_extent_grid([get_extent(county[2]) for county in counties])
+    overlay_fields = []
+    partitions = dict((county[0], []) for county in counties)
+    for feature_class, field_name, new_field in layers:
+        field_type, domain = get_overlay_field_type(feature_class, field_name)
+        overlay_fields.append((new_field, field_type))
+        buckets = partition_layer(feature_class, field_name, domain, counties,
+                                  county_grid, spatial_reference)
+        for county_oid in partitions:
+            partitions[county_oid].append(buckets[county_oid])
+        arcpy.SetProgressorPosition()
+    return overlay_fields, partitions
+
+def pack_features(features):
+    """ convert the county features to well known binary so they can be
+        handed to a worker process """
+    return [[(value, bytes(geometry.WKB)) for value, geometry in layer]
+            for layer in features]
+
+def unpack_features(packed, spatial_reference):
+    """ rebuild the county features packed by pack_features """
+    return [[(value, arcpy.FromWKB(bytearray(wkb), spatial_reference)) for value, wkb in layer]
+            for layer in packed]
+
+def prepare_overlay_features(features, spatial_reference, tolerance):
+    """ project the (value, geometry) features to the routes and index them
+        lines are buffered by the tolerance so features that are not exactly
+        coincident with the routes are still matched """
+    prepared = []
+    for value, geometry in features:
+        if geometry.spatialReference and spatial_reference and \
+                geometry.spatialReference.name != spatial_reference.name:
+            geometry = geometry.projectAs(spatial_reference)
+        if geometry.type == 'polyline' and tolerance > spatial_reference.XYTolerance:
+            geometry = geometry.buffer(tolerance)
+        prepared.append((value, geometry))
+    grid, cell_size = build_extent_grid([get_extent(g) for v, g in prepared])
+    return prepared, grid, cell_size
+
+def get_route_intervals(route, features, tolerance):
+    """ measure intervals along the route covered by each feature
+        returns a list of (from measure, to measure, value) """
+    prepared, grid, cell_size = features
+    intervals = []
+    for index in query_extent_grid(grid, cell_size, get_extent(route)):
+        value, geometry = prepared[index]
+        if route.disjoint(geometry):
+            continue
+        overlap = route.intersect(geometry, 2)
+        if overlap is None or overlap.length <= tolerance:
+            continue
+        for part in overlap:
+            points = [point for point in part if point]
+            if len(points) < 2:
+                continue
+            measures = sorted([route.measureOnLine(arcpy.PointGeometry(points[0], route.spatialReference)),
+                               route.measureOnLine(arcpy.PointGeometry(points[-1], route.spatialReference))])
+            if measures[1] - measures[0] > tolerance:
+                intervals.append((measures[0], measures[1], value))
+    return intervals
+
+def get_route_pieces(length, layer_intervals, tolerance):
+    """ cut a route once at the union of the break points of every layer
+        and attach the value of every layer to each piece, adjacent pieces
+        with the same values are combined
+        returns a list of (from measure, to measure, values) """
+    breaks = [0.0, length]
+    for intervals in layer_intervals:
+        for from_measure, to_measure, value in intervals:
+            breaks += [from_measure, to_measure]
+    breaks = sorted(breaks)
+    snapped = [breaks[0]]
+    for measure in breaks[1:]:
+        if measure - snapped[-1] > tolerance:
+            snapped.append(measure)
+    snapped[-1] = length
+
+    pieces = []
+    for from_measure, to_measure in zip(snapped[:-1], snapped[1:]):
+        middle = (from_measure + to_measure) / 2.0
+        values = []
+        for intervals in layer_intervals:
+            value = None
+            for interval in intervals:
+                if interval[0] <= middle <= interval[1]:
+                    value = interval[2]
+                    break
+            values.append(value)
+        if len(pieces) > 0 and pieces[-1][2] == values:
+            pieces[-1] = (pieces[-1][0], to_measure, values)
         else:
-            sp = baseline_selected[0]
-
-        if VERSION_USED != "10.2":
-            arcpy.RepairGeometry_management(sp)
-
-        clipped = IN_MEMORY + os.sep + os.path.basename(values[0]) + "Clip"
-        arcpy.Clip_analysis(values[0], county_geom, clipped)
-
-        clipped_sp = clipped + "sp"
-        arcpy.Dissolve_management(clipped, clipped_sp, values[1], multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-        arcpy.Delete_management(clipped)
-        del clipped
-
-        if VERSION_USED != "10.2":
-            arcpy.RepairGeometry_management(clipped_sp)
-
-        baseline_selected = combine_attributes(sp,
-                                    clipped_sp,
-                                    values[1],
-                                    values[2],
-                                    None,
-                                    None,
-                                    cluster_tolerance,
-                                    problem_fields, full_out_path, values[0])
-
-        
-        if baseline_selected != sp:
-            arcpy.Delete_management(sp)
-
-        arcpy.Delete_management(clipped_sp)
-        del clipped_sp
-        check_list.append(values[2])
-
-        if arcpy.Exists(baseline_selected):
-            arcpy.DeleteIdentical_management(baseline_selected, check_list)
-
-    return baseline_selected
+            pieces.append((from_measure, to_measure, values))
+    return pieces
+
+def stack_aadt_intervals(route, aadt_features, tolerance):
+    """ stack the AADT years covering a route into one interval table
+        returns a list of (from measure, to measure, AADT of every year) """
+    year_intervals = [get_route_intervals(route, features, tolerance)
+                      for features in aadt_features]
+    return [(from_measure, to_measure, tuple(values))
+            for from_measure, to_measure, values in get_route_pieces(route.length,
+                                                                     year_intervals,
+                                                                     tolerance)
+            if any(value is not None for value in values)]
+
+def overlay_attributes(routes, new_fields, county_features, county_name,
+                       cluster_tolerance, route_fields, aadt_count=0):
+    """ attach the attributes of every layer to the routes in a single pass
+        new_fields - list of (new field name, field type) of each layer
+        county_features - list of the (value, geometry) features of each
+        layer that fall in the county
+        aadt_count - number of AADT year layers at the end of new_fields,
+        they are stacked into one interval table per route and their
+        average is written to USRAP_AVG_AADT
+        returns a new feature class with one feature per route piece """
+    add_message("   Combining attributes")
+    desc = describe(routes)
+    spatial_reference = desc.spatialReference
+    tolerance = get_linear_tolerance(cluster_tolerance, spatial_reference)
+    route_field_types = dict((field.name, field.type) for field in desc.fields)
+    layer_features = [prepare_overlay_features(features, spatial_reference, tolerance)
+                      for features in county_features]
+
+    out_routes = scratch_path("overlay" + county_name)
+    arcpy.CreateFeatureclass_management(os.path.dirname(out_routes), os.path.basename(out_routes),
+                                        "POLYLINE", spatial_reference=spatial_reference)
+    for field_name in route_fields:
+        add_field(out_routes, field_name, route_field_types[field_name],
+                                  field_alias=field_name)
+    for field_name, field_type in new_fields:
+        add_field(out_routes, field_name, field_type,
+                                  field_alias=field_name)
+    insert_fields = route_fields + [field[0] for field in new_fields]
+    if aadt_count > 0:
+        add_field(out_routes, USRAP_AVG_AADT, 'DOUBLE', field_alias=USRAP_AVG_AADT)
+        insert_fields.append(USRAP_AVG_AADT)
+    insert_fields.append("SHAPE@")
+
+    attribute_count = len(layer_features) - aadt_count
+    rows = []
+    with arcpy.da.SearchCursor(routes, route_fields + ["SHAPE@"]) as route_cursor:
+        for row in route_cursor:
+            route = row[-1]
+            if route is None or route.length <= 0:
+                continue
+            layer_intervals = [get_route_intervals(route, features, tolerance)
+                               for features in layer_features[:attribute_count]]
+            if aadt_count > 0:
+                layer_intervals.append(stack_aadt_intervals(route, layer_features[attribute_count:],
+                                                            tolerance))
+            for from_measure, to_measure, values in get_route_pieces(route.length,
+                                                                     layer_intervals,
+                                                                     tolerance):
+                if from_measure <= 0 and to_measure >= route.length:
+                    piece = route
+                else:
+                    piece = route.segmentAlongLine(from_measure, to_measure)
+                if aadt_count > 0:
+                    values = values[:-1] + list(values[-1] or [None] * aadt_count)
+                rows.append(list(row[:-1]) + values + [piece])
+
+    if aadt_count > 0:
+        # the AADT columns of every piece are averaged at once
+        add_message("   Calculating average AADT for each segment")
+        aadt_fields = [field[0] for field in new_fields[attribute_count:]]
+        averages = get_average_aadt([row[-1 - aadt_count:-1] for row in rows], aadt_fields)
+        for row, average in zip(rows, averages):
+            row.insert(-1, average)
+
+    with arcpy.da.InsertCursor(out_routes, insert_fields) as insert_cursor:
+        for row in rows:
+            insert_cursor.insertRow(row)
+    return out_routes
 
 def repair_temp_data(out_temp_gdb, in_data, field):
     """ This function works around 2 issues at 10.2...not necessary at later releases """
     """ 1) RepairGeometry fails on datasets in in_memory workspaces """
+    """ the geometry check only sends the features that need it to RepairGeometry """
     """ 2) Clip fails on z enabled line features when none of the line features intersect the clip geometry """ 
     out_temp_fc = os.path.join(out_temp_gdb, "temp_" + os.path.basename(in_data))
     arcpy.env.outputMFlag = 'Disabled'
     arcpy.env.outputZFlag = 'Disabled'
     try:
         arcpy.Dissolve_management(in_data, out_temp_fc, field, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-        arcpy.RepairGeometry_management(out_temp_fc)
+        check_geometry(out_temp_fc, os.path.basename(str(in_data)))
         arcpy.AddSpatialIndex_management(out_temp_fc)
     except:
         arcpy.AddWarning("Repair Geometry failed on " + str(out_temp_fc))
@@ -927,8 +1402,434 @@ def check_path(fc):
     del desc
     return fc
 
+def get_aadt_field_name(aadt_layer):
+    """ name of the USRAP AADT field for the year of an AADT layer """
+    return USRAP_AADT_YYYY + '_' + os.path.basename(aadt_layer)[-4:]
+
+def process_county(county_name, county_geom, county_features, settings,
+                   workspace=IN_MEMORY):
+    """ clip, combine, classify and merge the routes of a single county
+        county_features - the partitioned attribute features of the county
+        returns the feature class holding the county segments, which is
+        copied to workspace when it is not the in_memory workspace, the
+        attribute coverage of the county and the summary of every merge
+        scenario """
+    add_message("Processing " + county_name + " County")
+    county_name = str(arcpy.ValidateTableName(county_name, IN_MEMORY))
+    field_route_name = settings['field_route_name']
+    field_route_type = settings['field_route_type']
+    cluster_tolerance = settings['cluster_tolerance']
+    condition = settings['condition']
+    SCRATCH['folder'] = settings['scratch_folder']
+    SCRATCH['budget_mb'] = settings['scratch_budget_mb']
+
+    baseline_selected = settings['routes']
+    if settings['route_where']:
+        baseline_selected = arcpy.MakeFeatureLayer_management(
+            baseline_selected, 'baseline' + county_name, settings['route_where'])[0]
+
+    clipped_routes = scratch_path("clip" + county_name + "routes")
+    arcpy.Clip_analysis(baseline_selected, county_geom, clipped_routes)
+    clipped_routes = track_scratch(clipped_routes)
+    routes = scratch_path("clip" + county_name + "routesD")
+    arcpy.Dissolve_management(clipped_routes, routes, field_route_name + ";" + field_route_type, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
+    release_scratch(clipped_routes)
+    routes = track_scratch(routes)
+    # the routes are checked once before the overlay, only the features the
+    # check flags go through Repair Geometry
+    check_geometry(routes, "   Routes in " + county_name)
+    c = arcpy.GetCount_management(routes)
+    add_message("   " + str(c[0]) + " routes in: " + county_name)
+    coverage = {}
+    summaries = []
+
+    if int(c[0]) > 0:
+        # every attribute and the stacked AADT years are attached in one
+        # overlay, which also calculates the average AADT
+        overlay = overlay_attributes(routes, settings['overlay_fields'], county_features,
+                                     county_name, cluster_tolerance,
+                                     [field_route_name, field_route_type],
+                                     len(settings['aadt_layers']))
+        release_scratch(routes)
+        routes = track_scratch(overlay)
+
+        # baseline segment will be identified as usrap segment
+        coverage = identify_usrap_segment(routes, roadway_type, field_route_name,
+                                          field_route_type)
+
+        arcpy.ResetProgressor()
+
+        max_val = int(arcpy.GetCount_management(routes)[0])
+        add_message('   {0} segments present after combining attributes'.format(max_val))
+        msg = "   Merging features..."
+        add_message(msg)
+        arcpy.SetProgressor('step', msg, 0, max_val, 1)
+        diff, summaries = merge_segments(routes, condition, settings['scenarios'])
+        arcpy.SetProgressorPosition(max_val)
+        arcpy.AddMessage('   {0} merged out of {1} segments'.format(diff,
+                                                                     max_val))
+        arcpy.ResetProgressor()
+
+        split_count, piece_count, short_count = normalize_segment_lengths(
+            routes, settings['max_segment_miles'], settings['min_segment_miles'])
+        if split_count > 0:
+            add_message("   {0} segments longer than {1} miles split into {2}".format(
+                split_count, settings['max_segment_miles'], piece_count))
+        if short_count > 0:
+            add_message("   {0} segments shorter than {1} miles flagged in {2}".format(
+                short_count, settings['min_segment_miles'], USRAP_SHORT_SEGMENT))
+
+    add_message("   Scratch data: peak {0:.1f} MB in memory, {1} datasets written to disk".format(
+        SCRATCH['peak'] / 1048576.0, SCRATCH['spilled']))
+    if workspace != IN_MEMORY:
+        out_routes = os.path.join(workspace, "Segments_" + county_name)
+        arcpy.CopyFeatures_management(routes, out_routes)
+        routes = out_routes
+    return routes, coverage, summaries
+
+def process_county_worker(job):
+    """ process a single county in a worker process, the county is
+        segmented into a scratch geodatabase of its own """
+    index, county_name, county_wkb, packed_features, settings = job
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(settings['spatial_reference'])
+    county_geom = arcpy.FromWKB(bytearray(county_wkb), spatial_reference)
+    county_features = unpack_features(packed_features, spatial_reference)
+    workspace = str(arcpy.CreateFileGDB_management(settings['scratch_folder'],
+                                                   "county_{0}.gdb".format(index))[0])
+    try:
+        return (county_name,) + process_county(county_name, county_geom, county_features,
+                                               settings, workspace)
+    finally:
+        clear_scratch()
+        arcpy.Delete_management(IN_MEMORY)
+        invalidate_metadata(IN_MEMORY)
+
+def set_worker_executable():
+    """ inside ArcGIS Pro sys.executable is the application itself, worker
+        processes need to be started with the python interpreter, either
+        WORKER_PYTHON or the first interpreter found in the environment,
+        sys.executable is kept when none is found """
+    if WORKER_PYTHON:
+        multiprocessing.set_executable(WORKER_PYTHON)
+        return
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return
+    for folder in (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin')):
+        for name in ('pythonw.exe', 'python.exe', 'python'):
+            executable = os.path.join(folder, name)
+            if os.path.isfile(executable):
+                multiprocessing.set_executable(executable)
+                return
+    arcpy.AddWarning("No python interpreter found in {0}, set WORKER_PYTHON to start "
+                     "the worker processes with".format(sys.exec_prefix))
+
+def segment_counties(settings, counties, partitions, workers=1):
+    """ segment every county and yield (county object id, county name,
+        segments, coverage, scenario summaries) in county cursor order,
+        counties are fanned out to worker processes when workers is more
+        than 1 """
+    if workers <= 1:
+        try:
+            for county_oid, county_name, county_geom in counties:
+                yield (county_oid, county_name) + process_county(
+                    county_name, county_geom, partitions.pop(county_oid), settings)
+        finally:
+            clear_scratch()
+            shutil.rmtree(settings['scratch_folder'], ignore_errors=True)
+        return
+    if len(counties) == 0:
+        return
+    if not os.path.exists(settings['scratch_folder']):
+        os.makedirs(settings['scratch_folder'])
+
+    def jobs():
+        """ pack the county jobs as the pool asks for them """
+        for index, (county_oid, county_name, county_geom) in enumerate(counties):
+            yield (index, county_name, bytes(county_geom.WKB),
+                   pack_features(partitions.pop(county_oid)), settings)
+
+    add_message("Processing {0} counties with {1} workers".format(len(counties), workers))
+    set_worker_executable()
+    pool = multiprocessing.Pool(min(workers, len(counties)))
+    try:
+        # imap returns the results in job order so the output is appended
+        # in the same order as a sequential run
+        results = pool.imap(process_county_worker, jobs())
+        for (county_oid, county_name, county_geom), result in zip(counties, results):
+            add_message("Appending " + county_name + " County")
+            yield (county_oid,) + result
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(settings['scratch_folder'], ignore_errors=True)
+
+def release_county(routes):
+    """ free the intermediate data of a county once it has been appended """
+    workspace = os.path.dirname(str(routes))
+    clear_scratch()
+    if workspace.lower().endswith('.gdb'):
+        if arcpy.Exists(workspace):
+            arcpy.Delete_management(workspace)
+        invalidate_metadata(workspace)
+    else:
+        arcpy.Delete_management(IN_MEMORY)
+        invalidate_metadata(IN_MEMORY)
+
+def get_schema_key(dataset):
+    """ name, type and length of the editable fields of a dataset """
+    return tuple((field.name.upper(), field.type, field.length)
+                 for field in list_fields(dataset) if not field.required)
+
+def get_projection_plan(source, target):
+    """ maps the fields of source onto the fields of target once per pair
+        of schemas, returns the cursor fields of both sides and the
+        position and width of every text value that must be shortened """
+    key = (get_schema_key(source), get_schema_key(target))
+    if key in METADATA_CACHE['projections']:
+        METADATA_STATS['hits'] += 1
+        return METADATA_CACHE['projections'][key]
+    METADATA_STATS['misses'] += 1
+    target_fields = dict((field.name.upper(), field) for field in list_fields(target)
+                         if not field.required)
+    source_fields = []
+    insert_fields = []
+    truncate = []
+    for field in list_fields(source):
+        if field.required or field.name.upper() not in target_fields:
+            continue
+        target_field = target_fields[field.name.upper()]
+        if target_field.type == 'String' and target_field.length < field.length:
+            truncate.append((len(source_fields), target_field.length))
+        source_fields.append(field.name)
+        insert_fields.append(target_field.name)
+    source_fields.append("SHAPE@")
+    insert_fields.append("SHAPE@")
+    plan = (source_fields, insert_fields, truncate)
+    METADATA_CACHE['projections'][key] = plan
+    return plan
+
+def get_segid_block(county_oid):
+    """ first and last SEGID reserved for the USRAP segments of a county """
+    first_id = USRAP_SEGID_START_FROM + (county_oid - 1) * SEGID_COUNTY_BLOCK
+    if first_id + SEGID_COUNTY_BLOCK - 1 > 2147483647:
+        raise ValueError("County object id {0} is too large to reserve a block of "
+                         "{1} for its USRAP_SEGID values".format(county_oid, SEGID_COUNTY_BLOCK))
+    return first_id, first_id + SEGID_COUNTY_BLOCK - 1
+
+def project_rows(source, target, segid_block=None):
+    """ insert every row of source into target through the projection plan,
+        the USRAP segments are numbered from the first SEGID of segid_block
+        as they are inserted
+        returns the first and last object id inserted or None """
+    source_fields, insert_fields, truncate = get_projection_plan(source, target)
+    numbered = segid_block is not None and USRAP_SEGMENT in source_fields
+    if numbered:
+        segment_index = source_fields.index(USRAP_SEGMENT)
+        insert_fields = insert_fields[:-1] + [USRAP_SEGID] + insert_fields[-1:]
+        segment_id, last_id = segid_block
+    oids = []
+    with arcpy.da.SearchCursor(source, source_fields) as ser_cur:
+        with arcpy.da.InsertCursor(target, insert_fields) as in_cur:
+            while True:
+                rows = list(itertools.islice(ser_cur, PROJECT_BATCH_ROWS))
+                if len(rows) == 0:
+                    break
+                if truncate or numbered:
+                    # the batch is transformed column by column and zipped
+                    # back into rows instead of copying every row
+                    columns = [list(column) for column in zip(*rows)]
+                    for index, length in truncate:
+                        columns[index] = [value[:length] if value is not None else None
+                                          for value in columns[index]]
+                    if numbered:
+                        usrap = [value == 'YES' for value in columns[segment_index]]
+                        if segment_id + sum(usrap) - 1 > last_id:
+                            raise ValueError("More than {0} USRAP segments in a county, "
+                                             "increase SEGID_COUNTY_BLOCK".format(
+                                                 SEGID_COUNTY_BLOCK))
+                        segids = []
+                        for is_usrap in usrap:
+                            segids.append(segment_id if is_usrap else None)
+                            segment_id += is_usrap
+                        columns.insert(-1, segids)
+                    rows = zip(*columns)
+                oids.extend([in_cur.insertRow(row) for row in rows])
+    if len(oids) == 0:
+        return None
+    return min(oids), max(oids)
+
+def append_segments(routes, full_out_path, county_oid, county_name, fingerprint, parameters):
+    """ append the segments of a county to the final output, numbering the
+        USRAP segments in the SEGID block of the county, and record the
+        county in the manifest and the checkpoint, this is done in a single
+        edit session so an interrupted append leaves nothing behind
+        returns the object id range of the appended rows or None """
+    if not arcpy.Exists(full_out_path):
+        n_d = describe(routes)
+        arcpy.CreateFeatureclass_management(os.path.dirname(full_out_path),
+                                            os.path.basename(full_out_path),
+                                            n_d.shapeType,
+                                            routes,
+                                            spatial_reference=n_d.spatialReference)
+        invalidate_metadata(full_out_path)
+    existing_fields = [field.name.upper() for field in list_fields(full_out_path)]
+    new_fields = [field for field in list_fields(routes) if field.name.upper() not in existing_fields and not field.required]
+
+    for field in new_fields:
+        add_field(full_out_path, field.name, field.type)
+    if USRAP_SEGID.upper() not in existing_fields:
+        add_field(full_out_path, USRAP_SEGID, 'LONG', field_alias=USRAP_SEGID)
+
+    # Append_management only writes the first character of text values
+    # under Python 3, so the rows are copied with cursors instead. The
+    # cursor fields are matched once per schema rather than once per row.
+    workspace = os.path.dirname(full_out_path)
+    with arcpy.da.Editor(workspace):
+        oid_range = project_rows(routes, full_out_path, get_segid_block(county_oid))
+        write_county_record(os.path.join(workspace, MANIFEST_TABLE_NAME), MANIFEST_FIELDS,
+                            county_name, fingerprint, oid_range)
+        write_county_record(os.path.join(workspace, CHECKPOINT_TABLE_NAME), CHECKPOINT_FIELDS,
+                            county_name, parameters, oid_range)
+    return oid_range
+
+def get_parameter_hash(settings):
+    """ hash of the tool parameters that change the segments of every county """
+    keys = ['routes', 'route_where', 'field_route_name', 'field_route_type',
+            'overlay_fields', 'spatial_reference', 'aadt_layers',
+            'cluster_tolerance', 'condition', 'max_segment_miles', 'min_segment_miles']
+    return hashlib.sha1(repr([settings[key] for key in keys]).encode('utf-8')).hexdigest()
+
+def fingerprint_counties(settings, counties, partitions):
+    """ content hash of the input slice of every county, made of the tool
+        parameters, the county boundary, the routes touching the county and
+        the partitioned attribute features
+        returns {county name: fingerprint} """
+    add_message("Fingerprinting county inputs")
+    spatial_reference = arcpy.SpatialReference()
+    spatial_reference.loadFromString(settings['spatial_reference'])
+    parameters = get_parameter_hash(settings).encode('utf-8')
+    hashes = []
+    for county_oid, county_name, county_geom in counties:
+        hasher = hashlib.sha1(parameters)
+        hasher.update(bytes(county_geom.WKB))
+        hashes.append(hasher)
+
+    grid, cell_size = build_extent_grid([get_extent(county[2]) for county in counties])
+    fields = [settings['field_route_name'], settings['field_route_type'], "SHAPE@"]
+    with arcpy.da.SearchCursor(settings['routes'], fields, settings['route_where'],
+                               spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            if row[-1] is None:
+                continue
+            for index in query_extent_grid(grid, cell_size, get_extent(row[-1])):
+                if not counties[index][2].disjoint(row[-1]):
+                    hashes[index].update(repr(row[:-1]).encode('utf-8'))
+                    hashes[index].update(bytes(row[-1].WKB))
+
+    fingerprints = {}
+    for hasher, (county_oid, county_name, county_geom) in zip(hashes, counties):
+        for layer in partitions[county_oid]:
+            hasher.update(b'|')
+            for value, geometry in layer:
+                hasher.update(repr(value).encode('utf-8'))
+                hasher.update(bytes(geometry.WKB))
+        fingerprints[county_name] = hasher.hexdigest()
+    return fingerprints
+
+def read_county_records(table_path, fields):
+    """ rows of a manifest or checkpoint table written by earlier runs
+        returns {county name: (hash, first object id, last object id)} """
+    records = {}
+    if not arcpy.Exists(table_path):
+        return records
+    with arcpy.da.SearchCursor(table_path, [field[0] for field in fields]) as cursor:
+        for row in cursor:
+            records[row[0]] = row[1:]
+    return records
+
+def create_county_records(table_path, fields):
+    """ create an empty manifest, checkpoint or coverage table, an existing
+        table is emptied """
+    if arcpy.Exists(table_path):
+        arcpy.DeleteRows_management(table_path)
+        return
+    arcpy.CreateTable_management(os.path.dirname(table_path),
+                                 os.path.basename(table_path))
+    invalidate_metadata(table_path)
+    for field_name, field_type, field_length in fields:
+        add_field(table_path, field_name, field_type, field_length=field_length)
+
+def delete_county_record(table_path, county_name):
+    """ remove the rows of a county from a manifest, checkpoint or coverage
+        table """
+    where = "{0} = '{1}'".format(RECORD_COUNTY, county_name.replace("'", "''"))
+    with arcpy.da.UpdateCursor(table_path, [RECORD_COUNTY], where) as cursor:
+        for row in cursor:
+            cursor.deleteRow()
+
+def write_county_record(table_path, fields, county_name, hash_value, oid_range):
+    """ record the hash and Segments object id range of a county """
+    delete_county_record(table_path, county_name)
+    first_oid, last_oid = oid_range if oid_range else (None, None)
+    with arcpy.da.InsertCursor(table_path, [field[0] for field in fields]) as cursor:
+        cursor.insertRow((county_name, hash_value, first_oid, last_oid))
+
+def write_coverage(table_path, county_name, coverage):
+    """ replace the coverage rows of a county with the miles found by
+        summarize_coverage, COVERAGE is the percent of the miles that have
+        a value """
+    delete_county_record(table_path, county_name)
+    with arcpy.da.InsertCursor(table_path, [field[0] for field in COVERAGE_FIELDS]) as cursor:
+        for (route_type, check_name), (total, missing) in sorted(coverage.items()):
+            percent = 100.0 * (total - missing) / total if total > 0 else None
+            cursor.insertRow((county_name, route_type, check_name, total, missing, percent))
+
+def delete_segment_rows(full_out_path, first_oid, last_oid):
+    """ delete the rows a county appended to Segments """
+    if first_oid is None or not arcpy.Exists(full_out_path):
+        return
+    oid_field = describe(full_out_path).oidFieldName
+    where = "{0} >= {1} AND {0} <= {2}".format(oid_field, first_oid, last_oid)
+    with arcpy.da.UpdateCursor(full_out_path, ['OID@'], where) as cursor:
+        for row in cursor:
+            cursor.deleteRow()
+
+def truncate_segments(full_out_path):
+    """ delete every row of the final output """
+    if arcpy.Exists(full_out_path):
+        del_lyr = "DELETE_LAYER"
+        arcpy.MakeFeatureLayer_management(full_out_path, del_lyr, "1=1")
+        arcpy.DeleteFeatures_management(del_lyr)
+        arcpy.Delete_management(del_lyr)
+        invalidate_metadata(full_out_path)
+
+def select_changed_counties(counties, partitions, fingerprints, manifest,
+                            manifest_path, coverage_path, full_out_path):
+    """ drop the counties whose fingerprint matches the manifest and delete
+        the rows of the counties that changed or no longer exist
+        returns the counties that need to be segmented again """
+    changed = []
+    for county in counties:
+        county_name = county[1]
+        if county_name in manifest:
+            if manifest[county_name][0] == fingerprints[county_name]:
+                partitions.pop(county[0])
+                continue
+            delete_segment_rows(full_out_path, *manifest[county_name][1:])
+        changed.append(county)
+    names = set(county[1] for county in counties)
+    for county_name in manifest:
+        if county_name not in names:
+            delete_segment_rows(full_out_path, *manifest[county_name][1:])
+            delete_county_record(manifest_path, county_name)
+            delete_county_record(coverage_path, county_name)
+    add_message("{0} of {1} counties changed since the last run".format(len(changed),
+                                                                       len(counties)))
+    return changed
+
 def main():
-    """ main function """
+    """ main function, reads the tool parameters and runs the segmentation """
     #Basic segmentation tool's inputs (arranged in accending order)
     ftrclass_route = arcpy.GetParameterAsText(0)
     field_route_name = arcpy.GetParameterAsText(1)
@@ -951,6 +1852,32 @@ def main():
     output_folder = arcpy.GetParameterAsText(18)
     cluster_tolerance = arcpy.GetParameterAsText(19)
 
+    full_out_path = execute(ftrclass_route, field_route_name, field_route_type,
+                            value_route_type, ftrclass_county, field_county_name,
+                            ftrclass_access_control, field_access_control_info,
+                            ftrclass_median, field_median_info,
+                            ftrclass_travel_lanes, field_travel_lanes_info,
+                            ftrclass_area_type, field_area_type_info,
+                            ftrclass_speed_limit, field_speed_limit_info,
+                            ftrclass_aadt_multi_layers, field_aadt_multi_layers_value,
+                            output_folder, cluster_tolerance)
+    if full_out_path:
+        arcpy.SetParameterAsText(20, full_out_path)
+
+def execute(ftrclass_route, field_route_name, field_route_type, value_route_type,
+            ftrclass_county, field_county_name, ftrclass_access_control,
+            field_access_control_info, ftrclass_median, field_median_info,
+            ftrclass_travel_lanes, field_travel_lanes_info, ftrclass_area_type,
+            field_area_type_info, ftrclass_speed_limit, field_speed_limit_info,
+            ftrclass_aadt_multi_layers, field_aadt_multi_layers_value,
+            output_folder, cluster_tolerance):
+    """ segment the routes with the tool parameters given as values, every
+        run starts with an empty metadata cache so several runs can be made
+        in one process
+        returns the path of the output segments or None when it failed """
+    output_segments = None
+    clear_metadata_cache()
+
     #If they pass in FeatureLayers...get the feature class path
     ftrclass_route = check_path(ftrclass_route)
     ftrclass_county = check_path(ftrclass_county)
@@ -994,22 +1921,6 @@ def main():
         del t
 
     full_out_path = output_folder + os.sep + OUTPUT_GDB_NAME + os.sep + OUTPUT_SEGMENT_NAME
-    if arcpy.Exists(full_out_path):
-        del_lyr = "DELETE_LAYER"
-        arcpy.MakeFeatureLayer_management(full_out_path, del_lyr, "1=1")
-        arcpy.DeleteFeatures_management(del_lyr)
-        arcpy.Delete_management(del_lyr)
-        #del del_lyr
-
-    key_fields = {ftrclass_route : [field_route_name, field_route_type],
-                  ftrclass_county : [field_county_name],
-                  ftrclass_access_control : [field_access_control_info],
-                  ftrclass_median : [field_median_info],
-                  ftrclass_travel_lanes : [field_travel_lanes_info],
-                  ftrclass_area_type : [field_area_type_info],
-                  ftrclass_speed_limit : [field_speed_limit_info]}
-
-    problem_fields = check_key_fields(key_fields, ftrclass_aadt_multi_layers, field_aadt_multi_layers_value)
 
     main_message = "Domain to denote Access Controls must contain {0} coded values"
     class_message = {
@@ -1054,11 +1965,13 @@ def main():
                     (USRAP_SPEED_LIMIT,
                     LESS_THAN_EQUAL_TO_OR_MORE_THAN_EQUAL_TO, 50, 55),
                     (USRAP_AVG_AADT, LESS_THAN_EQUAL_TO, 20)]
+    scenarios = get_merge_scenarios(condition)
+    if MERGE_SCENARIO:
+        condition = dict(scenarios)[MERGE_SCENARIO]
 
     try:
         max_val = 9 + len(ftrclass_aadt_multi_layers)
         arcpy.SetProgressor("step", "Initializing...", 0, max_val, 1)
-        msg = "Preparing output workspace"
         add_message("Preparing output workspace")
         if not os.path.exists(os.path.join(output_folder, OUTPUT_GDB_NAME)):
             # create file geodatabase at output location, if not present
@@ -1069,7 +1982,7 @@ def main():
         # class for route types
         baseline_values = get_field_values(ftrclass_route, field_route_type)
         # checking if route type is selected but not all
-        baseline_selected = fc_baseline = None
+        baseline_selected = fc_baseline = route_where = None
         if (len(value_route_type) > 0 and
                 len(value_route_type) != len(baseline_values)):
             field = get_field_object(ftrclass_route, field_route_type)
@@ -1077,13 +1990,13 @@ def main():
             if field.domain:
                 # find gdb for route feature class
                 workspace = get_workspace(ftrclass_route)
-                # create lookup for domain value
-                lookup = get_domain_values(workspace, field.domain)
-            where = create_where_clause(field, value_route_type, lookup)
+                # create lookup for domain code of the selected values
+                lookup = get_domain_codes(workspace, field.domain)
+            route_where = create_where_clause(field, value_route_type, lookup)
             # use this tool once and create where condition such as
             # it cover all the selection parms.
             baseline_selected = arcpy.MakeFeatureLayer_management(ftrclass_route,
-                                                           'baseline_selected', where)
+                                                           'baseline_selected', route_where)
 
         # set label to notify user if no route type is selected
         if len(value_route_type) == 0:
@@ -1092,178 +2005,96 @@ def main():
             baseline_selected = ftrclass_route
         arcpy.SetProgressorPosition()
 
+        # read every attribute layer once and split it by county
+        spatial_reference = describe(ftrclass_route).spatialReference
+        counties = read_counties(ftrclass_county, field_county_name, spatial_reference)
+        layers = [(ftrclass_county, field_county_name, USRAP_COUNTY),
+                  (ftrclass_access_control, field_access_control_info, USRAP_ACCESS_CONTROL),
+                  (ftrclass_median, field_median_info, USRAP_MEDIAN),
+                  (ftrclass_travel_lanes, field_travel_lanes_info, USRAP_LANES),
+                  (ftrclass_area_type, field_area_type_info, USRAP_AREA_TYPE),
+                  (ftrclass_speed_limit, field_speed_limit_info, USRAP_SPEED_LIMIT)]
+        layers += [(ftr, field_aadt_multi_layers_value, get_aadt_field_name(ftr))
+                   for ftr in ftrclass_aadt_multi_layers]
+        overlay_fields, partitions = partition_layers(layers, counties, spatial_reference)
+
+        # settings shared by every county, these must be picklable so
+        # they can be handed to worker processes
+        settings = {'routes': ftrclass_route,
+                    'route_where': route_where,
+                    'field_route_name': field_route_name,
+                    'field_route_type': field_route_type,
+                    'overlay_fields': overlay_fields,
+                    'spatial_reference': spatial_reference.exportToString(),
+                    'aadt_layers': ftrclass_aadt_multi_layers,
+                    'cluster_tolerance': cluster_tolerance,
+                    'condition': condition,
+                    'scenarios': scenarios if MERGE_WHAT_IF else [],
+                    'max_segment_miles': MAX_SEGMENT_MILES,
+                    'min_segment_miles': MIN_SEGMENT_MILES,
+                    'output_folder': output_folder,
+                    'full_out_path': full_out_path,
+                    'scratch_folder': os.path.join(os.path.dirname(output_folder),
+                                                   SCRATCH_FOLDER_NAME),
+                    'scratch_budget_mb': SCRATCH_MEMORY_BUDGET_MB / float(max(COUNTY_WORKERS, 1))}
+
+        # fields compared when removing identical output segments
+        check_list = [get_aadt_field_name(ftr) for ftr in ftrclass_aadt_multi_layers]
+        check_list += [USRAP_COUNTY, USRAP_MEDIAN, USRAP_ACCESS_CONTROL,
+                       USRAP_LANES, USRAP_AREA_TYPE, USRAP_SPEED_LIMIT,
+                       field_route_name, field_route_type]
+
+        # only the counties whose inputs changed are segmented again in
+        # incremental mode, otherwise the output is rebuilt from scratch
+        # unless an interrupted run with the same parameters is resumed
+        manifest_path = os.path.join(output_folder, MANIFEST_TABLE_NAME)
+        checkpoint_path = os.path.join(output_folder, CHECKPOINT_TABLE_NAME)
+        coverage_path = os.path.join(output_folder, COVERAGE_TABLE_NAME)
+        parameters = get_parameter_hash(settings)
+        # the fingerprints are only compared in incremental mode, counties
+        # recorded without one are segmented again by the next incremental run
+        fingerprints = {}
+        if INCREMENTAL_SEGMENTATION:
+            fingerprints = fingerprint_counties(settings, counties, partitions)
+        checkpoint = read_county_records(checkpoint_path, CHECKPOINT_FIELDS)
+        if any(record[0] != parameters for record in checkpoint.values()):
+            add_message("Parameters changed since the interrupted run, starting over")
+            checkpoint = {}
+        manifest = {}
+        if INCREMENTAL_SEGMENTATION and arcpy.Exists(full_out_path):
+            manifest = read_county_records(manifest_path, MANIFEST_FIELDS)
+        if len(manifest) > 0 or len(checkpoint) > 0:
+            if not arcpy.Exists(coverage_path):
+                create_county_records(coverage_path, COVERAGE_FIELDS)
+        if len(manifest) > 0:
+            counties = select_changed_counties(counties, partitions, fingerprints, manifest,
+                                               manifest_path, coverage_path, full_out_path)
+        elif len(checkpoint) == 0:
+            truncate_segments(full_out_path)
+            create_county_records(manifest_path, MANIFEST_FIELDS)
+            create_county_records(coverage_path, COVERAGE_FIELDS)
+
+        if len(checkpoint) > 0:
+            add_message("Resuming, {0} counties were completed by the interrupted run".format(
+                len(checkpoint)))
+            for county in [county for county in counties if county[1] in checkpoint]:
+                partitions.pop(county[0])
+            counties = [county for county in counties if county[1] not in checkpoint]
+        else:
+            create_county_records(checkpoint_path, CHECKPOINT_FIELDS)
+
         #process by county
-        with arcpy.da.SearchCursor(ftrclass_county, [field_county_name, "SHAPE@"]) as cursor:
-            for row in cursor:
-                county_name = str(row[0])
-                county_geom = row[1]
-                add_message("Processing " + county_name + " County")
-
-                county_name = str(arcpy.ValidateTableName(county_name, IN_MEMORY))
-
-                clipped_routes = IN_MEMORY + "\\clip" + county_name + "routes"  
-                arcpy.Clip_analysis(baseline_selected, county_geom, clipped_routes)
-                routes = clipped_routes + "D"
-                arcpy.Dissolve_management(clipped_routes, routes, field_route_name + ";" + field_route_type, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-                arcpy.Delete_management(clipped_routes)
-                for problem_field_key in problem_fields.keys():
-                    if len([f.name for f in arcpy.ListFields(problem_field_key) if f.name == problem_fields[problem_field_key]]) > 0:
-                        arcpy.DeleteField_management(problem_field_key, problem_fields[problem_field_key])
-                        arcpy.AddError("Does Exist")
-
-                c = arcpy.GetCount_management(routes)
-                add_message("   " + str(c[0]) + " routes in: " + county_name)
-
-                if int(c[0]) > 0:
-                    value_set = [[ftrclass_county, field_county_name, USRAP_COUNTY],
-                                 [ftrclass_access_control, field_access_control_info, USRAP_ACCESS_CONTROL],
-                                 [ftrclass_median, field_median_info, USRAP_MEDIAN],
-                                 [ftrclass_travel_lanes, field_travel_lanes_info, USRAP_LANES],
-                                 [ftrclass_area_type, field_area_type_info, USRAP_AREA_TYPE],
-                                 [ftrclass_speed_limit, field_speed_limit_info, USRAP_SPEED_LIMIT]]
-                    routes = combine_values(routes, value_set, cluster_tolerance, problem_fields, county_geom, full_out_path)
-                    if len(ftrclass_aadt_multi_layers) > 0:
-                        # combine attributes of identity result and AADT
-                        shape_field_name = arcpy.Describe(routes).shapeFieldName
-                        check_list = [shape_field_name]
-                        new_fields = []
-                        for ftr in ftrclass_aadt_multi_layers:
-                            desc = arcpy.Describe(ftr)
-                            if hasattr(desc,'featureClass'):
-                                ftr = desc.featureClass.catalogPath
-                            new_field = USRAP_AADT_YYYY + '_' + os.path.basename(ftr)[-4:]
-                            new_fields.append(new_field)
-                            seg_name = None
-                            out_gdb = None
-
-                            aadt_clip = IN_MEMORY + "\\clip" + county_name + "aadt" + os.path.basename(ftr)[-4:]
-                            arcpy.Clip_analysis(ftr, county_geom, aadt_clip)
-                            aadt_clipped = aadt_clip + "D"
-                            arcpy.Dissolve_management(aadt_clip, aadt_clipped, field_aadt_multi_layers_value, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-                            arcpy.Delete_management(aadt_clip)
-                            #arcpy.RepairGeometry_management(aadt_clipped)
-
-                            routes = combine_attributes(routes, aadt_clipped, field_aadt_multi_layers_value, new_field,  seg_name,
-                                                        out_gdb, cluster_tolerance, problem_fields, full_out_path, ftr)
-
-                            check_list.append(new_field)
-
-                            if arcpy.Exists(routes):
-                                arcpy.DeleteIdentical_management(routes, check_list)
-                            else:
-                                arcpy.AddMessage(str(routes) + " DOES NOT EXIST")
-
-                            arcpy.Delete_management(aadt_clipped)
-
-                        # calculate the average of all supplied years of AADT
-                        check_list.append(USRAP_COUNTY)
-                        check_list.append(USRAP_MEDIAN)
-                        check_list.append(USRAP_ACCESS_CONTROL)
-                        check_list.append(USRAP_LANES)
-                        check_list.append(USRAP_AREA_TYPE)
-                        check_list.append(USRAP_SPEED_LIMIT)
-                        check_list.append(field_route_name)
-                        check_list.append(field_route_type)
-                        r = routes + "FD"
-                        del check_list[check_list.index(shape_field_name)]
-                        arcpy.Dissolve_management(routes, r, check_list, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-                        arcpy.Delete_management(routes)
-                        routes = r
-                        routes = calculate_average(routes, new_fields, USRAP_AVG_AADT)
-
-                    # baseline segment will be identified as usrap segment
-                    routes = identify_usrap_segment(routes, roadway_type, output_folder, field_route_name)
-
-                    # delete duplicate records
-                    fields = [f.name for f in arcpy.ListFields(routes)
-                              if f.type != "OID"]
-                    #s="in_memory/dissolve"
-                    #arcpy.Dissolve_management(routes, s, fields, multi_part="SINGLE_PART", unsplit_lines="DISSOLVE_LINES")
-                    #routes = s
-                    #arcpy.AddMessage("After Dissolve: " + str(int(arcpy.GetCount_management(routes)[0])))
-                    layer = arcpy.MakeFeatureLayer_management(routes, 'layer')
-                    arcpy.ResetProgressor()
-
-                    max_val = int(arcpy.GetCount_management(routes)[0])
-                    add_message('   {0} segments present after combining attributes'.format(max_val))
-                    add_message("   Merging features...")
-                    # variables for progressor and message
-                    stepper = 0
-                    lower = 10
-
-                    arcpy.SetProgressor('step', msg, 0, max_val, 1)
-                    # collect field names on which conditions would be checked
-                    fields = [field[0] for field in condition]
-                    # insert required field names
-                    fields.insert(0, 'OID@')
-                    fields += [USRAP_SEGMENT, 'SHAPE@']
-
-                    global DELETE_OIDS
-
-                    where = "{0} = 'YES'".format(USRAP_SEGMENT)
-                    layer = arcpy.MakeFeatureLayer_management(routes, 'layer2', where)
-                    with arcpy.da.UpdateCursor(layer, fields, where) as update_cursor:
-                        for row in update_cursor:
-                            if '' in row:
-                                continue
-                            DELETE_OIDS = []
-
-                            numfeatures = merge_segments(row, update_cursor, fields,
-                                                         layer, condition)
-                            if len(DELETE_OIDS) > 0:
-                                stepper += (len(DELETE_OIDS)*2)
-                            else:
-                                stepper += 1
-                            percent = round(int((stepper/float(max_val))*100))
-                            if lower <= percent < 100:
-                                arcpy.AddMessage('     Merging {0}% complete.'.format(lower))
-                                lower += 10
-                            arcpy.SetProgressorPosition(stepper)
-                    arcpy.AddMessage('     Merging {0}% complete'.format('100'))
-                    merged_count = int(arcpy.GetCount_management(routes)[0])
-                    diff = max_val - merged_count
-                    arcpy.AddMessage('   {0} merged out of {1} segments'.format(diff,
-                                                                                 max_val))
-                    arcpy.ResetProgressor()
-                    msg = "   Assigning USRAP_SEGID to segments"
-                    arcpy.AddMessage(msg)
-                    arcpy.SetProgressor('step', msg, 0, 2, 1)
-
-                    routes = add_segids('layer', USRAP_SEGID)
-                    arcpy.SetProgressorPosition()
-
-                existing_fields = [field.name for field in arcpy.Describe(full_out_path).fields]
-                new_fields = [field for field in arcpy.Describe(routes).fields if field.name not in existing_fields and not field.required]
-
-                for field in new_fields:
-                    arcpy.AddField_management(full_out_path, field.name, field.type)
-
-
-                oid_field_name = arcpy.Describe(routes).oidFieldName
-                shp_field_name = arcpy.Describe(routes).shapeFieldName
-                route_fields = [field.name for field in arcpy.ListFields(routes) if field.name != oid_field_name and field.name != shp_field_name]
-                route_fields.append("SHAPE@")
-
-                oid_field_name = arcpy.Describe(full_out_path).oidFieldName
-                shp_field_name = arcpy.Describe(full_out_path).shapeFieldName
-                out_fields = [field.name for field in arcpy.ListFields(full_out_path) if field.name != oid_field_name and field.name != shp_field_name]
-                out_fields.append("SHAPE@")
-
-                #can get around the append thing with this but loose
-                # all of the inital field values
-                with arcpy.da.SearchCursor(routes, route_fields) as ser_cur:
-                    with arcpy.da.InsertCursor(full_out_path, out_fields) as in_cur:
-                        for row in ser_cur:
-                            new_row = [None] * len(out_fields)
-                            for field in route_fields:
-                                if out_fields.index(field) > -1:
-                                    new_row[out_fields.index(field)] = row[route_fields.index(field)]
-                            in_cur.insertRow(new_row)
-
-                #THIS ONLY INSERTS THE FIRST CHARACTER FROM STRING FIELDS WITH PY 3
-                # FOR SOME REASON and thus replaced with the above cursors
-                #arcpy.Append_management(routes, full_out_path, "NO_TEST")
-                arcpy.Delete_management("in_memory")
+        scenario_totals = {}
+        for county_oid, county_name, routes, coverage, summaries in segment_counties(
+                settings, counties, partitions, COUNTY_WORKERS):
+            append_segments(routes, full_out_path, county_oid, county_name,
+                            fingerprints.get(county_name), parameters)
+            write_coverage(coverage_path, county_name, coverage)
+            add_scenario_summaries(scenario_totals, summaries)
+            release_county(routes)
+        if MERGE_WHAT_IF:
+            write_scenario_report(os.path.join(output_folder, SCENARIO_TABLE_NAME),
+                                  scenarios, scenario_totals)
 
         # copy the rest of data when partial road types are selected for
         # analysis
@@ -1273,33 +2104,24 @@ def main():
                                                 fc_baseline, 'SWITCH_SELECTION')
             arcpy.Append_management(baseline_invert_selected, baseline_selected,
                                     'NO_TEST')
-        #Assign unique segIDs
-        where = "{0} = 'YES'".format(USRAP_SEGMENT)
-        l = arcpy.MakeFeatureLayer_management(full_out_path, "FINAL_OUTPUT_SEGMENTS")
-        arcpy.SelectLayerByAttribute_management(str(l[0]), 'CLEAR_SELECTION')
-        segment_id = USRAP_SEGID_START_FROM
-        with arcpy.da.UpdateCursor(str(l[0]), [USRAP_SEGID], where) as update_cur:
-            for row in update_cur:
-                row[0] = segment_id
-                segment_id += 1
-                update_cur.updateRow(row)
-        arcpy.SelectLayerByAttribute_management(str(l[0]),
-                                        'CLEAR_SELECTION')
-        arcpy.Delete_management(str(l[0]))
-
-        arcpy.RepairGeometry_management(full_out_path)
-
-        arcpy.DeleteIdentical_management(full_out_path, check_list)
+        check_geometry(full_out_path, OUTPUT_SEGMENT_NAME)
+
+        delete_identical(full_out_path, "Segments", check_list)
 
         arcpy.AddSpatialIndex_management(full_out_path)
 
-        arcpy.SetParameterAsText(20, full_out_path)
+        # the run is complete, the next run starts from scratch
+        arcpy.Delete_management(checkpoint_path)
+
+        output_segments = full_out_path
+        add_message("Metadata cache: {0} hits, {1} misses".format(METADATA_STATS['hits'],
+                                                                 METADATA_STATS['misses']))
 
         del ftrclass_route, ftrclass_county, ftrclass_access_control, ftrclass_median
         del ftrclass_travel_lanes, ftrclass_area_type, ftrclass_speed_limit
-        del aadt_clipped, baseline_selected, baseline_values, c, check_list, 
-        del county_geom, cursor, fc_baseline, field, fields, full_out_path
-        del problem_fields, update_cur, update_cursor, value_set, shape_field_name
+        del baseline_selected, baseline_values, check_list, settings
+        del counties, partitions, layers, fingerprints, manifest, checkpoint
+        del fc_baseline, full_out_path
 
         if len(ftrclass_aadt_multi_layers) > 0:
             for ftr in ftrclass_aadt_multi_layers:
@@ -1320,6 +2142,7 @@ def main():
             if arcpy.Exists(out_temp_gdb):
                 arcpy.Delete_management(out_temp_gdb)
                 del out_temp_gdb
+    return output_segments
 
 if __name__ == '__main__':
     try:
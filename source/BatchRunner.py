@@ -0,0 +1,132 @@
+"""
+-------------------------------------------------------------------------------
+ | Copyright 2015 Esri
+ |
+ | Licensed under the Apache License, Version 2.0 (the "License");
+ | you may not use this file except in compliance with the License.
+ | You may obtain a copy of the License at
+ |
+ |    http://www.apache.org/licenses/LICENSE-2.0
+ |
+ | Unless required by applicable law or agreed to in writing, software
+ | distributed under the License is distributed on an "AS IS" BASIS,
+ | WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ | See the License for the specific language governing permissions and
+ | limitations under the License.
+ ------------------------------------------------------------------------------
+ """
+# Runs many jobs of the toolbox scripts in one python process so arcpy and
+# the scripts are only loaded once. The execute function of every tool
+# starts its job with an empty metadata cache, so a job never sees the
+# describe results or field lists of datasets an earlier job rebuilt.
+#
+#   python BatchRunner.py jobs.json [--summary timing.csv]
+#
+# The job file is JSON, or TOML with python 3.11 or tomli installed:
+#
+#   {"defaults": {"CrashAssignment": {"max_dist": "100 Feet"}},
+#    "stop_on_error": false,
+#    "jobs": [{"name": "District 1", "tool": "BasicSegmentation",
+#              "parameters": {"ftrclass_route": "C:/data/d1.gdb/Routes", ...}},
+#             {"name": "District 1 crashes", "tool": "CrashAssignment",
+#              "parameters": {...}}]}
+#
+# The parameters of a job are the arguments of the execute function of its
+# tool, the defaults of the tool are used for the ones a job leaves out.
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+
+TOOLS = ["BasicSegmentation", "CrashAssignment", "CalculateCrashRate", "CreateRiskMaps"]
+SUMMARY_FIELDS = ["name", "tool", "status", "seconds", "result"]
+
+def read_job_file(job_file):
+    """
+    Read a JSON or TOML job file
+    """
+    if os.path.splitext(job_file)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(job_file, 'rb') as f:
+            return tomllib.load(f)
+    with open(job_file) as f:
+        return json.load(f)
+
+def get_tool(tool):
+    """
+    Import the script of a tool once, later jobs reuse the module
+    """
+    if tool not in TOOLS:
+        raise ValueError("Unknown tool {0}, expected one of {1}".format(tool, ", ".join(TOOLS)))
+    return importlib.import_module(tool)
+
+def run_job(job, defaults):
+    """
+    Run a single job and return its summary row
+    """
+    tool = job['tool']
+    name = job.get('name', tool)
+    parameters = dict(defaults.get(tool, {}))
+    parameters.update(job.get('parameters', {}))
+    print("Running {0} ({1})".format(name, tool))
+    start = time.time()
+    status = "failed"
+    result = None
+    try:
+        result = get_tool(tool).execute(**parameters)
+        # the scripts report their own errors and return None when they fail
+        if result is not None:
+            status = "completed"
+    except (Exception, SystemExit) as ex:
+        # a tool stopping with sys.exit fails its job, not the whole batch
+        print("{0} failed: {1!r}".format(name, ex))
+    seconds = time.time() - start
+    print("{0} {1} in {2:.1f} seconds".format(name, status, seconds))
+    return {'name': name, 'tool': tool, 'status': status,
+            'seconds': round(seconds, 1), 'result': result}
+
+def run_jobs(job_file, summary_path):
+    """
+    Run every job of the job file in order and write the timing summary
+    """
+    spec = read_job_file(job_file)
+    defaults = spec.get('defaults', {})
+    rows = []
+    for job in spec.get('jobs', []):
+        rows.append(run_job(job, defaults))
+        if rows[-1]['status'] != "completed" and spec.get('stop_on_error', False):
+            break
+
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    total = sum(row['seconds'] for row in rows)
+    failed = len([row for row in rows if row['status'] != "completed"])
+    print("{0} jobs run in {1:.1f} seconds, {2} failed, summary written to {3}".format(
+        len(rows), total, failed, summary_path))
+    return failed
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description="Run toolbox jobs from a JSON or TOML job file")
+    parser.add_argument('job_file')
+    parser.add_argument('--summary', help="timing summary csv, next to the job file by default")
+    args = parser.parse_args()
+    summary_path = args.summary or os.path.splitext(args.job_file)[0] + "_timing.csv"
+
+    # the scripts are imported from the folder of this file
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    failed = run_jobs(args.job_file, summary_path)
+    sys.exit(1 if failed > 0 else 0)
+
+if __name__ == '__main__':
+    main()
@@ -33,24 +33,43 @@ def get_workspace(feature_class):
         return None
 
 def main():
+    streets_intersection = arcpy.GetParameterAsText(0)
+    crashes = arcpy.GetParameterAsText(1)
+    time_period = arcpy.GetParameterAsText(2)
+    snap_distance = arcpy.GetParameterAsText(3)
+    weight_field = arcpy.GetParameterAsText(4)
+    weight_table = arcpy.GetParameter(5)
+    adt_field = arcpy.GetParameterAsText(6)
+    output_crash_rates = arcpy.GetParameterAsText(7)
+    params = arcpy.GetParameterInfo()
+
+    weights = []
+    if weight_table is not None:
+        weights = [[weight_table.getValue(i, 0), weight_table.getValue(i, 1)]
+                   for i in range(0, weight_table.rowCount)]
+
+    lyrx_path = execute(streets_intersection, crashes, time_period, snap_distance,
+                        weight_field, weights, adt_field, output_crash_rates)
+    if lyrx_path:
+        params[7].symbology = lyrx_path
+
+def execute(streets_intersection, crashes, time_period, snap_distance, weight_field,
+            weights, adt_field, output_crash_rates):
+    """
+    Calculate the crash rates with the tool parameters given as values, weights is
+    a list of [value, weight] pairs. Returns the layer file for the output symbology.
+    """
     scratch_datasets = []
     new_fields = ['c_count', 'c_weight', 'c_freq', 'c_rate', 'w_freq', 'w_rate']
+    weights = [list(weight) for weight in weights or []]
 
     try:
-        streets_intersection = arcpy.GetParameterAsText(0)
-        crashes = arcpy.GetParameterAsText(1)
-        time_interval, time_unit = arcpy.GetParameterAsText(2).split(' ')
+        time_interval, time_unit = time_period.split(' ')
         time_interval = float(time_interval)
         if time_unit == 'Years':
             time_interval = time_interval * 365
         elif time_unit == 'Weeks':
             time_interval = time_interval * 7
-        snap_distance = arcpy.GetParameterAsText(3)
-        weight_field = arcpy.GetParameterAsText(4)
-        weight_table = arcpy.GetParameter(5)
-        adt_field = arcpy.GetParameterAsText(6)
-        output_crash_rates = arcpy.GetParameterAsText(7)
-        params = arcpy.GetParameterInfo()
         shape_type = arcpy.Describe(streets_intersection).shapeType
 
         weight_provided = False
@@ -86,9 +105,9 @@ def main():
                                 if domain.name == field.domain:
                                     if domain.domainType == 'CodedValue':
                                         for key, value in domain.codedValues.items():
-                                            for i in range(0, weight_table.rowCount):
-                                                if weight_table.getValue(i, 0) == value:
-                                                    weight_table.setValue(i, 0, str(key))
+                                            for weight in weights:
+                                                if weight[0] == value:
+                                                    weight[0] = str(key)
                                     break
 
         with arcpy.da.UpdateCursor(crashes_snap, fields) as cursor:
@@ -96,9 +115,9 @@ def main():
                 row[0] = 1.0
                 if len(fields) == 3:
                     value = str(row[2])
-                    for i in range(0, weight_table.rowCount):
-                        if value == weight_table.getValue(i, 0):
-                            row[1] = weight_table.getValue(i, 1)
+                    for weight in weights:
+                        if value == weight[0]:
+                            row[1] = weight[1]
                             break
                 cursor.updateRow(row)
            
@@ -215,7 +234,7 @@ def main():
             temp_lyrx.write(lyrx_json.encode())
         lyrx_path = "{0}.lyrx".format(temp_lyrx.name)
         os.rename(temp_lyrx.name, lyrx_path)
-        params[7].symbology = lyrx_path
+        return lyrx_path
         
     finally:
         for dataset in scratch_datasets:
@@ -17,8 +17,12 @@
  """
 import arcpy
 import os
-import sys
+import shutil
 import math, time
+import numpy
+from SegmentationUtils import (SCRATCH, clear_metadata_cache, scratch_path, track_scratch,
+                               clear_scratch, check_geometry, delete_identical,
+                               chain_polylines)
 
 # pylint: disable = E1103, E1101, R0914, W0703, R0911, R0912, R0915, C0302
 
@@ -55,6 +59,46 @@ AREA_TYPE_FIELD = "USRAP_AREA_TYPE"
 USRAP_ROADWAY_TYPE_FIELDNAME = 'USRAP_ROADWAY_TYPE'
 USRAP_WHERE = "{0} = 'YES'".format(USRAP_SEGMENT_FIELD_NAME)
 
+# Specify the in_memory budget, in megabytes, for intermediate datasets.
+# Once it is exceeded the largest intermediates are moved to a scratch
+# geodatabase in SCRATCH_FOLDER_NAME and new ones are written there
+SCRATCH_MEMORY_BUDGET_MB = 8192
+SCRATCH_FOLDER_NAME = "CrashAssignmentScratch"
+
+# Crashes are matched to the nearest USRAP segment with an in-process grid
+# index over the segment edges when the segments have a projected
+# coordinate system, otherwise a spatial join is used. The crashes are
+# queried CRASH_QUERY_CHUNK at a time.
+CRASH_QUERY_CHUNK = 50000
+
+# Fields of the crash output holding the distance from a crash to its
+# segment and the distance along the segment, from its start, to the nearest
+# location, both in the units of the segments. They are written when the
+# in-process index is used and measure the segment the crash was assigned
+# to before merging.
+CRASH_DISTANCE_FIELD = "SEGMENT_DISTANCE"
+CRASH_MEASURE_FIELD = "SEGMENT_MEASURE"
+
+# Number of crashes of every index query that are searched again by
+# measuring every segment edge, a warning is given when the index finds a
+# different nearest location. 0 turns the check off.
+CRASH_INDEX_CHECK_SAMPLE = 100
+
+# When True the crash index is partitioned by route name and every crash is
+# searched among the segments of its own route first, crashes with a blank
+# route name or a route name no segment has are searched among all segments
+ROUTE_PARTITIONED_INDEX = True
+
+# When True the crashes with no segment of their own route within the search
+# distance are assigned to the nearest segment of any route, otherwise they
+# are left unassigned
+ROUTE_MISS_FALLBACK = False
+LINEAR_UNIT_METERS = {"METERS": 1.0, "DECIMETERS": 0.1, "CENTIMETERS": 0.01,
+                      "MILLIMETERS": 0.001, "KILOMETERS": 1000.0,
+                      "FEET": 0.3048, "USSURVEYFEET": 1200.0 / 3937,
+                      "INCHES": 0.0254, "YARDS": 0.9144, "MILES": 1609.344,
+                      "NAUTICALMILES": 1852.0}
+
 # Set increment value for progressor while merging segments
 SEGMENT_INCREMENT = 10
 
@@ -80,6 +124,369 @@ SUMMARY_ERROR_TABLE_NAME = "SummaryErrorTable"
 
 VERSION_USED = str(arcpy.GetInstallInfo()['Version'])
 
+# Number of merged geometries joined end to end and joined with a union
+MERGE_STATS = {'chains': 0, 'unions': 0}
+
+# Specify the name of the table relating every merged SEGID to the SEGID of
+# the segment it ended up in
+LINEAGE_TABLE_NAME = "SegmentLineage"
+
+# Union-find parents of the SEGIDs merged during the merge phase, the
+# crashes are remapped to the surviving SEGIDs once merging is complete
+SEGID_LINEAGE = {}
+
+#===================== Scratch Data ===========================================#
+def report_scratch(label):
+    """
+    Reports the peak in_memory usage and the datasets written to disk, then
+    deletes the tracked intermediates
+    """
+    peak, spilled = clear_scratch()
+    add_message("{0}: peak {1:.1f} MB of scratch data in memory, {2} datasets written to disk"
+                .format(label, peak / 1048576.0, spilled))
+
+#===================== Crash Index ============================================#
+def get_search_distance(max_dist, spatial_reference):
+    """
+    Search distance such as "100 Feet" in the units of a projected spatial
+    reference, None when it cannot be measured in planar units
+    """
+    if spatial_reference.type != 'Projected' or not max_dist:
+        return None
+    parts = str(max_dist).split()
+    try:
+        value = float(parts[0])
+    except ValueError:
+        return None
+    unit = parts[1].upper().replace("_", "") if len(parts) > 1 else None
+    if unit is None or unit == "UNKNOWN":
+        return value
+    if unit not in LINEAR_UNIT_METERS:
+        return None
+    return value * LINEAR_UNIT_METERS[unit] / spatial_reference.metersPerUnit
+
+def normalize_route_name(value):
+    """
+    Route name compared between crashes and segments, case and repeated
+    spaces are ignored
+    """
+    if value is None:
+        return ""
+    return " ".join(str(value).split()).upper()
+
+def get_segment_edges(segment_layer, id_field, route_field=None):
+    """
+    Straight edges of every segment as arrays along with the distance from
+    the start of its segment to the start of each edge, and the normalized
+    route name of every segment when route_field is given
+    """
+    segids = []
+    routes = []
+    edges = []
+    fields = [id_field, "SHAPE@"] + ([route_field] if route_field else [])
+    with arcpy.da.SearchCursor(segment_layer, fields) as cursor:
+        for row in cursor:
+            if row[1] is None:
+                continue
+            if route_field:
+                routes.append(normalize_route_name(row[2]))
+            start = 0.0
+            for part in row[1]:
+                points = numpy.array([(point.X, point.Y) for point in part if point])
+                if len(points) < 2:
+                    continue
+                lengths = numpy.hypot(*numpy.diff(points, axis=0).T)
+                starts = start + numpy.concatenate(([0.0], numpy.cumsum(lengths)[:-1]))
+                start += lengths.sum()
+                edges.append(numpy.column_stack((points[:-1], points[1:], starts,
+                                                 numpy.full(len(lengths), len(segids)))))
+            segids.append(row[0])
+    if len(edges) == 0:
+        return segids, routes, numpy.zeros((0, 6))
+    return segids, routes, numpy.vstack(edges)
+
+def build_segment_index(segids, edges, search_distance):
+    """
+    Packed uniform grid over the edges of the segments, edges longer than a
+    cell are cut so every piece touches at most four cells. The edges of a
+    cell are found with a binary search of the sorted cell keys, so the
+    index is plain arrays that need no geoprocessing to query.
+    """
+    lengths = numpy.hypot(edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1])
+    cell_size = max(search_distance, float(numpy.median(lengths)) if len(lengths) else 0, 1e-9)
+
+    # cut the edges into pieces no longer than a cell
+    pieces = numpy.maximum(numpy.ceil(lengths / cell_size), 1).astype(numpy.int64)
+    edge_index = numpy.repeat(numpy.arange(len(edges)), pieces)
+    piece = numpy.arange(len(edge_index)) - numpy.repeat(numpy.cumsum(pieces) - pieces, pieces)
+    t_0 = piece / pieces[edge_index].astype(float)
+    t_1 = (piece + 1) / pieces[edge_index].astype(float)
+    x_0, y_0, x_1, y_1 = [edges[edge_index, column] for column in range(4)]
+    edges = numpy.column_stack((x_0 + (x_1 - x_0) * t_0, y_0 + (y_1 - y_0) * t_0,
+                                x_0 + (x_1 - x_0) * t_1, y_0 + (y_1 - y_0) * t_1,
+                                edges[edge_index, 4] + lengths[edge_index] * t_0,
+                                edges[edge_index, 5]))
+
+    origin = (edges[:, [0, 2]].min() if len(edges) else 0,
+              edges[:, [1, 3]].min() if len(edges) else 0)
+    cell_x = ((edges[:, [0, 2]] - origin[0]) // cell_size).astype(numpy.int64)
+    cell_y = ((edges[:, [1, 3]] - origin[1]) // cell_size).astype(numpy.int64)
+    rows = int(cell_y.max()) + 1 if len(edges) else 1
+
+    # register every piece in each cell of its extent
+    low_x, low_y = cell_x.min(axis=1), cell_y.min(axis=1)
+    width = cell_x.max(axis=1) - low_x + 1
+    counts = width * (cell_y.max(axis=1) - low_y + 1)
+    owner = numpy.repeat(numpy.arange(len(edges)), counts)
+    local = numpy.arange(len(owner)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    keys = (low_x[owner] + local % width[owner]) * rows + low_y[owner] + local // width[owner]
+    order = numpy.argsort(keys, kind='stable')
+    cell_keys, starts = numpy.unique(keys[order], return_index=True)
+    return {'edges': edges, 'segids': segids, 'cell_size': cell_size, 'origin': origin,
+            'rows': rows, 'columns': int(cell_x.max()) + 1 if len(edges) else 1,
+            'cell_keys': cell_keys, 'starts': numpy.append(starts, len(order)),
+            'members': owner[order]}
+
+def build_route_indexes(segids, routes, edges, search_distance):
+    """
+    One segment index per normalized route name, the segment positions of
+    every index refer to the same segids
+    """
+    edge_routes = numpy.array(routes, dtype=object)[edges[:, 5].astype(numpy.int64)] \
+                  if len(edges) else numpy.array([], dtype=object)
+    order = numpy.argsort(edge_routes, kind='stable')
+    names, starts = numpy.unique(edge_routes[order], return_index=True)
+    starts = numpy.append(starts, len(order))
+    return dict((name, build_segment_index(segids, edges[order[starts[i]:starts[i + 1]]],
+                                           search_distance))
+                for i, name in enumerate(names) if name != "")
+
+def query_segment_index(index, points, search_distance):
+    """
+    Nearest segment within search_distance of every point, points is an
+    array of x and y with NaN for missing shapes
+    Returns the position of the segment in index['segids'] or -1, the
+    distance and the distance along the segment to the nearest location
+    """
+    count = len(points)
+    nearest = numpy.full(count, -1, dtype=numpy.int64)
+    distance = numpy.full(count, numpy.nan)
+    along = numpy.full(count, numpy.nan)
+    if count == 0 or len(index['edges']) == 0:
+        return nearest, distance, along
+    valid = ~numpy.isnan(points).any(axis=1)
+    cell_x = numpy.zeros(count, dtype=numpy.int64)
+    cell_y = numpy.zeros(count, dtype=numpy.int64)
+    cell_x[valid] = (points[valid, 0] - index['origin'][0]) // index['cell_size']
+    cell_y[valid] = (points[valid, 1] - index['origin'][1]) // index['cell_size']
+
+    # the cell of a point and its eight neighbours hold every edge within
+    # the search distance since a cell is never smaller than it
+    point_ids = []
+    edge_ids = []
+    for offset_x in (-1, 0, 1):
+        for offset_y in (-1, 0, 1):
+            column, row = cell_x + offset_x, cell_y + offset_y
+            inside = valid & (column >= 0) & (column < index['columns']) & \
+                     (row >= 0) & (row < index['rows'])
+            keys = column * index['rows'] + row
+            position = numpy.searchsorted(index['cell_keys'], keys)
+            position = numpy.minimum(position, len(index['cell_keys']) - 1)
+            inside &= index['cell_keys'][position] == keys
+            first = index['starts'][position]
+            counts = numpy.where(inside, index['starts'][position + 1] - first, 0)
+            owner = numpy.repeat(numpy.arange(count), counts)
+            local = numpy.arange(len(owner)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            point_ids.append(owner)
+            edge_ids.append(index['members'][first[owner] + local])
+    point_ids = numpy.concatenate(point_ids)
+    edges = index['edges'][numpy.concatenate(edge_ids)]
+
+    # distance from each point to each candidate edge
+    p_x, p_y = points[point_ids, 0], points[point_ids, 1]
+    d_x, d_y = edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1]
+    length_sq = d_x * d_x + d_y * d_y
+    t = numpy.where(length_sq > 0, ((p_x - edges[:, 0]) * d_x + (p_y - edges[:, 1]) * d_y) /
+                    numpy.where(length_sq > 0, length_sq, 1), 0)
+    t = numpy.clip(t, 0, 1)
+    gaps = numpy.hypot(edges[:, 0] + t * d_x - p_x, edges[:, 1] + t * d_y - p_y)
+    within = gaps <= search_distance
+    point_ids, edges, gaps, t = point_ids[within], edges[within], gaps[within], t[within]
+
+    # keep the closest edge of each point, ties go to the first segment
+    order = numpy.lexsort((edges[:, 5], gaps, point_ids))
+    matched, first = numpy.unique(point_ids[order], return_index=True)
+    best = order[first]
+    nearest[matched] = edges[best, 5].astype(numpy.int64)
+    distance[matched] = gaps[best]
+    along[matched] = edges[best, 4] + t[best] * numpy.sqrt(length_sq[within][best])
+    return nearest, distance, along
+
+def query_in_chunks(index, points, search_distance):
+    """
+    Nearest segment position, distance and distance along the segment of
+    every point, CRASH_QUERY_CHUNK points at a time
+    """
+    nearest = numpy.full(len(points), -1, dtype=numpy.int64)
+    distance = numpy.full(len(points), numpy.nan)
+    along = numpy.full(len(points), numpy.nan)
+    for start in range(0, len(points), CRASH_QUERY_CHUNK):
+        chunk = slice(start, start + CRASH_QUERY_CHUNK)
+        nearest[chunk], distance[chunk], along[chunk] = query_segment_index(
+            index, points[chunk], search_distance)
+    if CRASH_INDEX_CHECK_SAMPLE > 0 and len(points) > 0:
+        check_segment_index(index, points, search_distance, (nearest, distance, along))
+    return nearest, distance, along
+
+def find_nearest_edges(edges, points, search_distance):
+    """
+    Nearest segment within search_distance of every point found by measuring
+    every edge, the same result as query_segment_index without the grid
+    """
+    nearest = numpy.full(len(points), -1, dtype=numpy.int64)
+    distance = numpy.full(len(points), numpy.nan)
+    along = numpy.full(len(points), numpy.nan)
+    if len(edges) == 0:
+        return nearest, distance, along
+    d_x, d_y = edges[:, 2] - edges[:, 0], edges[:, 3] - edges[:, 1]
+    length_sq = d_x * d_x + d_y * d_y
+    divisor = numpy.where(length_sq > 0, length_sq, 1)
+    for position, (p_x, p_y) in enumerate(points):
+        if numpy.isnan(p_x) or numpy.isnan(p_y):
+            continue
+        t = numpy.where(length_sq > 0,
+                        ((p_x - edges[:, 0]) * d_x + (p_y - edges[:, 1]) * d_y) / divisor, 0)
+        t = numpy.clip(t, 0, 1)
+        gaps = numpy.hypot(edges[:, 0] + t * d_x - p_x, edges[:, 1] + t * d_y - p_y)
+        closest = numpy.flatnonzero(gaps == gaps.min())
+        best = closest[numpy.argmin(edges[closest, 5])]
+        if gaps[best] > search_distance:
+            continue
+        nearest[position] = int(edges[best, 5])
+        distance[position] = gaps[best]
+        along[position] = edges[best, 4] + t[best] * numpy.sqrt(length_sq[best])
+    return nearest, distance, along
+
+def check_segment_index(index, points, search_distance, found):
+    """
+    Compare the index query of CRASH_INDEX_CHECK_SAMPLE points, spread over
+    the points, with find_nearest_edges and warn about the points where the
+    distance or the location along the segment differ
+    Returns the number of points that differ
+    """
+    sample = numpy.unique(numpy.linspace(0, len(points) - 1,
+                                         min(CRASH_INDEX_CHECK_SAMPLE, len(points)))
+                          .astype(numpy.int64))
+    expected = find_nearest_edges(index['edges'], points[sample], search_distance)
+    tolerance = 1e-6 * max(search_distance, 1)
+    nearest, distance, along = [values[sample] for values in found]
+    differ = (nearest < 0) != (expected[0] < 0)
+    matched = (nearest >= 0) & (expected[0] >= 0)
+    differ[matched] |= numpy.abs(distance[matched] - expected[1][matched]) > tolerance
+    same_segment = matched & (nearest == expected[0])
+    differ[same_segment] |= numpy.abs(along[same_segment] -
+                                      expected[2][same_segment]) > tolerance
+    if differ.any():
+        arcpy.AddWarning("The segment index found a different nearest location for {0} of "
+                         "{1} crashes checked against every segment"
+                         .format(int(differ.sum()), len(sample)))
+    return int(differ.sum())
+
+def find_crash_segments(indexes, segids, edges, points, crash_routes, search_distance):
+    """
+    Nearest segment position, distance and distance along the segment of
+    every crash, crashes are searched in the
+    index of their route and in the global index, stored under None and
+    built when it is first needed, when their route has no index, or no
+    segment of their route is within the search distance and
+    ROUTE_MISS_FALLBACK is True
+    """
+    nearest = numpy.full(len(points), -1, dtype=numpy.int64)
+    distance = numpy.full(len(points), numpy.nan)
+    along = numpy.full(len(points), numpy.nan)
+    names = numpy.array([name if name in indexes else None for name in crash_routes],
+                        dtype=object)
+    own_route = numpy.not_equal(names, None)
+    searched = int(own_route.sum())
+    for name in set(names[own_route]):
+        selected = numpy.flatnonzero(names == name)
+        nearest[selected], distance[selected], along[selected] = query_in_chunks(
+            indexes[name], points[selected], search_distance)
+    missed = own_route & (nearest < 0) & ~numpy.isnan(points).any(axis=1)
+    fallback = ~own_route | missed if ROUTE_MISS_FALLBACK else ~own_route
+    selected = numpy.flatnonzero(fallback)
+    if len(selected) > 0:
+        if None not in indexes:
+            indexes[None] = build_segment_index(segids, edges, search_distance)
+        nearest[selected], distance[selected], along[selected] = query_in_chunks(
+            indexes[None], points[selected], search_distance)
+    if len([name for name in indexes if name is not None]) > 0:
+        arcpy.AddMessage("{0} crashes searched on their own route, {1} on every route"
+                         .format(searched, len(points) - searched))
+        if ROUTE_MISS_FALLBACK:
+            arcpy.AddMessage("{0} crashes with no segment of their own route in reach "
+                             "were assigned to another route"
+                             .format(int((missed & (nearest >= 0)).sum())))
+        else:
+            arcpy.AddMessage("{0} crashes with no segment of their own route in reach "
+                             "were left unassigned".format(int(missed.sum())))
+    return nearest, distance, along
+
+def write_crash_output(input_crash_fc, indexes, segids, edges, search_distance,
+                       crash_output_path, segment_sr, segid_type, crash_route_field=None):
+    """
+    Copy the crashes to the crash output with the SEGID of their nearest
+    segment, their distance to it and their measure along it in a single
+    insert cursor pass
+    Returns the number of crashes that were assigned a segment
+    """
+    # crash locations in the coordinates of the segments
+    oids = []
+    points = []
+    crash_routes = []
+    fields = ["OID@", "SHAPE@XY"] + ([crash_route_field] if crash_route_field else [])
+    with arcpy.da.SearchCursor(input_crash_fc, fields, spatial_reference=segment_sr) as cursor:
+        for row in cursor:
+            oids.append(row[0])
+            points.append(row[1] if row[1] and None not in row[1] else (numpy.nan, numpy.nan))
+            crash_routes.append(normalize_route_name(row[2]) if crash_route_field else "")
+    points = numpy.array(points, dtype=float).reshape(-1, 2)
+    nearest, distance, along = find_crash_segments(indexes, segids, edges, points,
+                                                   crash_routes, search_distance)
+    crash_segids = dict((oid, (segids[position], float(gap), float(measure)))
+                        for oid, position, gap, measure in zip(oids, nearest, distance, along)
+                        if position >= 0)
+    del points, oids, crash_routes, nearest, distance, along
+
+    desc = arcpy.Describe(input_crash_fc)
+    arcpy.CreateFeatureclass_management(os.path.dirname(crash_output_path),
+                                        os.path.basename(crash_output_path),
+                                        desc.shapeType, input_crash_fc,
+                                        "ENABLED" if desc.hasM else "DISABLED",
+                                        "ENABLED" if desc.hasZ else "DISABLED",
+                                        desc.spatialReference)
+    fields = [field.name for field in arcpy.ListFields(input_crash_fc)
+              if not field.required and field.type != 'Geometry' and
+              field.name.upper() != SEGMENTID_FIELD_NAME]
+    if SEGMENTID_FIELD_NAME not in [field.name.upper() for field in
+                                    arcpy.ListFields(crash_output_path)]:
+        arcpy.AddField_management(crash_output_path, SEGMENTID_FIELD_NAME, segid_type)
+    output_fields = [field.name.upper() for field in arcpy.ListFields(crash_output_path)]
+    for field_name in [CRASH_DISTANCE_FIELD, CRASH_MEASURE_FIELD]:
+        if field_name not in output_fields:
+            arcpy.AddField_management(crash_output_path, field_name, "DOUBLE")
+    fields = [field for field in fields
+              if field.upper() not in [CRASH_DISTANCE_FIELD, CRASH_MEASURE_FIELD]]
+    unassigned = (None, None, None)
+    with arcpy.da.SearchCursor(input_crash_fc, ["OID@"] + fields + ["SHAPE@"]) as s_cursor:
+        with arcpy.da.InsertCursor(crash_output_path,
+                                   fields + [SEGMENTID_FIELD_NAME, CRASH_DISTANCE_FIELD,
+                                             CRASH_MEASURE_FIELD, "SHAPE@"]) as i_cursor:
+            for row in s_cursor:
+                i_cursor.insertRow(row[1:-1] + crash_segids.get(row[0], unassigned) +
+                                   (row[-1],))
+    return len(crash_segids)
+
 #===================== Assignment =============================================#
 def create_gdb(output_folder):
     """
@@ -133,7 +540,7 @@ def get_usrap_segments(input_segment_fc):
             return segment_layer, count
         else:
             arcpy.AddError("No valid USRAP segments found. \nFurther processing will not be performed.")
-            sys.exit()
+            return []
 
     except arcpy.ExecuteError:
         arcpy.AddError("Error occurred while getting USRAP_SEGMENT.")
@@ -143,13 +550,51 @@ def get_usrap_segments(input_segment_fc):
         arcpy.AddError("Error occurred while getting USRAP_SEGMENT.")
         return []
 
-def assign_segid_to_crashes(max_dist, usrap_segment_layer, input_crash_fc, out_gdb):
+def assign_segid_to_crashes(max_dist, usrap_segment_layer, input_crash_fc, out_gdb,
+                            segment_route_name_field=None, crash_route_field=None):
+    """
+    This function assigns the SEGID of the nearest segment within max_dist
+    to every crash using the crash index, a spatial join is used when the
+    distance cannot be measured in the units of the segments
+    """
+    try:
+        add_formatted_message("Assigning {0} to crashes... ", SEGMENTID_FIELD_NAME)
+        segment_sr = arcpy.Describe(usrap_segment_layer).spatialReference
+        search_distance = get_search_distance(max_dist, segment_sr)
+        if search_distance is None:
+            return join_nearest_segments(max_dist, usrap_segment_layer, input_crash_fc, out_gdb)
+
+        by_route = ROUTE_PARTITIONED_INDEX and segment_route_name_field and crash_route_field
+        segids, routes, edges = get_segment_edges(usrap_segment_layer, SEGMENTID_FIELD_NAME,
+                                                  segment_route_name_field if by_route else None)
+        indexes = {}
+        if by_route:
+            indexes = build_route_indexes(segids, routes, edges, search_distance)
+        segid_type = get_field_type(usrap_segment_layer, SEGMENTID_FIELD_NAME)
+        assigned = write_crash_output(input_crash_fc, indexes, segids, edges, search_distance,
+                                      out_gdb + os.sep + CRASH_OUTPUT_NAME,
+                                      segment_sr, segid_type,
+                                      crash_route_field if by_route else None)
+        arcpy.AddMessage("{0} crashes are within {1} of a segment".format(assigned, max_dist))
+        del indexes, edges
+        return True
+
+    except arcpy.ExecuteError:
+        arcpy.AddError("Error occured while assigning segments to the " +
+                       "Crash Feature Class.")
+        return False
+
+    except Exception:
+        arcpy.AddError("Error occured while assigning segments to the " +
+                       "Crash Feature Class.")
+        return False
+
+def join_nearest_segments(max_dist, usrap_segment_layer, input_crash_fc, out_gdb):
     """
     This function first creates the Field mapping and then performs a
     spatial join between Crash Feature Class and Segment Feature Class
     """
     try:
-        add_formatted_message("Assigning {0} to crashes... ", SEGMENTID_FIELD_NAME)
         # Specify target features, join features
         target_features = input_crash_fc
         join_features = usrap_segment_layer
@@ -210,95 +655,30 @@ def assign_crashes_to_segments(input_segment_fc, crash_years, crash_year_field,
         arcpy.SetProgressor("step", "Assigning crash count to segments..",
                             0, c_count + 1, 1)
 
-        #   Copy the features into memory for faster writes
-        in_mem_segs = "in_memory" + os.sep + SEGMENT_OUTPUT_NAME
-        arcpy.CopyFeatures_management(input_segment_fc, in_mem_segs)
+        #   Copy the segments to the output and add the fields for each
+        #   crash year, total crashes and average crashes in one schema
+        #   change, every value is then written by a single update pass
+        global SEGMENT_OUTPUT_PATH
+        SEGMENT_OUTPUT_PATH = out_gdb + os.sep + "temp" + SEGMENT_OUTPUT_NAME
+        arcpy.CopyFeatures_management(input_segment_fc, SEGMENT_OUTPUT_PATH)
 
         arcpy.AddMessage("Adding crash year fields in input segment" +
                          " feature class...")
-
-        fields = []
-
-        #   Add fields for each crash year in the segment feature class
-        for year in crash_years:
-            year_field = "{0}{1}".format(CRASH_YEAR_FIELD, str(year))
-            arcpy.AddField_management(in_mem_segs, year_field, "SHORT")
-            fields.append(year_field)
-
-            arcpy.CalculateField_management(in_mem_segs, year_field, 0, "PYTHON_9.3")
-        fields.append(SEGMENTID_FIELD_NAME)
-
-        #   Add fields for Total and Average crashes in the
-        #   segment feature class
-        arcpy.AddField_management(in_mem_segs, TOTAL_CRASH_FIELD_NAME,
-                                  "LONG")
-
-        arcpy.AddField_management(in_mem_segs, AVG_CRASHES_FIELD_NAME,
-                                  "DOUBLE")
+        new_fields = [["{0}{1}".format(CRASH_YEAR_FIELD, year), "SHORT"]
+                      for year in crash_years]
+        new_fields += [[TOTAL_CRASH_FIELD_NAME, "LONG"], [AVG_CRASHES_FIELD_NAME, "DOUBLE"]]
+        add_fields(SEGMENT_OUTPUT_PATH, new_fields)
 
         arcpy.SetProgressorPosition(1)
         arcpy.AddMessage("Assignment process started..")
 
-        #   Take segment id assign to each crash from crash spatial join output,
-        #   increment the crash count by 1 for that segment id
-        #   for specified year
-        row_count = 0
-        per_val_list = [int(round((c_count * per_num) / 100))
-                        for per_num in range(10, 110, 10)]
-        perc = 10
-
-        test = {}
-        with arcpy.da.SearchCursor(pts, [SEGMENTID_FIELD_NAME, crash_year_field]) as crash_cursor:
-            for row in crash_cursor:
-                row_count += 1
-                #arcpy.SetProgressorLabel(("Finished assigning {0} crashes out" +
-                #                          " of {1}").format(row_count, c_count))
-                #arcpy.SetProgressorPosition()
-
-                if row_count in per_val_list:
-                    arcpy.AddMessage("Assignment progress : {0}%".format(perc))
-                    perc += 10
-                field = "{0}{1}".format(CRASH_YEAR_FIELD, int(row[1]))
-                if list(test.keys()).count(row[0]) > 0:
-                    updated = False 
-                    for r in test[row[0]]:              
-                        if r.count(field) > 0:
-                            r[1] += 1
-                            updated = True
-                            break
-                    if updated != True:
-                        test[row[0]].append([field, 1])
-                else:
-                    test[row[0]] = [[field, 1]]
-        del crash_cursor
-
-        with arcpy.da.UpdateCursor(in_mem_segs, fields, SEGMENTID_FIELD_NAME + " IS NOT NULL") as segment_cursor:
-            for update_row in segment_cursor:
-                if list(test.keys()).count(update_row[-1]) > 0:
-                    row = test[update_row[-1]]
-                    for r in row:
-                        year = r[0]
-                        val = r[1]
-                        update_row[fields.index(year)] = val
-                    segment_cursor.updateRow(update_row)
-                    del row
-        del segment_cursor, test
+        #   Count the crashes of every segment and year, then write the
+        #   year counts, total and average of each segment in one pass
+        segment_rows, counts = count_crashes(pts, crash_year_field, crash_years)
+        write_crash_counts(SEGMENT_OUTPUT_PATH, crash_years, segment_rows, counts)
+        del segment_rows, counts, new_fields
 
         arcpy.SetProgressorPosition()
-        arcpy.AddMessage("Adding total crashes and average crashes in the " +
-                         "output")
-        #   Calculate the total crashes and average crashes for each segment
-        segment_output_fc = caluculate_sum_avg_field(crash_years, in_mem_segs)
-        if not segment_output_fc:
-            return False
-
-        # copy the updated segments to a physical class
-        global SEGMENT_OUTPUT_PATH
-        SEGMENT_OUTPUT_PATH = out_gdb + os.sep + "temp" + SEGMENT_OUTPUT_NAME
-        arcpy.CopyFeatures_management(in_mem_segs, SEGMENT_OUTPUT_PATH)
-
-        arcpy.Delete_management(in_mem_segs)
-        del in_mem_segs
 
         arcpy.AddMessage("Assignment process completed.")
         arcpy.AddMessage("-" * 80)
@@ -310,49 +690,71 @@ def assign_crashes_to_segments(input_segment_fc, crash_years, crash_year_field,
                        " segments")
         return False
 
-def caluculate_sum_avg_field(crash_years, segs):
+def get_field_type(dataset, field_name):
     """
-    Count the total and average crashes for each year and update the values
+    AddField type keyword of a field of the dataset
     """
-    try:
-        #   Make a list for all year's crashes fields
-        update_fields = []
-        for year in crash_years:
-            update_fields.append("{0}{1}".format(CRASH_YEAR_FIELD, str(year)))
+    field_type = [field.type for field in arcpy.ListFields(dataset)
+                  if field.name.upper() == field_name.upper()][0]
+    return {"Integer": "LONG", "SmallInteger": "SHORT", "String": "TEXT",
+            "Double": "DOUBLE", "Single": "FLOAT"}.get(field_type, "LONG")
 
-        #   Add 2 fields to the list for Total Crash Count and Average Crashes
-        update_fields.append(TOTAL_CRASH_FIELD_NAME)
-        update_fields.append(AVG_CRASHES_FIELD_NAME)
-
-        #   Calculate total crash count and average crashes for each segment.
-        #   To calculate the average crashes, dividing by the number of years
-        #   for which it has count
-        with arcpy.da.UpdateCursor(segs, update_fields) as update_cursor:
-            for row in update_cursor:
-                total_count = 0
-                num_div_years = 0
-                for i in range(len(crash_years)):
-                    total_count += row[i]
-                    num_div_years += 1
-                if total_count == 0:
-                    row[-1] = None
-                    row[-2] = 0
-                    update_cursor.updateRow(row)
-                else:
-                    avg_crashes = float(total_count) / float(num_div_years)
-                    row[-1] = round(avg_crashes, 4)
-                    row[-2] = total_count
-                    update_cursor.updateRow(row)
-        del update_cursor
-        return True
+def add_fields(dataset, fields):
+    """
+    Add the [name, type] fields to a dataset in a single schema change where
+    AddFields is available
+    """
+    if hasattr(arcpy, "AddFields_management"):
+        arcpy.AddFields_management(dataset, fields)
+    else:
+        for field_name, field_type in fields:
+            arcpy.AddField_management(dataset, field_name, field_type)
 
-    except Exception:
-        arcpy.AddError("Error occured while calculating Total Crashes and " +
-                       "Average Crashes")
-        return False
+def count_crashes(pts, crash_year_field, crash_years):
+    """
+    Count the crashes of every segment and year. SEGIDs and years are mapped
+    to dense row and column numbers and the counts are accumulated with
+    bincount into a segments by years matrix.
+    Returns {SEGID: row} and the matrix
+    """
+    year_columns = dict((year, column) for column, year in enumerate(crash_years))
+    segment_rows = {}
+    rows = []
+    columns = []
+    with arcpy.da.SearchCursor(pts, [SEGMENTID_FIELD_NAME, crash_year_field]) as crash_cursor:
+        for row in crash_cursor:
+            rows.append(segment_rows.setdefault(row[0], len(segment_rows)))
+            columns.append(year_columns[int(row[1])])
+    cells = numpy.array(rows, dtype=numpy.int64) * len(crash_years) + \
+            numpy.array(columns, dtype=numpy.int64)
+    counts = numpy.bincount(cells, minlength=len(segment_rows) * len(crash_years))
+    return segment_rows, counts.reshape(len(segment_rows), len(crash_years))
+
+def write_crash_counts(segs, crash_years, segment_rows, counts):
+    """
+    Write the crash count of every year, the total crashes and the average
+    crashes of each segment in a single update pass. The average is the
+    total divided by the number of crash years, segments without crashes
+    have no average.
+    """
+    update_fields = ["{0}{1}".format(CRASH_YEAR_FIELD, year) for year in crash_years]
+    update_fields += [TOTAL_CRASH_FIELD_NAME, AVG_CRASHES_FIELD_NAME, SEGMENTID_FIELD_NAME]
+    no_crashes = [0] * len(crash_years)
+    with arcpy.da.UpdateCursor(segs, update_fields) as update_cursor:
+        for row in update_cursor:
+            segment_row = segment_rows.get(row[-1])
+            if segment_row is None:
+                year_counts = no_crashes
+            else:
+                year_counts = [int(count) for count in counts[segment_row]]
+            total_count = sum(year_counts)
+            avg_crashes = None
+            if total_count > 0:
+                avg_crashes = round(float(total_count) / float(len(crash_years)), 4)
+            update_cursor.updateRow(year_counts + [total_count, avg_crashes, row[-1]])
 
 def assign_values(input_segment_fc, input_crash_fc, crash_year_field, max_dist,
-                  output_folder):
+                  output_folder, segment_route_name_field=None, crash_route_field=None):
     """
     Assigns the segment id to crashes and crash count to segments
     """
@@ -400,7 +802,8 @@ def assign_values(input_segment_fc, input_crash_fc, crash_year_field, max_dist,
 
     # Perform Sptial Join with Crash Feature class
     crash_output_fc = assign_segid_to_crashes(max_dist, usrap_segment_layer,
-                                              input_crash_fc, out_gdb)
+                                              input_crash_fc, out_gdb,
+                                              segment_route_name_field, crash_route_field)
 
     arcpy.Delete_management(usrap_segment_layer)
 
@@ -453,9 +856,7 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
             add_message("Merging by relaxing Speed Limit...")
             add_message("-" * 80)
             step_count = 1
-            flds = [f.name for f in arcpy.ListFields(sorted_features_layer) if f.type != "OID"]
-            arcpy.DeleteIdentical_management(sorted_features_layer, flds)
-            del flds
+            delete_identical(sorted_features_layer, "Merge input")
 
             # Check select and copy to mem the unique vals from COUNTY_FIELD_NAME
             iii=0
@@ -465,11 +866,12 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
                 add_message("Merging segments in " + str(county_name))
                 ww = USRAP_WHERE + " AND " + COUNTY_FIELD_NAME + " = '" + str(county_name.replace("'", "''")) + "'"
                 arcpy.SelectLayerByAttribute_management(sorted_features_layer, "NEW_SELECTION", ww)
-                in_mem_class = r"in_memory\c" + str(iii)
+                in_mem_class = scratch_path("c" + str(iii))
                 in_mem_layer = "fl" + str(iii)
                 arcpy.CopyFeatures_management(sorted_features_layer, in_mem_class)
+                in_mem_class = track_scratch(in_mem_class)
                 if VERSION_USED != "10.2":
-                    arcpy.RepairGeometry_management(in_mem_class, "DELETE_NULL")
+                    check_geometry(in_mem_class, "Segments in " + str(county_name))
 
                 arcpy.MakeFeatureLayer_management(in_mem_class, in_mem_layer)
 
@@ -478,7 +880,10 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
                 
                 arcpy.SelectLayerByAttribute_management(in_mem_layer,"CLEAR_SELECTION")
                 arcpy.Append_management(in_mem_layer, temp_segments)
+                arcpy.Delete_management(in_mem_layer)
+                report_scratch(str(county_name))
 
+            report_merge_stats()
             arcpy.SelectLayerByAttribute_management(sorted_features_layer, "NEW_SELECTION", "{0} <> 'YES'".format(USRAP_SEGMENT_FIELD_NAME))
 
             arcpy.Append_management(sorted_features_layer, temp_segments)
@@ -518,8 +923,9 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
 
                     w = USRAP_WHERE + " AND " + COUNTY_FIELD_NAME + " = '" + str(county_name.replace("'", "''")) + "'"
                     arcpy.SelectLayerByAttribute_management(sorted_features_layer, "NEW_SELECTION", w)
-                    in_mem_class = r"in_memory\c" + str(iii)
+                    in_mem_class = scratch_path("c" + str(iii))
                     arcpy.CopyFeatures_management(sorted_features_layer, in_mem_class)
+                    in_mem_class = track_scratch(in_mem_class)
                     in_mem_layer = "fl" + str(iii)
                     arcpy.MakeFeatureLayer_management(in_mem_class, in_mem_layer)
 
@@ -527,8 +933,11 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
                                     "without_aadt", next_step_count, condition, segment_route_name_field,crash_fields, USRAP_WHERE)
                     arcpy.SelectLayerByAttribute_management(in_mem_layer,"CLEAR_SELECTION")
                     arcpy.Append_management(in_mem_layer, temp_segments2)
+                    arcpy.Delete_management(in_mem_layer)
+                    report_scratch(str(county_name))
 
 
+                report_merge_stats()
                 arcpy.SelectLayerByAttribute_management(sorted_features_layer, "NEW_SELECTION", "{0} <> 'YES'".format(USRAP_SEGMENT_FIELD_NAME))
                 arcpy.Append_management(sorted_features_layer, temp_segments2)
 
@@ -567,7 +976,7 @@ def check_criteria(sorted_features_layer, conditions, criterias, check_fields, s
     except Exception as ex:
         print(ex.args)
         arcpy.AddError("Error occurred while checking conditions..")
-        sys.exit()
+        return None
 
 def get_avg_per_segment(layer):
     """
@@ -653,7 +1062,7 @@ def build_check_condition(sorted_features_layer, condition, criteria, param):
      
     except Exception:
         arcpy.AddError("Error occurred while checking conditions..")
-        sys.exit()
+        raise
 
 def calculate_percentage_change(val1, val2):
     return math.fabs(((val2-val1)/val1) * 100)
@@ -669,6 +1078,84 @@ def calculate_length_weighted_avg(val1, length1, val2, length2):
     elif val1 != None and val2 != None:
         return round((val1 + val2)/2, 1)
 
+def join_segments(geometry, other_geometry, tolerance, has_z, has_m):
+    """
+    Joins the geometry of a merged segment to the geometry of the segment
+    absorbing it, end to end chains are concatenated and other shapes fall
+    back to a union
+    """
+    if geometry is None:
+        return other_geometry
+    joined = chain_polylines([geometry, other_geometry], tolerance, has_z, has_m)
+    if joined is None:
+        MERGE_STATS['unions'] += 1
+        return other_geometry.union(geometry)
+    MERGE_STATS['chains'] += 1
+    return joined
+
+def find_segid_root(parents, segid):
+    """
+    Surviving SEGID of the merge group that contains segid
+    """
+    root = segid
+    while parents.get(root, root) != root:
+        root = parents[root]
+    # compress the path so later lookups are a single step
+    while parents.get(segid, segid) != root:
+        parents[segid], segid = root, parents[segid]
+    return root
+
+def union_segids(parents, survivor, merged):
+    """
+    Attach the merge group of merged to the merge group of survivor
+    """
+    survivor = find_segid_root(parents, survivor)
+    merged = find_segid_root(parents, merged)
+    if survivor != merged:
+        parents[merged] = survivor
+    return survivor
+
+def remap_crash_segids(crash_output, parents):
+    """
+    Replace the SEGID of every crash on a merged segment with the SEGID of
+    the surviving segment in a single cursor pass
+    Returns the number of crashes updated
+    """
+    updated = 0
+    if len(parents) == 0:
+        return updated
+    with arcpy.da.UpdateCursor(crash_output, [SEGMENTID_FIELD_NAME],
+                               SEGMENTID_FIELD_NAME + " IS NOT NULL") as update_cursor:
+        for row in update_cursor:
+            if row[0] in parents:
+                update_cursor.updateRow([find_segid_root(parents, row[0])])
+                updated += 1
+    return updated
+
+def write_lineage_table(out_gdb, parents, segid_type):
+    """
+    Write every merged SEGID with the SEGID of the segment it ended up in,
+    SEGIDs that were not merged are not listed
+    """
+    lineage_table = os.path.join(out_gdb, LINEAGE_TABLE_NAME)
+    if arcpy.Exists(lineage_table):
+        arcpy.Delete_management(lineage_table)
+    arcpy.CreateTable_management(out_gdb, LINEAGE_TABLE_NAME)
+    add_fields(lineage_table, [["ORIGINAL_SEGID", segid_type], ["FINAL_SEGID", segid_type]])
+    with arcpy.da.InsertCursor(lineage_table, ["ORIGINAL_SEGID", "FINAL_SEGID"]) as cursor:
+        for segid in sorted(parents):
+            cursor.insertRow((segid, find_segid_root(parents, segid)))
+    return lineage_table
+
+def report_merge_stats():
+    """
+    Reports how the merged geometries were joined and resets the counts
+    """
+    add_message("{0} merges joined end to end, {1} joined with a union".format(
+        MERGE_STATS['chains'], MERGE_STATS['unions']))
+    MERGE_STATS['chains'] = 0
+    MERGE_STATS['unions'] = 0
+
 def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
                   condition, segment_route_name_field, crash_fields, where):
     """
@@ -678,7 +1165,6 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
         #get sorted cursor
         delete_oids = []
         union_geoms = []
-        seg_ids = {}
 
         i=0
 
@@ -690,6 +1176,11 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
         seg_id_field_index = check_fields.index(SEGMENTID_FIELD_NAME)
         aadt_field_index = check_fields.index(AVG_AADT_FIELD_NAME)
 
+        desc = arcpy.Describe(sorted_features_layer)
+        tolerance = desc.spatialReference.XYTolerance or 0.001
+        has_z, has_m = desc.hasZ, desc.hasM
+        del desc
+
         arcpy.SelectLayerByAttribute_management(sorted_features_layer, "NEW_SELECTION",where)
         with arcpy.da.UpdateCursor(sorted_features_layer, check_fields, sql_clause=(None, 'ORDER BY ' + USRAP_ROADWAY_TYPE_FIELDNAME + " DSC")) as update_cursor:
             for row in update_cursor:
@@ -745,10 +1236,8 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
                                                     new_aadt = calculate_length_weighted_avg(aadt_1, row[-2], aadt_2, search_row[-2])
                                                     row[check_fields.index(AVG_AADT_FIELD_NAME)] = new_aadt
                                                 try:
-                                                    if row[-1] != None:
-                                                        row[-1] = search_row[-1].union(row[-1])
-                                                    else:
-                                                        row[-1] = search_row[-1]
+                                                    row[-1] = join_segments(row[-1], search_row[-1],
+                                                                            tolerance, has_z, has_m)
                                                 except Exception as ex:
                                                     msg = "Merge failed for ObjectId {0} and {1}".format(search_row[0], row[0])
                                                     arcpy.AddWarning(msg)
@@ -764,7 +1253,7 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
                                                 row[check_fields.index(AVG_CRASHES_FIELD_NAME)] = new_avg
                                                 update_cursor.updateRow(row)
                                                 delete_oids.append(search_row[0])
-                                                seg_ids[seg_id2] = seg_id1
+                                                union_segids(SEGID_LINEAGE, seg_id1, seg_id2)
                                         else:
                                             #This is checked while relaxing AADT
                                             for crash_field in crash_fields:
@@ -783,18 +1272,16 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
                                                 new_avg = new_total / float(len(crash_fields) -1)
                                             row[check_fields.index(AVG_CRASHES_FIELD_NAME)] = new_avg  
                                         
-                                            try:    
-                                                if row[-1] != None:
-                                                    row[-1] = search_row[-1].union(row[-1])
-                                                else:
-                                                    row[-1] = search_row[-1]
+                                            try:
+                                                row[-1] = join_segments(row[-1], search_row[-1],
+                                                                        tolerance, has_z, has_m)
                                             except Exception as ex:
                                                 msg = "Merge failed for ObjectId {0} and {1}".format(search_row[0], row[0])
                                                 arcpy.AddWarning(msg)
                                             pass
                                             update_cursor.updateRow(row)
                                             delete_oids.append(search_row[0]) 
-                                            seg_ids[seg_id2] = seg_id1               
+                                            union_segids(SEGID_LINEAGE, seg_id1, seg_id2)
 
         #delete extras
         if len(delete_oids) > 0:
@@ -825,18 +1312,6 @@ def union_segments(sorted_features_layer, check_fields, aadt_check, step_count,
                                                             where)
             arcpy.DeleteRows_management(sorted_features_layer)
 
-            current_values = []
-            for seg_value in list(seg_ids.keys()):
-                current_values.append(str(seg_value))
-
-            where = SEGMENTID_FIELD_NAME +' = ' + ' OR {0} = '.format(SEGMENTID_FIELD_NAME).join(current_values)
-
-            arcpy.AddMessage("Updating crash features...")
-            with arcpy.da.UpdateCursor(CRASH_OUTPUT_NAME, [SEGMENTID_FIELD_NAME], where_clause=where) as update_points_cursor:
-                for u_row in update_points_cursor:
-                    u_row[0] = seg_ids[u_row[0]]
-                    update_points_cursor.updateRow(u_row)
-
         if len(union_geoms) > 0:
             try:
                 union_geom_ids = map(str, union_geoms)
@@ -1194,6 +1669,48 @@ def main():
 
     output_folder = arcpy.GetParameterAsText(9)
 
+    full_out_path = execute(input_segment_fc, segment_route_name_field,
+                            segment_route_type_field, input_crash_fc,
+                            crash_route_field, crash_year_field, max_dist,
+                            min_avg_crashes, per_of_segments, output_folder)
+    if full_out_path:
+        arcpy.SetParameterAsText(10, full_out_path)
+
+def execute(input_segment_fc, segment_route_name_field, segment_route_type_field,
+            input_crash_fc, crash_route_field, crash_year_field, max_dist,
+            min_avg_crashes, per_of_segments, output_folder):
+    """
+    Assign the crashes and merge the segments with the tool parameters
+    given as values, every run starts with an empty metadata cache so
+    several runs can be made in one process.
+    Returns the path of the output segments or None when it failed.
+    """
+    MERGE_STATS['chains'] = MERGE_STATS['unions'] = 0
+    SEGID_LINEAGE.clear()
+    clear_metadata_cache()
+    SCRATCH['folder'] = os.path.join(output_folder, SCRATCH_FOLDER_NAME)
+    SCRATCH['budget_mb'] = SCRATCH_MEMORY_BUDGET_MB
+    try:
+        return assign_and_merge(input_segment_fc, segment_route_name_field,
+                                segment_route_type_field, input_crash_fc,
+                                crash_route_field, crash_year_field, max_dist,
+                                min_avg_crashes, per_of_segments, output_folder)
+    finally:
+        # scratch data must not outlive the run, failed runs included
+        arcpy.Delete_management("in_memory")
+        clear_scratch()
+        shutil.rmtree(SCRATCH['folder'], ignore_errors=True)
+        arcpy.env.workspace = None
+        arcpy.ResetProgressor()
+
+def assign_and_merge(input_segment_fc, segment_route_name_field, segment_route_type_field,
+                     input_crash_fc, crash_route_field, crash_year_field, max_dist,
+                     min_avg_crashes, per_of_segments, output_folder):
+    """
+    Assign the crashes, merge the segments and check the outputs for
+    errors, the scratch data is cleared by execute
+    Returns the path of the output segments or None when it failed.
+    """
     #get full path if FeatureLayer
     input_segment_fc = check_path(input_segment_fc)
     input_crash_fc = check_path(input_crash_fc)
@@ -1203,7 +1720,8 @@ def main():
     # Assigning Segmemnt IDs to Crashes and crash count to Segments
     returned_values = assign_values(input_segment_fc, input_crash_fc,
                                     crash_year_field, max_dist,
-                                    output_folder)
+                                    output_folder, segment_route_name_field,
+                                    crash_route_field)
     if not returned_values:
         return
 
@@ -1227,7 +1745,7 @@ def main():
     arcpy.SetProgressor("step", "Merging segments..", 0, steps, int(SEGMENT_INCREMENT))
     try:
         temp_seg = SEGMENT_OUTPUT_PATH
-        arcpy.RepairGeometry_management(temp_seg)
+        check_geometry(temp_seg, "Segments")
         sorted_path = os.path.join(out_gdb, "sorted_segments")
         sorted_segments = arcpy.Sort_management(temp_seg, sorted_path, [["SHAPE_Length", "DESCENDING"]])
         sorted_features_layer = arcpy.MakeFeatureLayer_management(sorted_segments, "sorted_features_layer")
@@ -1266,6 +1784,8 @@ def main():
         ts = check_criteria(sorted_features_layer, [min_avg_crashes, per_of_segments],
                        ["min average", "per segments"],
                        check_fields, segment_route_name_field, crash_fields, full_out_path + "_temp")
+        if not ts:
+            return
 
         arcpy.Delete_management(sorted_path)
         del sorted_path
@@ -1273,11 +1793,20 @@ def main():
         arcpy.SetProgressorPosition(int(steps) - 1)
         add_message("Merging of segments completed.")
 
+        #   Point the crashes at the surviving segments and keep the lineage
+        #   of every merged SEGID
+        arcpy.AddMessage("Updating crash features...")
+        crash_output = os.path.join(out_gdb, CRASH_OUTPUT_NAME)
+        updated = remap_crash_segids(crash_output, SEGID_LINEAGE)
+        write_lineage_table(out_gdb, SEGID_LINEAGE,
+                            get_field_type(crash_output, SEGMENTID_FIELD_NAME))
+        add_message("{0} crashes moved to merged segments, lineage of {1} SEGIDs written to {2}"
+                    .format(updated, len(SEGID_LINEAGE), LINEAGE_TABLE_NAME))
+
         #   Clear the selection from the layer and copy it as new feature class
         #   in output Geodatabase
         output_layer = arcpy.MakeFeatureLayer_management(ts,"output_layer", "1=1")
         arcpy.CopyFeatures_management(output_layer, full_out_path)
-        arcpy.SetParameterAsText(10, full_out_path)
         try:
             if arcpy.Exists(output_layer):
                 arcpy.Delete_management(output_layer)
@@ -1323,17 +1852,14 @@ def main():
     #   crashes in input dataset
     check_total_crashes(unassigned_crashes)
 
-    arcpy.Delete_management("in_memory")
-
     del input_segment_fc, segment_route_name_field, segment_route_type_field
-    del SEGMENT_OUTPUT_PATH, sorted_segments, returned_values
+    del sorted_segments, returned_values
     del input_crash_fc, crash_route_field, crash_year_field, max_dist
     del min_avg_crashes, per_of_segments, output_folder
     del crash_years, aadt_years, usrap_count, out_gdb, table_created, check_fields, crash_fields
     del unassigned_crashes, segment_error_added
 
-    arcpy.env.workspace = None
-    arcpy.ResetProgressor()
+    return full_out_path
 
 if __name__ == '__main__':
     main()
@@ -374,12 +374,13 @@ def get_popup_html(calc_field, aadt_fields):
     html += '<div><br /></div><div><b>Assigned Crash Count:</b> {{{0}}}</div><div><br /></div><div><b>USRAP Roadway Type:</b> {{{1}}}</div></div>'.format(CRASH_COUNT_FIELDNAME, USRAP_ROADWAY_TYPE_FIELDNAME)
     return html
 
-def update_and_save_map(segments, route_name_field):
+def update_and_save_map(segments, route_name_field, project='CURRENT'):
     """
     Create a new map in the project with risk map layers added.
+    A project other than the current one is saved once the map is added.
     """
     import arcpy.mp as mapping
-    prj = mapping.ArcGISProject('CURRENT')
+    prj = mapping.ArcGISProject(project)
 
     desc = arcpy.Describe(segments)
     aadt_fields = arcpy.ListFields(segments, USRAP_AADT_YYYY)
@@ -429,6 +430,8 @@ def update_and_save_map(segments, route_name_field):
             layer_connection = layer.connectionProperties['connection_info']['database']
             layer.updateConnectionProperties(layer_connection, desc.path)
     
+    if project != 'CURRENT':
+        prj.save()
     arcpy.AddMessage("Map: " + new_map.name + " was created successfully.")
     arcpy.AddMessage("Please check under the Maps entry in the Project pane.")
 
@@ -451,6 +454,34 @@ def main():
     segments = arcpy.GetParameterAsText(0)
     route_name_field = arcpy.GetParameterAsText(1)
 
+    execute(segments, route_name_field)
+
+def get_project(project=None):
+    """
+    The project the risk map is added to, the current project when project is None,
+    which only exists when the tool runs inside ArcGIS Pro
+    """
+    if project:
+        return project
+    import arcpy.mp as mapping
+    try:
+        mapping.ArcGISProject('CURRENT')
+    except (OSError, RuntimeError):
+        raise ValueError("No ArcGIS Pro project is open, give the path of the .aprx "
+                         "project the risk map should be added to")
+    return 'CURRENT'
+
+def execute(segments, route_name_field, project=None):
+    """
+    This function will create the risk maps with the tool parameters given as values,
+    the map is added to the project given or to the current project when it is None
+    """
+    #fail before the segments are changed when there is no project for the map
+    project = get_project(project)
+
+    #the crash rates of an earlier run in the same process are not reused
+    crash_rate_for_road_type.clear()
+
     segments = check_path(segments)
 
     add_fields(segments, CRASH_CALC_FIELDS, "DOUBLE", 6)
@@ -475,7 +506,8 @@ def main():
     create_summary_tables(layer, summary_table_values, route_name_field)
 
     #update the datasource for the layers in the map and save a new mxd
-    update_and_save_map(segments, route_name_field)
+    update_and_save_map(segments, route_name_field, project)
+    return segments
 
 if __name__ == '__main__':
     try:
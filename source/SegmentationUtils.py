@@ -0,0 +1,453 @@
+"""
+-------------------------------------------------------------------------------
+ | Copyright 2015 Esri
+ |
+ | Licensed under the Apache License, Version 2.0 (the "License");
+ | you may not use this file except in compliance with the License.
+ | You may obtain a copy of the License at
+ |
+ |    http://www.apache.org/licenses/LICENSE-2.0
+ |
+ | Unless required by applicable law or agreed to in writing, software
+ | distributed under the License is distributed on an "AS IS" BASIS,
+ | WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ | See the License for the specific language governing permissions and
+ | limitations under the License.
+ ------------------------------------------------------------------------------
+ """
+# Helpers shared by BasicSegmentation and CrashAssignment: the metadata
+# cache, the intermediate datasets of a process, the geometry checks run
+# before the overlay, the removal of duplicate geometries and the chaining
+# of polyline parts. The scripts set SCRATCH['folder'] and
+# SCRATCH['budget_mb'] from their own configuration before a run.
+import arcpy
+import os
+import itertools
+import numpy
+
+IN_MEMORY = 'in_memory'
+SCRATCH_GDB_NAME = "scratch_{0}.gdb"
+
+# Number of shapes read to estimate the size of an intermediate dataset
+SIZE_SAMPLE_ROWS = 1000
+
+# arcpy.Describe results and field lists keyed by catalog path, see describe
+# and list_fields, the scripts keep their own caches in the other keys
+METADATA_CACHE = {'describe': {}, 'fields': {}, 'domains': {}, 'domain_codes': {},
+                  'projections': {}}
+METADATA_STATS = {'hits': 0, 'misses': 0}
+
+# Intermediate datasets of the current process, see scratch_path and
+# track_scratch, datasets maps the path a dataset was created at to its
+# current path and estimated size in bytes
+SCRATCH = {'datasets': {}, 'memory': 0, 'peak': 0, 'spilled': 0, 'names': 0,
+           'folder': None, 'budget_mb': 8192}
+
+def add_message(msg):
+    arcpy.SetProgressorLabel(msg)
+    arcpy.AddMessage(msg)
+
+#===================== Metadata ===============================================#
+def describe(dataset):
+    """
+    Cached arcpy.Describe of a dataset, keyed by its path
+    """
+    key = str(dataset)
+    if key in METADATA_CACHE['describe']:
+        METADATA_STATS['hits'] += 1
+    else:
+        METADATA_STATS['misses'] += 1
+        METADATA_CACHE['describe'][key] = arcpy.Describe(dataset)
+    return METADATA_CACHE['describe'][key]
+
+def list_fields(dataset):
+    """
+    Cached field list of a dataset
+    """
+    key = str(dataset)
+    if key in METADATA_CACHE['fields']:
+        METADATA_STATS['hits'] += 1
+    else:
+        METADATA_STATS['misses'] += 1
+        METADATA_CACHE['fields'][key] = arcpy.ListFields(dataset)
+    return METADATA_CACHE['fields'][key]
+
+def invalidate_metadata(dataset):
+    """
+    Drop the cached metadata of a dataset after its schema has changed or it
+    has been deleted, a workspace path drops every dataset in it
+    """
+    key = str(dataset)
+    for cache in (METADATA_CACHE['describe'], METADATA_CACHE['fields']):
+        for cached in list(cache.keys()):
+            if cached == key or cached.startswith(key + os.sep) or \
+                    cached.startswith(key + "\\"):
+                del cache[cached]
+
+def clear_metadata_cache():
+    """
+    Start a run with an empty metadata cache
+    """
+    for cache in METADATA_CACHE.values():
+        cache.clear()
+    METADATA_STATS['hits'] = 0
+    METADATA_STATS['misses'] = 0
+
+#===================== Scratch Data ===========================================#
+def get_scratch_gdb():
+    """
+    Scratch file geodatabase of this process, created on first use
+    """
+    scratch_gdb = os.path.join(SCRATCH['folder'], SCRATCH_GDB_NAME.format(os.getpid()))
+    if not arcpy.Exists(scratch_gdb):
+        if not os.path.exists(SCRATCH['folder']):
+            os.makedirs(SCRATCH['folder'])
+        arcpy.CreateFileGDB_management(SCRATCH['folder'], os.path.basename(scratch_gdb))
+    return scratch_gdb
+
+def scratch_path(prefix):
+    """
+    Collision free path for a new intermediate dataset, in_memory while the
+    memory budget allows it and the scratch geodatabase otherwise
+    """
+    SCRATCH['names'] += 1
+    name = "{0}_{1}".format(prefix, SCRATCH['names'])
+    if SCRATCH['memory'] < SCRATCH['budget_mb'] * 1048576:
+        return IN_MEMORY + "\\" + str(arcpy.ValidateTableName(name, IN_MEMORY))
+    SCRATCH['spilled'] += 1
+    scratch_gdb = get_scratch_gdb()
+    return os.path.join(scratch_gdb, str(arcpy.ValidateTableName(name, scratch_gdb)))
+
+def estimate_size(dataset):
+    """
+    Approximate size in bytes of a dataset, the width of its fields plus the
+    average well known binary size of the first SIZE_SAMPLE_ROWS shapes for
+    every row
+    """
+    width = 0
+    for field in list_fields(dataset):
+        width += field.length if field.type == 'String' else 8
+    count = int(arcpy.GetCount_management(dataset)[0])
+    if count == 0:
+        return 0
+    with arcpy.da.SearchCursor(dataset, ["SHAPE@WKB"]) as cursor:
+        sample = [len(row[0]) if row[0] else 0
+                  for row in itertools.islice(cursor, SIZE_SAMPLE_ROWS)]
+    shape_size = float(sum(sample)) / len(sample) if len(sample) > 0 else 0
+    return int(count * (width + shape_size))
+
+def is_in_memory(dataset):
+    """
+    True when a dataset is held in the in_memory workspace
+    """
+    return str(dataset).lower().startswith(IN_MEMORY)
+
+def track_scratch(dataset):
+    """
+    Record the size of an intermediate dataset once it is written, when the
+    memory budget is exceeded the largest in_memory intermediates are moved
+    to the scratch geodatabase
+    Returns the path the dataset can be found at
+    """
+    size = estimate_size(dataset)
+    SCRATCH['datasets'][str(dataset)] = [str(dataset), size]
+    if is_in_memory(dataset):
+        SCRATCH['memory'] += size
+        SCRATCH['peak'] = max(SCRATCH['peak'], SCRATCH['memory'])
+    while SCRATCH['memory'] > SCRATCH['budget_mb'] * 1048576:
+        in_memory = [(record[1], key) for key, record in SCRATCH['datasets'].items()
+                     if is_in_memory(record[0])]
+        if len(in_memory) == 0:
+            break
+        size, key = max(in_memory)
+        current = SCRATCH['datasets'][key][0]
+        scratch_gdb = get_scratch_gdb()
+        spilled = os.path.join(scratch_gdb, str(arcpy.ValidateTableName(
+            os.path.basename(current), scratch_gdb)))
+        arcpy.CopyFeatures_management(current, spilled)
+        arcpy.Delete_management(current)
+        invalidate_metadata(current)
+        SCRATCH['datasets'][key][0] = spilled
+        SCRATCH['memory'] -= size
+        SCRATCH['spilled'] += 1
+    return get_scratch(dataset)
+
+def get_scratch(dataset):
+    """
+    Current path of an intermediate dataset that may have been spilled
+    """
+    record = SCRATCH['datasets'].get(str(dataset))
+    return record[0] if record else dataset
+
+def release_scratch(dataset):
+    """
+    Delete an intermediate dataset and stop tracking it
+    """
+    record = SCRATCH['datasets'].pop(str(dataset), None)
+    if record is None:
+        for key, value in list(SCRATCH['datasets'].items()):
+            if value[0] == str(dataset):
+                record = SCRATCH['datasets'].pop(key)
+    current = record[0] if record else dataset
+    if arcpy.Exists(current):
+        arcpy.Delete_management(current)
+    invalidate_metadata(current)
+    if record and is_in_memory(current):
+        SCRATCH['memory'] -= record[1]
+
+def clear_scratch():
+    """
+    Delete every tracked intermediate and the scratch geodatabase
+    Returns the peak in_memory usage in bytes and the number of
+    intermediates written to disk since the last call
+    """
+    for key in list(SCRATCH['datasets'].keys()):
+        release_scratch(key)
+    if SCRATCH['folder']:
+        scratch_gdb = os.path.join(SCRATCH['folder'], SCRATCH_GDB_NAME.format(os.getpid()))
+        if arcpy.Exists(scratch_gdb):
+            arcpy.Delete_management(scratch_gdb)
+            invalidate_metadata(scratch_gdb)
+    stats = (SCRATCH['peak'], SCRATCH['spilled'])
+    SCRATCH['memory'] = 0
+    SCRATCH['peak'] = 0
+    SCRATCH['spilled'] = 0
+    return stats
+
+#===================== Geometry Checks ========================================#
+def get_rings(part):
+    """
+    Split a part at the null points separating polygon rings
+    """
+    rings = [[]]
+    for point in part:
+        if point:
+            rings[-1].append(point)
+        else:
+            rings.append([])
+    return [ring for ring in rings if len(ring) > 0]
+
+def get_vertex_health(points, resolution):
+    """
+    Mask of the vertices repeating the vertex before them and whether the
+    part doubles back over itself, points is a list of (x, y)
+    """
+    coords = numpy.array(points, dtype=float).reshape(-1, 2)
+    steps = numpy.diff(coords, axis=0)
+    repeated = numpy.concatenate(([False], numpy.all(numpy.abs(steps) <= resolution, axis=1)))
+    moves = steps[~repeated[1:]]
+    if len(moves) < 2:
+        return repeated, False
+    cross = moves[:-1, 0] * moves[1:, 1] - moves[:-1, 1] * moves[1:, 0]
+    dot = numpy.sum(moves[:-1] * moves[1:], axis=1)
+    scale = numpy.hypot(moves[:-1, 0], moves[:-1, 1]) * numpy.hypot(moves[1:, 0], moves[1:, 1])
+    overlaps = (numpy.abs(cross) <= 1e-9 * scale) & (dot < 0)
+    return repeated, bool(overlaps.any())
+
+def inspect_geometry(geometry, resolution):
+    """
+    Health of a single geometry, the defect that removes it ('null', 'empty'
+    or 'zero length') or None, its rings without the repeated vertices and
+    whether vertices repeat and whether a part doubles back over itself
+    """
+    if geometry is None:
+        return 'null', [], False, False
+    if geometry.pointCount == 0:
+        return 'empty', [], False, False
+    if geometry.length <= 0:
+        return 'zero length', [], False, False
+    parts = []
+    duplicates = overlaps = False
+    for part in geometry:
+        for ring in get_rings(part):
+            repeated, overlap = get_vertex_health([(point.X, point.Y) for point in ring],
+                                                  resolution)
+            overlaps = overlaps or overlap
+            if repeated.any():
+                duplicates = True
+                ring = [point for point, skip in zip(ring, repeated) if not skip]
+            if len(ring) > 1:
+                parts.append(ring)
+    if duplicates and len(parts) == 0:
+        return 'zero length', [], False, False
+    return None, parts, duplicates, overlaps
+
+def report_geometry(stage, counts, repaired):
+    """
+    Report the features of each kind found by the geometry check of a layer
+    """
+    add_message("{0}: {1} repaired with Repair Geometry ({2})".format(
+        stage, repaired, ", ".join("{0} {1}".format(counts[key], key) for key in
+                                   ['null', 'empty', 'zero length', 'duplicate vertices',
+                                    'self overlapping'])))
+
+def check_geometry(feature_class, stage):
+    """
+    Validate every geometry in a single cursor pass, null, empty and zero
+    length features are deleted and repeated vertices are removed from
+    polylines in memory, Repair Geometry only runs on the features that
+    double back over themselves or could not be fixed in memory
+    Returns the number of features of each kind
+    """
+    desc = describe(feature_class)
+    resolution = desc.spatialReference.XYResolution or 0.0001
+    is_line = desc.shapeType == 'Polyline'
+    counts = {'null': 0, 'empty': 0, 'zero length': 0, 'duplicate vertices': 0,
+              'self overlapping': 0}
+    repair = []
+    with arcpy.da.UpdateCursor(feature_class, ['OID@', 'SHAPE@']) as cursor:
+        for row in cursor:
+            geometry = row[1]
+            defect, parts, duplicates, overlaps = inspect_geometry(geometry, resolution)
+            if defect:
+                counts[defect] += 1
+                cursor.deleteRow()
+                continue
+            fixable = is_line and not getattr(geometry, 'hasCurves', False)
+            if duplicates:
+                counts['duplicate vertices'] += 1
+            if overlaps:
+                counts['self overlapping'] += 1
+            if overlaps or (duplicates and not fixable):
+                repair.append(row[0])
+            elif duplicates:
+                row[1] = arcpy.Polyline(arcpy.Array([arcpy.Array(ring) for ring in parts]),
+                                        desc.spatialReference, desc.hasZ, desc.hasM)
+                cursor.updateRow(row)
+
+    if len(repair) > 0:
+        where = "{0} IN ({1})".format(desc.oidFieldName, ",".join(str(oid) for oid in repair))
+        repair_layer = arcpy.MakeFeatureLayer_management(feature_class, "repair_layer", where)[0]
+        arcpy.RepairGeometry_management(repair_layer)
+        arcpy.Delete_management(repair_layer)
+    report_geometry(stage, counts, len(repair))
+    return counts
+
+def check_features(features, spatial_reference, stage):
+    """
+    Validate the (value, geometry) features of a layer read into memory the
+    way check_geometry validates a feature class, only the features that
+    need it are copied to in_memory for Repair Geometry
+    Returns the features that are left
+    """
+    resolution = spatial_reference.XYResolution or 0.0001
+    counts = {'null': 0, 'empty': 0, 'zero length': 0, 'duplicate vertices': 0,
+              'self overlapping': 0}
+    checked = []
+    repair = []
+    for value, geometry in features:
+        defect, parts, duplicates, overlaps = inspect_geometry(geometry, resolution)
+        if defect:
+            counts[defect] += 1
+            continue
+        fixable = geometry.type == 'polyline' and not getattr(geometry, 'hasCurves', False)
+        if duplicates:
+            counts['duplicate vertices'] += 1
+        if overlaps:
+            counts['self overlapping'] += 1
+        if overlaps or (duplicates and not fixable):
+            repair.append(len(checked))
+        elif duplicates:
+            points = [point for ring in parts for point in ring]
+            geometry = arcpy.Polyline(arcpy.Array([arcpy.Array(ring) for ring in parts]),
+                                      geometry.spatialReference,
+                                      any(point.Z is not None for point in points),
+                                      any(point.M is not None for point in points))
+        checked.append((value, geometry))
+
+    if len(repair) > 0:
+        # the features are copied in order so object id n is checked[repair[n - 1]]
+        repair_fc = IN_MEMORY + "\\repair_features"
+        arcpy.CopyFeatures_management([checked[index][1] for index in repair], repair_fc)
+        arcpy.RepairGeometry_management(repair_fc)
+        repaired = dict((repair[oid - 1], geometry) for oid, geometry in
+                        arcpy.da.SearchCursor(repair_fc, ['OID@', 'SHAPE@']))
+        arcpy.Delete_management(repair_fc)
+        invalidate_metadata(repair_fc)
+        checked = [(value, repaired[index]) if index in repaired else (value, geometry)
+                   for index, (value, geometry) in enumerate(checked)
+                   if index in repaired or index not in repair]
+    report_geometry(stage, counts, len(repair))
+    return checked
+
+#===================== Duplicate Geometries ===================================#
+def get_geometry_key(geometry, resolution):
+    """
+    Vertices of a geometry snapped to the resolution of its spatial
+    reference, the same line digitized in either direction gives the same key
+    """
+    if geometry is None:
+        return None
+    parts = []
+    for part in geometry:
+        points = [(point.X, point.Y) for point in part if point]
+        parts.append(numpy.rint(numpy.array(points, dtype=float).reshape(-1, 2) / resolution)
+                     .astype(numpy.int64))
+    forward = b'|'.join(part.tobytes() for part in parts)
+    backward = b'|'.join(part[::-1].tobytes() for part in reversed(parts))
+    return min(forward, backward)
+
+def delete_identical(feature_class, stage, fields=None):
+    """
+    Delete the rows repeating the field values and shape of an earlier row
+    in a single cursor pass, every field that is not required is compared
+    when fields is None
+    Returns the number of rows deleted
+    """
+    if fields is None:
+        fields = [field.name for field in list_fields(feature_class) if not field.required]
+    resolution = describe(feature_class).spatialReference.XYResolution or 0.0001
+    seen = set()
+    removed = 0
+    with arcpy.da.UpdateCursor(feature_class, list(fields) + ['SHAPE@']) as cursor:
+        for row in cursor:
+            key = (tuple(row[:-1]), get_geometry_key(row[-1], resolution))
+            if key in seen:
+                cursor.deleteRow()
+                removed += 1
+            else:
+                seen.add(key)
+    add_message("{0}: {1} identical segments removed".format(stage, removed))
+    return removed
+
+#===================== Polyline Chaining ======================================#
+def chain_polylines(geometries, tolerance, has_z=False, has_m=False):
+    """
+    Join polylines that meet end to end into one polyline by concatenating
+    their vertices in the right direction
+    Returns None when the polylines do not form a single chain
+    """
+    parts = []
+    for geometry in geometries:
+        if geometry is None or geometry.isMultipart or getattr(geometry, 'hasCurves', False):
+            return None
+        points = [point for point in geometry.getPart(0) if point]
+        if len(points) < 2:
+            return None
+        parts.append(points)
+
+    def near(point_1, point_2):
+        """
+        End points closer than the tolerance
+        """
+        return abs(point_1.X - point_2.X) <= tolerance and abs(point_1.Y - point_2.Y) <= tolerance
+
+    chain = parts[0]
+    remaining = parts[1:]
+    while len(remaining) > 0:
+        for index, points in enumerate(remaining):
+            if near(chain[-1], points[0]):
+                chain = chain + points[1:]
+            elif near(chain[-1], points[-1]):
+                chain = chain + points[-2::-1]
+            elif near(chain[0], points[-1]):
+                chain = points[:-1] + chain
+            elif near(chain[0], points[0]):
+                chain = points[:0:-1] + chain
+            else:
+                continue
+            del remaining[index]
+            break
+        else:
+            return None
+    return arcpy.Polyline(arcpy.Array(chain), geometries[0].spatialReference, has_z, has_m)